@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Headless render check of many books in one process, for CI.
+#
+# Every book is opened in the viewer under Qt's offscreen platform with the
+# GPU disabled. All of them share one QApplication and one profile, so
+# Chromium starts once for the whole run, and up to --workers books load at
+# the same time. For each book the time from setUrl() to Readium's first
+# rendered page, the JavaScript errors it logged and the remote requests
+# that were blocked are recorded and a JSON summary is written at the end.
+#
+#   python batchcheck.py BOOK... [--list FILE] [-j 4] [-o summary.json]
+#
+# BOOK is an unpacked book folder or a .epub file. Exits with 1 if any book
+# failed to render.
+
+import os
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import contextlib
+
+from plugin_utils import QtCore, QtWidgets, QtWebEngineWidgets, Qt, Signal
+import bookserver
+import consolelog
+import requestpolicy
+import plugin
+
+DEFAULT_WORKERS = 4
+BOOK_TIMEOUT_SECS = 60
+VIEWPORT = (1024, 768)
+# errors logged by the first page's images and fonts still count
+SETTLE_MSECS = 1000
+CONSOLE_TOP = 5
+
+
+def prepare_environment():
+    # read when the QApplication and QtWebEngine start up
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    flags = os.environ.get('QTWEBENGINE_CHROMIUM_FLAGS', '').split()
+    for flag in ('--disable-gpu', '--disable-gpu-compositing'):
+        if flag not in flags:
+            flags.append(flag)
+    os.environ['QTWEBENGINE_CHROMIUM_FLAGS'] = ' '.join(flags)
+
+
+def read_book_list(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+
+
+def book_source(path):
+    if os.path.isdir(path):
+        return bookserver.DirectoryBookSource(path)
+    return bookserver.EpubArchiveSource(path)
+
+
+class BatchChecker(QtCore.QObject):
+
+    ''' Opens books in turn, at most workers at a time, and records how each one went '''
+
+    finished = Signal()
+
+    def __init__(self, books, profile, scheme_handler, workers=DEFAULT_WORKERS, timeout=BOOK_TIMEOUT_SECS,
+                 viewport=VIEWPORT, log=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.profile = profile
+        self.scheme_handler = scheme_handler
+        self.interceptor = getattr(profile, 'request_interceptor', None)
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.viewport = viewport
+        # where the console messages of the books go, all of them are counted either way
+        self.log = log
+        self.queue = list(enumerate(books))
+        self.queue.reverse()
+        self.results = [None] * len(books)
+        self.busy = {}
+
+    def start(self):
+        for i in range(min(self.workers, len(self.queue))):
+            self._next()
+        if not self.busy:
+            QtCore.QTimer.singleShot(0, self.finished.emit)
+
+    def _next(self):
+        if not self.queue:
+            if not self.busy:
+                # once the closed views have been deleted
+                QtCore.QTimer.singleShot(0, self.finished.emit)
+            return
+        index, path = self.queue.pop()
+        name = 'check{:05d}'.format(index)
+        job = {'index': index, 'name': name, 'result': {'book': path, 'ok': False, 'error': None, 'load_ms': None}}
+        try:
+            source = book_source(path)
+        except Exception as e:
+            job['result']['error'] = 'could not open: {}'.format(e)
+            self.results[index] = job['result']
+            self._next()
+            return
+        job['source'] = source
+        self.scheme_handler.mount(name, source)
+        console = consolelog.ConsoleLog(stream=self.log, level='ERROR', parent=self)
+        view = QtWebEngineWidgets.QWebEngineView()
+        page = plugin.WebPage(self.profile, view, console=console)
+        view.setPage(page)
+        # laid out and painted like a visible window but never shown on screen
+        view.setAttribute(Qt.WA_DontShowOnScreen, True)
+        view.resize(*self.viewport)
+        view.show()
+        job['view'] = view
+        job['console'] = console
+        page.readerEvent.connect(lambda event, payload, job=job: self._reader_event(job, event))
+        view.loadFinished.connect(lambda ok, job=job: self._loaded(job, ok))
+        watchdog = QtCore.QTimer(view)
+        watchdog.setSingleShot(True)
+        watchdog.timeout.connect(lambda job=job: self._finish(job, 'timed out'))
+        watchdog.start(self.timeout * 1000)
+        self.busy[name] = job
+        job['t0'] = time.perf_counter()
+        view.setUrl(self.scheme_handler.reader_url(bookserver.book_query(name)))
+
+    def _loaded(self, job, ok):
+        if not ok:
+            self._finish(job, 'the viewer did not load')
+
+    def _reader_event(self, job, event):
+        if event != 'first-render' or job['result']['load_ms'] is not None:
+            return
+        job['result']['load_ms'] = round((time.perf_counter() - job['t0']) * 1000, 1)
+        QtCore.QTimer.singleShot(SETTLE_MSECS, lambda job=job: self._finish(job))
+
+    def _finish(self, job, error=None):
+        if self.busy.pop(job['name'], None) is None:
+            return
+        result = job['result']
+        result['ok'] = error is None and result['load_ms'] is not None
+        result['error'] = error
+        console = job['console']
+        console.close()
+        errors = sorted((e for e in console.entries.values() if e['level'] == 'ERROR'),
+                        key=lambda e: e['count'], reverse=True)
+        result['js_errors'] = sum(e['count'] for e in errors)
+        result['console'] = [{k: e[k] for k in ('source', 'line', 'message', 'count')} for e in errors[:CONSOLE_TOP]]
+        result['blocked'] = (self.interceptor.take_blocked('/' + job['name'] + '/')
+                             if self.interceptor is not None else {})
+        self.results[job['index']] = result
+        view = job['view']
+        view.stop()
+        view.close()
+        close = getattr(job['source'], 'close', None)
+        if close is not None:
+            # a packed book's file and memory map, once no request can read from them
+            view.destroyed.connect(lambda obj=None, close=close: close())
+        view.deleteLater()
+        console.deleteLater()
+        self.scheme_handler.unmount(job['name'])
+        self._next()
+
+
+def summarize(results, elapsed, args):
+    return {
+        'qt': QtCore.qVersion(),
+        'workers': args.workers,
+        'viewport': list(args.viewport),
+        'elapsed_s': round(elapsed, 2),
+        'totals': {
+            'books': len(results),
+            'rendered': sum(1 for r in results if r['ok']),
+            'failed': sum(1 for r in results if not r['ok']),
+            'js_errors': sum(r.get('js_errors', 0) for r in results),
+            'blocked_requests': sum(sum(r.get('blocked', {}).values()) for r in results),
+        },
+        'books': results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Open many books headless in one process and report how they render')
+    parser.add_argument('books', nargs='*', help='unpacked book folders or .epub files')
+    parser.add_argument('--list', help='file with one book path per line')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS, help='books loading at the same time')
+    parser.add_argument('--timeout', type=int, default=BOOK_TIMEOUT_SECS, help='seconds to wait for a first page')
+    parser.add_argument('--viewport', default='{}x{}'.format(*VIEWPORT), help='view size, WIDTHxHEIGHT')
+    parser.add_argument('--allow-remote', action='store_true', help='let books load from remote hosts')
+    parser.add_argument('-v', '--verbose', action='store_true', help='show the console errors as they happen')
+    parser.add_argument('-o', '--output', help='write the json summary here instead of stdout')
+    args = parser.parse_args(argv)
+
+    books = [os.path.abspath(b) for b in args.books]
+    if args.list:
+        books.extend(os.path.abspath(b) for b in read_book_list(args.list))
+    if not books:
+        parser.error('no books to check')
+    args.viewport = tuple(int(v) for v in args.viewport.lower().split('x'))
+    if not bookserver.scheme_supported():
+        sys.exit('The batch check needs Qt 5.12 or later for its url scheme')
+
+    prepare_environment()
+    bookserver.register_reader_scheme()
+    app = QtWidgets.QApplication([sys.argv[0]])
+    pfolder = tempfile.mkdtemp(prefix='batchcheck-')
+    viewer_home = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer', 'cloud-reader-lite')
+    handler = bookserver.BookSchemeHandler(viewer_home, app)
+    policy = requestpolicy.RequestPolicy(remote='allow' if args.allow_remote else 'block')
+    # stdout is for the summary
+    with contextlib.redirect_stdout(sys.stderr):
+        profile = plugin.create_profile(pfolder, handler, request_policy=policy)
+    log = sys.stderr if args.verbose else open(os.devnull, 'w')
+    checker = BatchChecker(books, profile, handler, workers=args.workers, timeout=args.timeout,
+                           viewport=args.viewport, log=log)
+    checker.finished.connect(app.quit)
+    t0 = time.perf_counter()
+    QtCore.QTimer.singleShot(0, checker.start)
+    app.exec_()
+    report = summarize([r for r in checker.results if r is not None], time.perf_counter() - t0, args)
+
+    # the pages have to go before their profile
+    del checker, profile, handler
+    if log is not sys.stderr:
+        log.close()
+    shutil.rmtree(pfolder, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+    print('{rendered} of {books} books rendered, {js_errors} javascript errors, {blocked_requests} requests '
+          'blocked'.format(**report['totals']), 'in {:.1f}s'.format(report['elapsed_s']), file=sys.stderr)
+    return 1 if report['totals']['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Measure the cold import cost of plugin.py with the lazily resolving
+# plugin_utils against the baseline plugin_utils that imported every binding
+# up front, for both the PyQt5 (Sigil Qt5) and PySide6 (Sigil Qt6) branches.
+# The baseline copy is taken from the git revision given on the command
+# line, e.g. the last release before plugin_utils went lazy. Every sample runs in a fresh interpreter
+# and imports plugin.py itself, so whatever plugin.py and the modules it
+# imports at the top touch is what gets paid for.
+#
+#   python benchmarks/import_time.py BASELINE_REV [-n RUNS] [--json]
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BRANCHES = (('PyQt5', '5.15.2'), ('PySide6', '6.5.2'))
+
+CHILD = r'''
+import sys, time, json
+sys.path[:0] = %(path)r
+t0 = time.perf_counter()
+import plugin_utils
+t1 = time.perf_counter()
+import plugin
+t2 = time.perf_counter()
+lazy = getattr(plugin_utils, '_LAZY_EXPORTS', {})
+resolved = sorted(name for name in lazy if name in vars(plugin_utils))
+print(json.dumps({'utils': t1 - t0, 'plugin': t2 - t1, 'resolved': resolved}))
+'''
+
+
+def baseline_dir(rev):
+    ''' a temporary folder with the plugin_utils.py of rev in it, None if git can't give it '''
+    try:
+        out = subprocess.run(['git', 'show', rev + ':plugin_utils.py'], cwd=REPO_DIR,
+                             capture_output=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    folder = tempfile.mkdtemp(prefix='import-time-')
+    with open(os.path.join(folder, 'plugin_utils.py'), 'wb') as f:
+        f.write(out.stdout)
+    return folder
+
+
+def sample(qt_version, path):
+    env = dict(os.environ, SIGIL_QT_RUNTIME_VERSION=qt_version, QT_QPA_PLATFORM='offscreen')
+    out = subprocess.run([sys.executable, '-c', CHILD % {'path': path}],
+                         cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    if out.returncode != 0:
+        return None
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure(qt_version, runs, baseline):
+    samples = {'lazy': [], 'eager': []}
+    for i in range(runs):
+        # interleaved so that a noisy stretch hits both alike
+        for kind, path in (('lazy', [REPO_DIR]), ('eager', [baseline, REPO_DIR])):
+            s = sample(qt_version, path)
+            if s is None:
+                return None
+            samples[kind].append(s)
+    total = lambda kind: statistics.median(s['utils'] + s['plugin'] for s in samples[kind])
+    res = {'runs': runs, 'import_only': statistics.median(s['utils'] for s in samples['lazy']),
+           'lazy': total('lazy'), 'resolved_by_plugin': samples['lazy'][0]['resolved'], 'eager': total('eager')}
+    res['saving'] = res['eager'] - res['lazy']
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure plugin.py import time against the eager baseline')
+    parser.add_argument('baseline', help='git revision whose plugin_utils imported every binding up front')
+    parser.add_argument('-n', '--runs', type=int, default=7)
+    parser.add_argument('--json', action='store_true', help='print raw json results')
+    args = parser.parse_args(argv)
+    baseline = baseline_dir(args.baseline)
+    if baseline is None:
+        parser.error('could not get plugin_utils.py of {} from git'.format(args.baseline))
+    results = {}
+    try:
+        for binding, qt_version in BRANCHES:
+            results[binding] = measure(qt_version, args.runs, baseline)
+    finally:
+        if baseline:
+            shutil.rmtree(baseline, ignore_errors=True)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return 0
+    for binding, res in results.items():
+        if res is None:
+            print('{:8} not installed, skipped'.format(binding))
+            continue
+        print('{:8} import plugin: baseline {:7.1f} ms  lazy {:7.1f} ms  saving {:7.1f} ms  [median of {}]'.format(
+            binding, res['eager'] * 1000, res['lazy'] * 1000, res['saving'] * 1000, res['runs']))
+        print('{:8} resolved by plugin.py: {}'.format('', ', '.join(res['resolved_by_plugin']) or 'nothing'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Headless reader benchmark. Generates synthetic unpacked EPUBs over a size
+# matrix and opens each one in the plugin's own MainWindow under Qt's
+# offscreen platform with the GPU disabled. Every case runs in a fresh
+# process (and so a fresh renderer) and records
+#
+#   time_to_first_page  setUrl() until Readium's first PAGINATION_CHANGED
+#   chapters            time to open and paginate each further spine item
+#   page_turns          openPageNext() latency over the first chapters
+#   renderer_peak_rss   peak RSS of the QtWebEngine render process
+#
+#   python benchmarks/reader_bench.py [--quick] [-o results.json]
+#   python benchmarks/reader_bench.py --compare old.json new.json
+
+import os
+import sys
+import json
+import time
+import zlib
+import struct
+import random
+import shutil
+import argparse
+import tempfile
+import itertools
+import subprocess
+import statistics
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASE_TIMEOUT = 300
+
+# spine items, text KB per chapter, images per chapter, KB per image, layout
+FULL_MATRIX = {
+    'spine': (5, 50),
+    'chapter_kb': (10, 200),
+    'images': (0, 10),
+    'image_kb': (50,),
+    'layout': ('reflowable', 'pre-paginated'),
+}
+QUICK_MATRIX = {
+    'spine': (5,),
+    'chapter_kb': (20,),
+    'images': (0, 4),
+    'image_kb': (50,),
+    'layout': ('reflowable', 'pre-paginated'),
+}
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+         'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+         'ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum eu fugiat '
+         'nulla pariatur excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt').split()
+
+
+def case_name(case):
+    return 's{spine}-t{chapter_kb}k-i{images}x{image_kb}k-{layout}'.format(**case)
+
+
+def expand_matrix(matrix):
+    keys = sorted(matrix)
+    return [dict(zip(keys, values)) for values in itertools.product(*(matrix[k] for k in keys))]
+
+
+# ----------------------------------------------------------------------------
+# synthetic books
+
+def make_png(path, nbytes, seed):
+    # a noisy grayscale png roughly nbytes big (noise does not compress)
+    width = 256
+    height = max(1, nbytes // (width + 1))
+    noise = random.Random(seed).getrandbits(8 * width * height).to_bytes(width * height, 'little')
+    rows = b''.join(b'\x00' + noise[y * width:(y + 1) * width] for y in range(height))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(rows, 1)))
+        f.write(chunk(b'IEND', b''))
+
+
+def chapter_xhtml(index, case):
+    words = itertools.cycle(WORDS)
+    paras, size, target = [], 0, case['chapter_kb'] * 1024
+    while size < target:
+        p = '<p>' + ' '.join(next(words) for i in range(60)) + '.</p>'
+        paras.append(p)
+        size += len(p)
+    step = max(1, len(paras) // (case['images'] + 1))
+    for i in range(case['images']):
+        paras.insert((i + 1) * step + i, '<p><img src="images/c{:03d}-{:02d}.png" alt=""/></p>'.format(index, i))
+    head = ''
+    if case['layout'] == 'pre-paginated':
+        head = '<meta name="viewport" content="width=600, height=800"/>'
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+            '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">\n'
+            '<head><title>Chapter {0}</title>{1}</head>\n<body>\n<h1>Chapter {0}</h1>\n{2}\n</body>\n</html>\n'
+            ).format(index + 1, head, '\n'.join(paras))
+
+
+def make_book(dest, case):
+    oebps = os.path.join(dest, 'OEBPS')
+    os.makedirs(os.path.join(dest, 'META-INF'))
+    os.makedirs(os.path.join(oebps, 'images'))
+    with open(os.path.join(dest, 'mimetype'), 'w') as f:
+        f.write('application/epub+zip')
+    with open(os.path.join(dest, 'META-INF', 'container.xml'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0"?>\n<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+                '</rootfiles></container>\n')
+    manifest, spine, nav = [], [], []
+    for c in range(case['spine']):
+        href = 'c{:03d}.xhtml'.format(c)
+        with open(os.path.join(oebps, href), 'w', encoding='utf-8') as f:
+            f.write(chapter_xhtml(c, case))
+        manifest.append('<item id="c{0:03d}" href="{1}" media-type="application/xhtml+xml"/>'.format(c, href))
+        spine.append('<itemref idref="c{:03d}"/>'.format(c))
+        nav.append('<li><a href="{}">Chapter {}</a></li>'.format(href, c + 1))
+        for i in range(case['images']):
+            name = 'c{:03d}-{:02d}.png'.format(c, i)
+            make_png(os.path.join(oebps, 'images', name), case['image_kb'] * 1024, c * 100 + i)
+            manifest.append('<item id="img{0:03d}-{1:02d}" href="images/{2}" media-type="image/png"/>'.format(c, i, name))
+    with open(os.path.join(oebps, 'nav.xhtml'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+                '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops">'
+                '<head><title>Contents</title></head><body><nav epub:type="toc"><ol>{}</ol></nav></body></html>\n'
+                .format(''.join(nav)))
+    with open(os.path.join(oebps, 'content.opf'), 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                '<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="uid">\n'
+                '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+                '<dc:identifier id="uid">urn:bench:{0}</dc:identifier><dc:title>{0}</dc:title>'
+                '<dc:language>en</dc:language><meta property="dcterms:modified">2021-01-01T00:00:00Z</meta>'
+                '<meta property="rendition:layout">{1}</meta></metadata>\n'
+                '<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+                '{2}</manifest>\n<spine>{3}</spine>\n</package>\n'
+                .format(case_name(case), case['layout'], ''.join(manifest), ''.join(spine)))
+
+
+# ----------------------------------------------------------------------------
+# the measuring child process
+
+# Runs inside the viewer once the first page is up. Every step waits for the
+# PAGINATION_CHANGED it causes and reports back through SigilReader.emit().
+DRIVER = r'''
+(function (turns, stepTimeout) {
+    var reader = ReadiumSDK.reader, E = ReadiumSDK.Events;
+    var idrefs = reader.spine().items.map(function (item) { return item.idref; });
+    var result = {chapters: [], page_turns: [], timeouts: 0};
+
+    function step(action, done) {
+        var t0 = performance.now(), finished = false;
+        function finish(data) {
+            if (finished) { return; }
+            finished = true;
+            reader.off(E.PAGINATION_CHANGED, finish);
+            done(data ? performance.now() - t0 : null, data);
+        }
+        reader.once(E.PAGINATION_CHANGED, finish);
+        setTimeout(function () { if (!finished) { result.timeouts++; finish(null); } }, stepTimeout);
+        action();
+    }
+
+    function openChapter(i) {
+        if (i >= idrefs.length) { return turnPage(0); }
+        step(function () { reader.openSpineItemPage(idrefs[i], 0); }, function (ms, data) {
+            var pages = (data && data.paginationInfo) ? data.paginationInfo.openPages : [];
+            result.chapters.push({idref: idrefs[i], ms: ms, pages: pages.length ? pages[0].spineItemPageCount : null});
+            openChapter(i + 1);
+        });
+    }
+
+    function turnPage(n) {
+        if (n === 0) {
+            return step(function () { reader.openSpineItemPage(idrefs[0], 0); }, function () { turnPage(1); });
+        }
+        if (n > turns) { return report(); }
+        step(function () { reader.openPageNext(); }, function (ms) {
+            result.page_turns.push(ms);
+            turnPage(n + 1);
+        });
+    }
+
+    function report() {
+        if (window.performance && performance.memory) {
+            result.js_heap = performance.memory.usedJSHeapSize;
+        }
+        SigilReader.emit('bench-result', result);
+    }
+
+    openChapter(1);
+})(%(turns)d, %(step_timeout)d);
+'''
+
+
+def peak_rss(pid):
+    if not pid:
+        return None
+    if sys.platform.startswith('linux'):
+        try:
+            with open('/proc/{}/status'.format(pid), 'r') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            return None
+    try:
+        import psutil
+    except ImportError:
+        return None
+    try:
+        info = psutil.Process(pid).memory_info()
+        return getattr(info, 'peak_wset', info.rss)
+    except psutil.Error:
+        return None
+
+
+def run_child(args):
+    sys.path.insert(0, REPO_DIR)
+    from plugin_utils import QtCore, QtWidgets
+    import bookserver
+    import plugin
+
+    bookserver.register_reader_scheme()
+    app = QtWidgets.QApplication([sys.argv[0]])
+    pfolder = tempfile.mkdtemp(prefix='reader-bench-prefs-')
+    viewer_home = os.path.join(REPO_DIR, 'viewer', 'cloud-reader-lite')
+    handler = bookserver.BookSchemeHandler(viewer_home, app)
+    profile = plugin.create_profile(pfolder, handler)
+    handler.mount('bench', bookserver.DirectoryBookSource(args.child))
+    result = {}
+
+    def reader_event(name, payload):
+        if name == 'first-render' and 'time_to_first_page' not in result:
+            result['time_to_first_page'] = (time.perf_counter() - t0) * 1000
+            window.browser.page().runJavaScript(DRIVER % {'turns': args.turns, 'step_timeout': args.step_timeout})
+        elif name == 'bench-result':
+            result.update(json.loads(payload))
+            page = window.browser.page()
+            result['renderer_peak_rss'] = peak_rss(page.renderProcessPid() if hasattr(page, 'renderProcessPid') else None)
+            app.quit()
+
+    t0 = time.perf_counter()
+    window = plugin.MainWindow(bookserver.book_query('bench'), {}, scheme_handler=handler, profile=profile)
+    window.resize(args.width, args.height)
+    window.browser.page().readerEvent.connect(reader_event)
+    QtCore.QTimer.singleShot(CASE_TIMEOUT * 1000, app.quit)
+    app.exec_()
+
+    window.close()
+    del window, profile, handler
+    shutil.rmtree(pfolder, ignore_errors=True)
+    print('__bench__' + json.dumps(result))
+    return 0
+
+
+# ----------------------------------------------------------------------------
+# driver
+
+def summarize(raw):
+    chapters = [c['ms'] for c in raw.get('chapters', []) if c.get('ms') is not None]
+    turns = [t for t in raw.get('page_turns', []) if t is not None]
+    ans = {
+        'time_to_first_page_ms': raw.get('time_to_first_page'),
+        'chapter_ms_median': statistics.median(chapters) if chapters else None,
+        'chapter_ms_max': max(chapters) if chapters else None,
+        'page_turn_ms_median': statistics.median(turns) if turns else None,
+        'page_turn_ms_p95': sorted(turns)[int(0.95 * (len(turns) - 1))] if turns else None,
+        'renderer_peak_rss': raw.get('renderer_peak_rss'),
+        'timeouts': raw.get('timeouts'),
+    }
+    return ans
+
+
+def run_case(case, args, workdir):
+    bookdir = os.path.join(workdir, case_name(case))
+    make_book(bookdir, case)
+    env = dict(os.environ, QT_QPA_PLATFORM='offscreen')
+    flags = env.get('QTWEBENGINE_CHROMIUM_FLAGS', '')
+    env['QTWEBENGINE_CHROMIUM_FLAGS'] = (flags + ' --disable-gpu --disable-gpu-compositing').strip()
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', bookdir, '--turns', str(args.turns),
+           '--width', str(args.width), '--height', str(args.height), '--step-timeout', str(args.step_timeout)]
+    try:
+        out = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=CASE_TIMEOUT + 30)
+    except subprocess.TimeoutExpired:
+        return {'case': case, 'name': case_name(case), 'error': 'timed out'}
+    finally:
+        shutil.rmtree(bookdir, ignore_errors=True)
+    for line in reversed(out.stdout.splitlines()):
+        if line.startswith('__bench__'):
+            raw = json.loads(line[len('__bench__'):])
+            if 'time_to_first_page' not in raw:
+                return {'case': case, 'name': case_name(case), 'error': 'the reader never rendered a page'}
+            return {'case': case, 'name': case_name(case), 'summary': summarize(raw), 'raw': raw}
+    return {'case': case, 'name': case_name(case), 'error': (out.stderr.strip().splitlines() or ['failed'])[-1]}
+
+
+def git_commit():
+    try:
+        out = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True)
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(old_path, new_path):
+    with open(old_path, 'r', encoding='utf-8') as f:
+        old = {r['name']: r for r in json.load(f)['results']}
+    with open(new_path, 'r', encoding='utf-8') as f:
+        new = json.load(f)['results']
+    for r in new:
+        o = old.get(r['name'])
+        print(r['name'])
+        if o is None or 'summary' not in o or 'summary' not in r:
+            print('  (no comparable result)')
+            continue
+        for key, value in sorted(r['summary'].items()):
+            before = o['summary'].get(key)
+            if value is None or before is None:
+                continue
+            change = ' ({:+.1f}%)'.format((value - before) * 100.0 / before) if before else ''
+            print('  {:24} {:>14.1f} -> {:>14.1f}{}'.format(key, before, value, change))
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Headless time-to-first-page and pagination benchmark')
+    parser.add_argument('--quick', action='store_true', help='small matrix for a fast check')
+    parser.add_argument('--filter', default='', help='only run cases whose name contains this')
+    parser.add_argument('--turns', type=int, default=20, help='page turns to time (default: 20)')
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--step-timeout', type=int, default=15000, help='ms to wait for each pagination')
+    parser.add_argument('-o', '--output', help='write json results here instead of stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        return run_child(args)
+    if args.compare:
+        return compare(*args.compare)
+
+    cases = [c for c in expand_matrix(QUICK_MATRIX if args.quick else FULL_MATRIX) if args.filter in case_name(c)]
+    workdir = tempfile.mkdtemp(prefix='reader-bench-')
+    results = []
+    try:
+        for case in cases:
+            print('{} ...'.format(case_name(case)), file=sys.stderr)
+            r = run_case(case, args, workdir)
+            print('  {}'.format(r.get('error') or json.dumps(r['summary'])), file=sys.stderr)
+            results.append(r)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'platform': sys.platform,
+        'viewport': [args.width, args.height],
+        'turns': args.turns,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=1, sort_keys=True))
+    return 1 if any('error' in r for r in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+import os
+import time
+import shutil
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from lrustore import LRUStore, read_json, write_json_atomic
+from bookinfo import book_key, spine_documents
+from materialize import Materializer
+
+MANIFEST_NAME = 'manifest.json'
+BOOK_FOLDER = 'book'
+EPUB_MIMETYPE = b'application/epub+zip'
+DEFAULT_BUDGET = 2048 * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+DIGEST_WORKERS = max(1, min(8, os.cpu_count() or 2))
+
+
+def file_hash(path):
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def walk_files(root):
+    for dirpath, dirs, files in os.walk(root):
+        rel = os.path.relpath(dirpath, root)
+        for name in files:
+            relpath = name if rel == os.curdir else rel.replace(os.sep, '/') + '/' + name
+            yield relpath, os.path.join(dirpath, name)
+
+
+''' Remove epub_content/tmp* folders left behind by sessions that crashed or were killed.
+    Only folders older than max_age seconds are touched so a running session is left alone. '''
+def remove_stale_tempdirs(epub_home, max_age=24 * 60 * 60):
+    if not os.path.isdir(epub_home):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(epub_home):
+        p = os.path.join(epub_home, name)
+        if name.startswith('tmp') and os.path.isdir(p) and os.path.getmtime(p) < cutoff:
+            shutil.rmtree(p, ignore_errors=True)
+
+
+class BookDigests(object):
+
+    ''' Content hashes (file_hash) of the files of one book, worked out at
+        most once per launch and shared by everything that is keyed on file
+        contents. Sigil rewrites its temp folder on every launch, so a stat
+        shortcut against an earlier launch almost never holds. The hashes
+        come from this launch's book cache manifest or BookSync when there is
+        one, anything else is hashed on a pool of threads. '''
+
+    def __init__(self, bookroot, manifest=None, sync=None, workers=DIGEST_WORKERS):
+        self.bookroot = bookroot
+        self.sync = sync
+        self.workers = max(1, workers)
+        self._digests = {relpath: rec[2] for relpath, rec in (manifest or {}).items()}
+        self._lock = threading.Lock()
+
+    def get(self, bookpaths):
+        ''' {bookpath: hash} for those of bookpaths that could be read '''
+        bookpaths = list(bookpaths)
+        with self._lock:
+            todo = [p for p in bookpaths if p not in self._digests]
+        if todo and self.sync is not None:
+            found = self.sync.digests(todo)
+            with self._lock:
+                self._digests.update(found)
+            todo = [p for p in todo if p not in found]
+        if todo:
+            found = self._hash(todo)
+            with self._lock:
+                self._digests.update(found)
+        with self._lock:
+            return {p: self._digests[p] for p in bookpaths if p in self._digests}
+
+    def _hash(self, bookpaths):
+        def one(bookpath):
+            try:
+                return bookpath, file_hash(os.path.join(self.bookroot, *bookpath.split('/')))
+            except OSError:
+                return bookpath, None
+        if len(bookpaths) == 1:
+            results = [one(bookpaths[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(bookpaths)),
+                                    thread_name_prefix='book-digest') as pool:
+                results = list(pool.map(one, bookpaths))
+        return {bookpath: digest for bookpath, digest in results if digest is not None}
+
+
+class BookCache(object):
+
+    ''' Persistent per-book copies of unpacked epubs that survive between
+        reader sessions. Each book lives in <cachedir>/<book key>/book and a
+        manifest of size, mtime and content hash per file makes sure that only
+        files that actually changed are rewritten on the next sync. '''
+
+    def __init__(self, cachedir, budget=DEFAULT_BUDGET, materializer=None):
+        self.store = LRUStore(cachedir, budget)
+        self.materializer = materializer or Materializer()
+
+    def bookdir(self, key):
+        return os.path.join(self.store.path(key), BOOK_FOLDER)
+
+    def _open_entry(self, key):
+        bookdir = self.bookdir(key)
+        os.makedirs(bookdir, exist_ok=True)
+        old = read_json(os.path.join(self.store.path(key), MANIFEST_NAME), {})
+        # mark the entry as used before the sweep can see it
+        self.store.touch(key)
+        return bookdir, (old if isinstance(old, dict) else {})
+
+    @staticmethod
+    def check(relpath, src, bookdir, old):
+        ''' (relpath, src, dest, manifest record, whether dest needs writing) '''
+        st = os.stat(src)
+        dest = os.path.join(bookdir, *relpath.split('/'))
+        rec = old.get(relpath)
+        present = os.path.isfile(dest)
+        if present and rec and rec[0] == st.st_size and rec[1] == st.st_mtime_ns:
+            return relpath, src, dest, rec, False
+        digest = file_hash(src)
+        # Sigil rewrites its temp folder on every launch so most files
+        # only differ by mtime
+        changed = not (present and rec and rec[0] == st.st_size and rec[2] == digest)
+        return relpath, src, dest, [st.st_size, st.st_mtime_ns, digest], changed
+
+    def _finish_entry(self, key, bookdir, old, manifest, stats, failed=()):
+        ''' failed are files still in the book that could not be brought up
+            to date, their previous copy is kept '''
+        for relpath in old:
+            if relpath not in manifest and relpath not in failed:
+                try:
+                    os.remove(os.path.join(bookdir, *relpath.split('/')))
+                    stats['removed'] += 1
+                except OSError:
+                    pass
+
+        if 'mimetype' not in manifest:
+            with open(os.path.join(bookdir, 'mimetype'), 'wb') as f:
+                f.write(EPUB_MIMETYPE)
+
+        write_json_atomic(os.path.join(self.store.path(key), MANIFEST_NAME), manifest)
+        self.store.touch(key, size=stats['bytes'])
+
+    def sync(self, srcdir, key=None):
+        ''' Bring the cached copy of the book in srcdir up to date.
+            Returns (key, bookdir, stats) '''
+        if key is None:
+            key = book_key(srcdir)
+        bookdir, old = self._open_entry(key)
+
+        def check(item):
+            try:
+                return self.check(item[0], item[1], bookdir, old)
+            except OSError:
+                # removed or unreadable since the walk saw it
+                return item[0], None, None, None, None
+
+        manifest = {}
+        failed = set()
+        pairs = []
+        stats = {'files': 0, 'copied': 0, 'unchanged': 0, 'removed': 0, 'bytes': 0, 'copied_bytes': 0,
+                 'errors': 0}
+        with ThreadPoolExecutor(max_workers=self.materializer.workers) as pool:
+            for relpath, src, dest, rec, changed in pool.map(check, walk_files(srcdir)):
+                if rec is None:
+                    failed.add(relpath)
+                    continue
+                manifest[relpath] = rec
+                stats['files'] += 1
+                stats['bytes'] += rec[0]
+                if changed:
+                    pairs.append((src, dest))
+                else:
+                    stats['unchanged'] += 1
+
+        report = self.materializer.materialize(pairs)
+        for src, err in report.errors:
+            # leave it out of the manifest so the next sync tries again
+            relpath = os.path.relpath(src, srcdir).replace(os.sep, '/')
+            manifest.pop(relpath, None)
+            failed.add(relpath)
+        stats['copied'] = report.files
+        stats['copied_bytes'] = report.bytes
+        stats['errors'] = len(failed)
+        stats['materialize'] = report
+
+        self._finish_entry(key, bookdir, old, manifest, stats, failed)
+        return key, bookdir, stats
+
+    def start_sync(self, srcdir, first=(), key=None):
+        ''' Like sync() but only brings the files in first (and META-INF) up to
+            date before returning, the rest follows on background threads once
+            start() is called on the returned BookSync '''
+        if key is None:
+            key = book_key(srcdir)
+        return BookSync(self, srcdir, key, first)
+
+    def manifest(self, key):
+        ''' The manifest the last sync of the book wrote '''
+        manifest = read_json(os.path.join(self.store.path(key), MANIFEST_NAME), {})
+        return manifest if isinstance(manifest, dict) else {}
+
+    def sweep(self, keep=()):
+        return self.store.sweep(keep)
+
+
+class BookSync(object):
+
+    ''' A book cache sync that finishes in the background. Files are checked
+        and written out in reading order by a few worker threads, want() moves
+        a file to the front of the queue. Listeners are called with the
+        relpath of every file as it becomes available, on a worker thread. '''
+
+    def __init__(self, cache, srcdir, key, first=(), workers=4):
+        self.cache = cache
+        self.key = key
+        self.bookdir, self._old = cache._open_entry(key)
+        self.workers = workers
+        self.manifest = {}
+        self.failed = set()
+        self.stats = {'files': 0, 'copied': 0, 'unchanged': 0, 'removed': 0, 'bytes': 0, 'copied_bytes': 0,
+                      'errors': 0, 'first': 0}
+        self.sources = dict(walk_files(srcdir))
+        self._lock = threading.Lock()
+        # notified whenever a queued file has been dealt with
+        self._synced = threading.Condition(self._lock)
+        self._listeners = []
+        self._threads = []
+        self._running = 0
+        self.done = threading.Event()
+        first = [p for p in first if p in self.sources]
+        first += [p for p in self.sources if p.startswith('META-INF/') and p not in first]
+        spine = [p for idref, p in spine_documents(srcdir) if p in self.sources]
+        ordered = first + spine + sorted(self.sources)
+        seen = set(first)
+        self._queue = deque(p for p in ordered[len(first):] if not (p in seen or seen.add(p)))
+        self._pending = set(self._queue)
+        for relpath in first:
+            self._sync_file(relpath)
+        self.stats['first'] = len(first)
+
+    def add_listener(self, fn):
+        self._listeners.append(fn)
+
+    def known(self, relpath):
+        return relpath in self.sources
+
+    def pending(self, relpath):
+        with self._lock:
+            return relpath in self._pending
+
+    def want(self, relpath):
+        ''' Move relpath to the front of the queue '''
+        with self._lock:
+            if relpath in self._pending:
+                self._queue.remove(relpath)
+                self._queue.appendleft(relpath)
+
+    def digests(self, relpaths):
+        ''' {relpath: content hash} of relpaths as this sync hashes them,
+            waits for the ones still queued. Only call this once start()
+            has been or is about to be called. '''
+        relpaths = [p for p in relpaths if p in self.sources]
+        with self._synced:
+            for relpath in relpaths:
+                while relpath in self._pending:
+                    self._synced.wait()
+            return {p: self.manifest[p][2] for p in relpaths if p in self.manifest}
+
+    def _sync_file(self, relpath):
+        try:
+            relpath, src, dest, rec, changed = self.cache.check(relpath, self.sources[relpath], self.bookdir, self._old)
+            if changed:
+                self.cache.materializer.place(src, dest)
+        except OSError:
+            # left out of the manifest so the next sync tries again
+            with self._lock:
+                self.stats['errors'] += 1
+                self.failed.add(relpath)
+            return
+        with self._lock:
+            self.manifest[relpath] = rec
+            self.stats['files'] += 1
+            self.stats['bytes'] += rec[0]
+            if changed:
+                self.stats['copied'] += 1
+                self.stats['copied_bytes'] += rec[0]
+            else:
+                self.stats['unchanged'] += 1
+
+    def _work(self):
+        try:
+            while True:
+                with self._lock:
+                    if not self._queue:
+                        break
+                    relpath = self._queue.popleft()
+                try:
+                    self._sync_file(relpath)
+                except Exception as e:
+                    # _sync_file only expects OSErrors, the old copy is kept either way
+                    print('Book cache: cannot sync {}: {}'.format(relpath, e))
+                    with self._lock:
+                        self.stats['errors'] += 1
+                        self.failed.add(relpath)
+                finally:
+                    # whatever happened, nobody may be left waiting for it
+                    with self._synced:
+                        self._pending.discard(relpath)
+                        self._synced.notify_all()
+                for fn in self._listeners:
+                    fn(relpath)
+        finally:
+            with self._synced:
+                self._running -= 1
+                last = self._running == 0
+                if last and self._queue:
+                    # every worker died, what they never got to is tried again next time
+                    self.failed.update(self._queue)
+                    self._pending.difference_update(self._queue)
+                    self._queue.clear()
+                    self._synced.notify_all()
+            if last:
+                try:
+                    self.cache._finish_entry(self.key, self.bookdir, self._old, self.manifest, self.stats,
+                                             self.failed)
+                finally:
+                    self.done.set()
+
+    def start(self):
+        if not self._queue:
+            self.cache._finish_entry(self.key, self.bookdir, self._old, self.manifest, self.stats, self.failed)
+            self.done.set()
+            return
+        self._running = self.workers
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, name='book-sync-{}'.format(i), daemon=True)
+            self._threads.append(t)
+            t.start()
+
+    def join(self, timeout=None):
+        return self.done.wait(timeout)
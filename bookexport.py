@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Proof PDFs and page images of a book without anyone paging through it.
+#
+# The spine is split into contiguous ranges of about the same size and every
+# range is exported by a worker process of its own under Qt's offscreen
+# platform: each spine document is printed with printToPdf, and the viewer
+# pages through it grabbing an image of every page. The parts are stitched
+# in spine order at the end, the PDFs into one file when pypdf is installed
+# and otherwise left in order in OUTDIR/pdf-parts.
+#
+#   python bookexport.py BOOK OUTDIR [--no-pdf] [--no-png] [-j 4]
+#
+# BOOK is an unpacked book folder or a .epub file.
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import contextlib
+import subprocess
+
+from plugin_utils import QtCore, QtGui, QtWidgets, Qt, Signal, QWebEnginePage
+from bookinfo import spine_documents
+import bookserver
+import consolelog
+import requestpolicy
+import plugin
+from batchcheck import prepare_environment
+
+DEFAULT_WORKERS = max(1, min(4, os.cpu_count() or 2))
+VIEWPORT = (600, 800)
+PAGE_SIZES = ('A4', 'A5', 'Letter')
+PDF_MARGIN_MM = 12
+LOAD_TIMEOUT_MSECS = 60000
+STEP_TIMEOUT_MSECS = 15000
+# time for fonts and images to settle before a page is grabbed
+SETTLE_MSECS = 150
+WORKER_TIMEOUT_SECS = 3600
+PART_NAME = 'part.json'
+BOOK_NAME = 'export'
+
+# Runs inside the viewer. Every call reports the page it ends up on through
+# SigilReader.emit() once Readium has paginated, tagged with the step it
+# was asked for so that python can drop answers that come in too late.
+DRIVER = r'''
+window.__sigilExport = window.__sigilExport || (function () {
+    var reader = ReadiumSDK.reader, E = ReadiumSDK.Events;
+
+    function shown(step, info) {
+        var pages = (info && info.openPages) ? info.openPages : [];
+        var last = pages.length ? pages[pages.length - 1] : null;
+        SigilReader.emit('export-page', last ? {step: step, idref: last.idref, index: last.spineItemPageIndex,
+                                                count: last.spineItemPageCount} : {step: step});
+    }
+
+    function go(step, action) {
+        function done(data) {
+            reader.off(E.PAGINATION_CHANGED, done);
+            shown(step, data ? data.paginationInfo : null);
+        }
+        reader.on(E.PAGINATION_CHANGED, done);
+        action();
+    }
+
+    return {
+        open: function (step, idref) { go(step, function () { reader.openSpineItemPage(idref, 0); }); },
+        next: function (step) { go(step, function () { reader.openPageNext(); }); },
+        // where the reader is, for when opening the page on screen changed nothing
+        state: function (step) { shown(step, reader.getPaginationInfo()); }
+    };
+})();
+'''
+
+
+''' Contiguous [start, end) ranges of sizes (one per spine item) adding up
+    to about the same each, at most parts of them '''
+def split_ranges(sizes, parts):
+    total = sum(sizes)
+    ranges = []
+    start = 0
+    done = 0
+    for i, size in enumerate(sizes):
+        done += size
+        if (len(ranges) < parts - 1 and i + 1 < len(sizes) and
+                done * parts >= total * (len(ranges) + 1)):
+            ranges.append((start, i + 1))
+            start = i + 1
+    if start < len(sizes):
+        ranges.append((start, len(sizes)))
+    return ranges
+
+
+def page_layout(name):
+    size = QtGui.QPageSize(getattr(QtGui.QPageSize.PageSizeId, name))
+    margins = QtCore.QMarginsF(PDF_MARGIN_MM, PDF_MARGIN_MM, PDF_MARGIN_MM, PDF_MARGIN_MM)
+    return QtGui.QPageLayout(size, QtGui.QPageLayout.Orientation.Portrait, margins,
+                             QtGui.QPageLayout.Unit.Millimeter)
+
+
+class RangeExporter(QtCore.QObject):
+
+    ''' Exports the spine items of one range of a book mounted as BOOK_NAME '''
+
+    finished = Signal()
+
+    def __init__(self, items, outdir, scheme_handler, profile, pdf=True, png=True, viewport=VIEWPORT,
+                 layout=None, console=None, parent=None):
+        ''' items is a list of (spine index, idref, bookpath) '''
+        QtCore.QObject.__init__(self, parent)
+        self.items = items
+        self.outdir = outdir
+        self.scheme_handler = scheme_handler
+        self.profile = profile
+        self.pdf = pdf
+        self.png = png
+        self.viewport = viewport
+        self.layout = layout or page_layout(PAGE_SIZES[0])
+        self.console = console
+        self.report = {'pdf': [], 'png': [], 'errors': []}
+        self.queue = []
+        self.current = None
+        self.stage = None
+        self.step = 0
+        self.retried = False
+        self.last_index = -1
+        self.pdf_page = None
+        self.pdf_path = None
+        self.view = None
+        self.watchdog = QtCore.QTimer(self)
+        self.watchdog.setSingleShot(True)
+        self.watchdog.timeout.connect(self._timed_out)
+
+    def start(self):
+        if self.pdf:
+            self._start_pdf()
+        elif self.png:
+            self._start_png()
+        else:
+            self._done()
+
+    def book_url(self, bookpath):
+        url = self.scheme_handler.reader_url()
+        url.setPath('/{}/{}/{}'.format(bookserver.BOOK_PREFIX, BOOK_NAME, bookpath))
+        return url
+
+    def _error(self, message):
+        index, idref, bookpath = self.current
+        self.report['errors'].append({'index': index, 'idref': idref, 'stage': self.stage, 'error': message})
+        print('{} ({}): {}'.format(idref, self.stage, message), file=sys.stderr)
+
+    def _timed_out(self):
+        if self.current is None:
+            return
+        if self.stage == 'pdf':
+            self._error('timed out')
+            # the aborted load can still report loadFinished(False) and that
+            # signal doesn't say which load it was for, so the rest is
+            # printed from a fresh page
+            self.pdf_page.triggerAction(QWebEnginePage.WebAction.Stop)
+            if self.queue:
+                self.pdf_page.deleteLater()
+                self.pdf_page = self._new_pdf_page()
+            self._next_pdf()
+        elif self.stage == 'load':
+            self._error('the viewer did not render a first page')
+            self._done()
+        elif not self.retried:
+            # reopening the page that is already on screen may not paginate at all
+            self.retried = True
+            self._run('state')
+        else:
+            self._error('timed out')
+            self._next_item()
+
+    # ------------------------------------------------------------------------
+    # pdf, one spine document at a time as Chromium prints it
+
+    def _start_pdf(self):
+        self.stage = 'pdf'
+        self.pdf_page = self._new_pdf_page()
+        self.queue = list(reversed(self.items))
+        self._next_pdf()
+
+    def _new_pdf_page(self):
+        page = plugin.WebPage(self.profile, self, console=self.console)
+        # the page is the token of the loads made in it, signals of a page
+        # that has been given up on are dropped
+        page.loadFinished.connect(lambda ok, page=page: self._pdf_loaded(page, ok))
+        page.pdfPrintingFinished.connect(lambda path, ok, page=page: self._pdf_printed(page, path, ok))
+        return page
+
+    def _next_pdf(self):
+        self.current = None
+        if not self.queue:
+            self.pdf_page.deleteLater()
+            self.pdf_page = None
+            if self.png:
+                self._start_png()
+            else:
+                self._done()
+            return
+        self.current = self.queue.pop()
+        self.watchdog.start(LOAD_TIMEOUT_MSECS)
+        self.pdf_page.setUrl(self.book_url(self.current[2]))
+
+    def _pdf_loaded(self, page, ok):
+        if self.current is None or page is not self.pdf_page:
+            return
+        if not ok:
+            self.watchdog.stop()
+            self._error('load failed')
+            self._next_pdf()
+            return
+        self.pdf_path = os.path.join(self.outdir, '{:05d}.pdf'.format(self.current[0]))
+        self.pdf_page.printToPdf(self.pdf_path, self.layout)
+
+    def _pdf_printed(self, page, path, ok):
+        # a print that timed out may still finish later
+        if self.current is None or page is not self.pdf_page or path != self.pdf_path:
+            return
+        self.watchdog.stop()
+        if ok:
+            self.report['pdf'].append([self.current[0], path])
+        else:
+            self._error('printing failed')
+        self._next_pdf()
+
+    # ------------------------------------------------------------------------
+    # page images, paged through in the viewer
+
+    def _start_png(self):
+        self.stage = 'load'
+        self.view = plugin.WebView(scheme_handler=self.scheme_handler, profile=self.profile, console=self.console)
+        # laid out and painted like a visible window but never shown on screen
+        self.view.setAttribute(Qt.WA_DontShowOnScreen, True)
+        self.view.resize(*self.viewport)
+        self.view.show()
+        self.view.page().readerEvent.connect(self._reader_event)
+        self.queue = list(reversed(self.items))
+        self.current = self.queue[-1] if self.queue else None
+        self.watchdog.start(LOAD_TIMEOUT_MSECS)
+        self.view.setUrl(self.scheme_handler.reader_url(bookserver.book_query(BOOK_NAME)))
+
+    def _reader_event(self, name, payload):
+        if name == 'first-render' and self.stage == 'load':
+            self.watchdog.stop()
+            self.stage = 'png'
+            self.view.page().runJavaScript(DRIVER)
+            self._next_item()
+        elif name == 'export-page' and self.stage == 'png':
+            self._page_shown(json.loads(payload))
+
+    def _run(self, action, *args):
+        self.step += 1
+        self.watchdog.start(STEP_TIMEOUT_MSECS)
+        self.view.page().runJavaScript('window.__sigilExport.{}({})'.format(
+            action, ', '.join(json.dumps(a) for a in (self.step,) + args)))
+
+    def _next_item(self):
+        if not self.queue:
+            self.current = None
+            self._done()
+            return
+        self.current = self.queue.pop()
+        self.retried = False
+        self.last_index = -1
+        self._run('open', self.current[1])
+
+    def _page_shown(self, info):
+        if info.get('step') != self.step or self.current is None:
+            return
+        self.watchdog.stop()
+        if info.get('idref') != self.current[1]:
+            self._error('the viewer did not open it')
+            self._next_item()
+            return
+        if info.get('index', -1) <= self.last_index:
+            self._error('the viewer did not turn the page after {}'.format(self.last_index))
+            self._next_item()
+            return
+        step = self.step
+        QtCore.QTimer.singleShot(SETTLE_MSECS, lambda: self._capture(step, info))
+
+    def _capture(self, step, info):
+        if step != self.step:
+            return
+        index = self.current[0]
+        path = os.path.join(self.outdir, '{:05d}-{:05d}.png'.format(index, info['index']))
+        if self.view.grab().toImage().save(path, 'PNG'):
+            self.report['png'].append([index, info['index'], path])
+        else:
+            self._error('could not save page {}'.format(info['index']))
+        self.last_index = info['index']
+        if info['index'] + 1 < info['count']:
+            self.retried = False
+            self._run('next')
+        else:
+            self._next_item()
+
+    def _done(self):
+        self.watchdog.stop()
+        self.stage = None
+        if self.view is not None:
+            self.view.close()
+        self.finished.emit()
+
+
+def run_worker(args):
+    start, _, end = args.range.partition(':')
+    spine = spine_documents(args.book)
+    items = [(i, idref, bookpath) for i, (idref, bookpath) in enumerate(spine)][int(start):int(end)]
+
+    bookserver.register_reader_scheme()
+    app = QtWidgets.QApplication([sys.argv[0]])
+    pfolder = tempfile.mkdtemp(prefix='bookexport-')
+    viewer_home = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'viewer', 'cloud-reader-lite')
+    handler = bookserver.BookSchemeHandler(viewer_home, app)
+    with contextlib.redirect_stdout(sys.stderr):
+        profile = plugin.create_profile(pfolder, handler, request_policy=requestpolicy.RequestPolicy())
+    handler.mount(BOOK_NAME, bookserver.DirectoryBookSource(args.book))
+    console = consolelog.ConsoleLog(parent=app)
+    exporter = RangeExporter(items, args.worker, handler, profile, pdf=args.pdf, png=args.png,
+                             viewport=args.viewport, layout=page_layout(args.page_size), console=console)
+    exporter.finished.connect(app.quit)
+    QtCore.QTimer.singleShot(0, exporter.start)
+    app.exec_()
+    console.close()
+    report = exporter.report
+
+    # the pages have to go before their profile
+    del exporter, profile, handler
+    shutil.rmtree(pfolder, ignore_errors=True)
+    with open(os.path.join(args.worker, PART_NAME), 'w', encoding='utf-8') as f:
+        json.dump(report, f)
+    return 0
+
+
+# ----------------------------------------------------------------------------
+# driver
+
+''' Join the pdfs in order into path, returns False if pypdf is not there '''
+def stitch_pdf(parts, path):
+    try:
+        from pypdf import PdfWriter
+    except ImportError:
+        return False
+    writer = PdfWriter()
+    for part in parts:
+        writer.append(part)
+    with open(path, 'wb') as f:
+        writer.write(f)
+    return True
+
+
+def run_workers(bookroot, ranges, workdir, args):
+    procs = []
+    for n, (start, end) in enumerate(ranges):
+        partdir = os.path.join(workdir, '{:03d}'.format(n))
+        os.makedirs(partdir)
+        cmd = [sys.executable, os.path.abspath(__file__), bookroot, args.outdir, '--worker', partdir,
+               '--range', '{}:{}'.format(start, end), '--viewport', '{}x{}'.format(*args.viewport),
+               '--page-size', args.page_size]
+        if not args.pdf:
+            cmd.append('--no-pdf')
+        if not args.png:
+            cmd.append('--no-png')
+        procs.append((partdir, subprocess.Popen(cmd, stdout=subprocess.DEVNULL)))
+    parts = []
+    deadline = time.monotonic() + WORKER_TIMEOUT_SECS
+    for partdir, proc in procs:
+        try:
+            proc.wait(max(1, deadline - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+        try:
+            with open(os.path.join(partdir, PART_NAME), 'r', encoding='utf-8') as f:
+                parts.append(json.load(f))
+        except (OSError, ValueError):
+            parts.append({'pdf': [], 'png': [], 'errors': [{'stage': 'worker', 'error': 'worker {} failed ({})'.format(
+                os.path.basename(partdir), proc.returncode)}]})
+    return parts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export proof PDFs and page images of a book')
+    parser.add_argument('book', help='unpacked book folder or .epub file')
+    parser.add_argument('outdir', help='folder for the book pdf, pages/ and export.json')
+    parser.add_argument('-j', '--workers', type=int, default=DEFAULT_WORKERS, help='worker processes')
+    parser.add_argument('--no-pdf', dest='pdf', action='store_false', help='no proof pdf')
+    parser.add_argument('--no-png', dest='png', action='store_false', help='no page images')
+    parser.add_argument('--viewport', default='{}x{}'.format(*VIEWPORT), help='page image size, WIDTHxHEIGHT')
+    parser.add_argument('--page-size', default=PAGE_SIZES[0], choices=PAGE_SIZES, help='pdf page size')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--range', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    args.viewport = tuple(int(v) for v in args.viewport.lower().split('x'))
+
+    if args.worker:
+        return run_worker(args)
+    if not bookserver.scheme_supported():
+        sys.exit('The export needs Qt 5.12 or later for its url scheme')
+
+    t0 = time.perf_counter()
+    outdir = os.path.abspath(args.outdir)
+    os.makedirs(outdir, exist_ok=True)
+    # next to the results so that they can be moved rather than copied
+    workdir = tempfile.mkdtemp(prefix='.export-', dir=outdir)
+    bookroot = os.path.abspath(args.book)
+    try:
+        if not os.path.isdir(bookroot):
+            with zipfile.ZipFile(bookroot) as zf:
+                zf.extractall(os.path.join(workdir, 'book'))
+            bookroot = os.path.join(workdir, 'book')
+        spine = spine_documents(bookroot)
+        if not spine:
+            sys.exit('No spine documents found in ' + args.book)
+        sizes = []
+        for idref, bookpath in spine:
+            try:
+                sizes.append(max(1, os.path.getsize(os.path.join(bookroot, *bookpath.split('/')))))
+            except OSError:
+                sizes.append(1)
+        ranges = split_ranges(sizes, max(1, args.workers))
+
+        prepare_environment()
+        parts = run_workers(bookroot, ranges, workdir, args)
+
+        pdfs = sorted(p for part in parts for p in part['pdf'])
+        pngs = sorted(p for part in parts for p in part['png'])
+        errors = [e for part in parts for e in part['errors']]
+        report = {'book': os.path.abspath(args.book), 'workers': len(ranges), 'ranges': ranges,
+                  'spine_items': len(spine), 'pages': len(pngs), 'pdf': None, 'pdf_parts': [], 'errors': errors}
+
+        if pngs:
+            pagedir = os.path.join(outdir, 'pages')
+            shutil.rmtree(pagedir, ignore_errors=True)
+            os.makedirs(pagedir)
+            for n, (index, page, path) in enumerate(pngs):
+                os.replace(path, os.path.join(pagedir, 'page-{:05d}.png'.format(n + 1)))
+        if pdfs:
+            name = os.path.splitext(os.path.basename(os.path.abspath(args.book)))[0]
+            pdfpath = os.path.join(outdir, name + '.pdf')
+            if stitch_pdf([path for index, path in pdfs], pdfpath):
+                report['pdf'] = pdfpath
+            else:
+                print('pypdf is not installed, the pdf is left in parts in pdf-parts', file=sys.stderr)
+                partdir = os.path.join(outdir, 'pdf-parts')
+                shutil.rmtree(partdir, ignore_errors=True)
+                os.makedirs(partdir)
+                for n, (index, path) in enumerate(pdfs):
+                    dest = os.path.join(partdir, '{:05d}-{}.pdf'.format(n + 1, spine[index][0]))
+                    os.replace(path, dest)
+                    report['pdf_parts'].append(dest)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report['elapsed_s'] = round(time.perf_counter() - t0, 2)
+    with open(os.path.join(outdir, 'export.json'), 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    print('{} pages, {} of {} spine items printed, {} errors in {:.1f}s'.format(
+        report['pages'], len(pdfs), len(spine), len(errors), report['elapsed_s']), file=sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+import os
+import re
+import hashlib
+import posixpath
+from urllib.parse import unquote
+from xml.etree import ElementTree
+
+CONTAINER_NS = 'urn:oasis:names:tc:opendocument:xmlns:container'
+OPF_NS = 'http://www.idpf.org/2007/opf'
+DC_NS = 'http://purl.org/dc/elements/1.1/'
+
+_reference_pattern = re.compile(r'''(?:href|src)\s*=\s*["']([^"'#?]+)''', re.I)
+_css_reference_pattern = re.compile(r'''(?:@import\s+|url\(\s*)["']?([^"')#?\s]+)''', re.I)
+
+
+''' Return the book path of the OPF from META-INF/container.xml '''
+def find_opf_bookpath(bookroot):
+    cpath = os.path.join(bookroot, 'META-INF', 'container.xml')
+    try:
+        tree = ElementTree.parse(cpath)
+    except (OSError, ElementTree.ParseError):
+        return None
+    for rootfile in tree.iter('{%s}rootfile' % CONTAINER_NS):
+        if rootfile.get('media-type', 'application/oebps-package+xml') == 'application/oebps-package+xml':
+            return rootfile.get('full-path')
+    return None
+
+
+''' Return the unique identifier of the book (falling back to its first dc:identifier) '''
+def book_identifier(opf_path):
+    uid_ref = None
+    identifiers = {}
+    first_id = None
+    try:
+        for event, elem in ElementTree.iterparse(opf_path, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == '{%s}package' % OPF_NS:
+                    uid_ref = elem.get('unique-identifier')
+                continue
+            if elem.tag == '{%s}identifier' % DC_NS and elem.text and elem.text.strip():
+                value = elem.text.strip()
+                identifiers[elem.get('id')] = value
+                if first_id is None:
+                    first_id = value
+            elif elem.tag == '{%s}metadata' % OPF_NS:
+                # nothing of interest past the metadata
+                break
+    except (OSError, ElementTree.ParseError):
+        return None
+    return identifiers.get(uid_ref) or first_id
+
+
+''' The book's first dc:title, None if it has none '''
+def book_title(bookroot):
+    opfbookpath = find_opf_bookpath(bookroot)
+    if not opfbookpath:
+        return None
+    try:
+        for event, elem in ElementTree.iterparse(os.path.join(bookroot, *opfbookpath.split('/'))):
+            if elem.tag == '{%s}title' % DC_NS and elem.text and elem.text.strip():
+                return elem.text.strip()
+            if elem.tag == '{%s}metadata' % OPF_NS:
+                break
+    except (OSError, ElementTree.ParseError):
+        pass
+    return None
+
+
+''' A short stable key for a book, suitable for use as a folder name. A book
+    without an identifier is told apart by origin, the file it was opened
+    from (the book folder when not given), rather than all such books
+    sharing one key. '''
+def book_key(bookroot, origin=None):
+    ident = None
+    opfbookpath = find_opf_bookpath(bookroot)
+    if opfbookpath:
+        ident = book_identifier(os.path.join(bookroot, *opfbookpath.split('/')))
+    if not ident:
+        ident = 'unidentified:' + os.path.abspath(origin or bookroot)
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()[:20]
+
+
+''' Key of one copy of a book: two editions that share an identifier but
+    were opened from different files get different keys '''
+def edition_key(bookroot, origin=None):
+    ident = '{}:{}'.format(book_key(bookroot, origin), os.path.abspath(origin or bookroot))
+    return hashlib.sha1(ident.encode('utf-8')).hexdigest()[:20]
+
+
+''' Return the spine as a list of (idref, book path of the document) '''
+def spine_documents(bookroot):
+    opfbookpath = find_opf_bookpath(bookroot)
+    if not opfbookpath:
+        return []
+    opfdir = posixpath.dirname(opfbookpath)
+    hrefs = {}
+    spine = []
+    try:
+        for event, elem in ElementTree.iterparse(os.path.join(bookroot, *opfbookpath.split('/'))):
+            if elem.tag == '{%s}item' % OPF_NS:
+                href = unquote(elem.get('href', '')).partition('#')[0]
+                hrefs[elem.get('id')] = posixpath.normpath(posixpath.join(opfdir, href))
+            elif elem.tag == '{%s}itemref' % OPF_NS:
+                spine.append(elem.get('idref'))
+            elem.clear()
+    except (OSError, ElementTree.ParseError):
+        return []
+    return [(idref, hrefs[idref]) for idref in spine if idref in hrefs]
+
+
+def _referenced(bookroot, bookpath, pattern):
+    try:
+        with open(os.path.join(bookroot, *bookpath.split('/')), 'rb') as f:
+            text = f.read().decode('utf-8', errors='replace')
+    except OSError:
+        return []
+    base = posixpath.dirname(bookpath)
+    return [posixpath.normpath(posixpath.join(base, unquote(ref)))
+            for ref in pattern.findall(text) if ':' not in ref and not ref.startswith('/')]
+
+
+''' Book paths Readium needs before it can show the first page: the container,
+    the OPF, the nav document and ncx, the first spine item and the
+    stylesheets, images and fonts it uses '''
+def opening_files(bookroot):
+    files = ['mimetype', 'META-INF/container.xml']
+    opfbookpath = find_opf_bookpath(bookroot)
+    if not opfbookpath:
+        return files
+    files.append(opfbookpath)
+    opfdir = posixpath.dirname(opfbookpath)
+    hrefs = {}
+    nav = []
+    toc = first = None
+    try:
+        for event, elem in ElementTree.iterparse(os.path.join(bookroot, *opfbookpath.split('/'))):
+            if elem.tag == '{%s}item' % OPF_NS:
+                href = posixpath.normpath(posixpath.join(opfdir, unquote(elem.get('href', '')).partition('#')[0]))
+                hrefs[elem.get('id')] = href
+                if 'nav' in elem.get('properties', '').split():
+                    nav.append(href)
+            elif elem.tag == '{%s}spine' % OPF_NS:
+                toc = elem.get('toc')
+            elif elem.tag == '{%s}itemref' % OPF_NS and first is None and elem.get('linear', 'yes') != 'no':
+                first = elem.get('idref')
+            elem.clear()
+    except (OSError, ElementTree.ParseError):
+        return files
+    files.extend(nav)
+    if toc in hrefs:
+        files.append(hrefs[toc])
+    if first in hrefs:
+        files.append(hrefs[first])
+        for dep in _referenced(bookroot, hrefs[first], _reference_pattern):
+            files.append(dep)
+            if dep.lower().endswith('.css'):
+                files.extend(_referenced(bookroot, dep, _css_reference_pattern))
+    seen = set()
+    return [f for f in files if not (f in seen or seen.add(f))]
+
+
+NCX_NS = 'http://www.daisy.org/z3986/2005/ncx/'
+XHTML_NS = 'http://www.w3.org/1999/xhtml'
+OPS_NS = 'http://www.idpf.org/2007/ops'
+
+# spine itemref properties as Readium's PackageDocumentParser reads them
+_SPINE_PROPERTIES = {
+    'rendition:orientation-landscape': {'rendition_orientation': 'landscape'},
+    'rendition:orientation-portrait': {'rendition_orientation': 'portrait'},
+    'rendition:orientation-auto': {'rendition_orientation': 'auto'},
+    'rendition:spread-none': {'rendition_spread': 'none'},
+    'rendition:spread-landscape': {'rendition_spread': 'landscape'},
+    'rendition:spread-portrait': {'rendition_spread': 'portrait'},
+    'rendition:spread-both': {'rendition_spread': 'both'},
+    'rendition:spread-auto': {'rendition_spread': 'auto'},
+    'rendition:flow-paginated': {'rendition_flow': 'paginated'},
+    'rendition:flow-scrolled-continuous': {'rendition_flow': 'scrolled-continuous'},
+    'rendition:flow-scrolled-doc': {'rendition_flow': 'scrolled-doc'},
+    'rendition:flow-auto': {'rendition_flow': 'auto'},
+    'rendition:page-spread-center': {'page_spread': 'page-spread-center'},
+    'page-spread-left': {'page_spread': 'page-spread-left'},
+    'page-spread-right': {'page_spread': 'page-spread-right'},
+    'rendition:layout-reflowable': {'fixed_flow': False, 'rendition_layout': 'reflowable'},
+    'rendition:layout-pre-paginated': {'fixed_flow': True, 'rendition_layout': 'pre-paginated'},
+}
+
+
+def _local(tag):
+    return tag.rpartition('}')[2]
+
+
+''' The manifest and spine of the OPF at opf_path in the form Readium's
+    PackageDocumentParser builds them, plus the book path of the toc document
+    Readium will use. Parsed in one streaming pass, None if anything Readium
+    needs is missing. '''
+def package_document(opf_path, opfbookpath):
+    manifest = []
+    spine = []
+    viewports = {}
+    toc_id = None
+    ppd = None
+    spine_step = None
+    # element children of the package element seen so far
+    package_children = 0
+    depth = 0
+    try:
+        for event, elem in ElementTree.iterparse(opf_path, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth == 2:
+                    package_children += 1
+                    if elem.tag == '{%s}spine' % OPF_NS:
+                        spine_id = elem.get('id')
+                        spine_step = '/{}'.format(package_children * 2) + ('[{}]'.format(spine_id) if spine_id else '')
+                        toc_id = elem.get('toc')
+                        ppd = elem.get('page-progression-direction')
+                continue
+            depth -= 1
+            tag = elem.tag
+            if tag == '{%s}item' % OPF_NS and depth == 2:
+                manifest.append({
+                    'href': elem.get('href') or '',
+                    'id': elem.get('id') or '',
+                    'media_overlay_id': elem.get('media-overlay') or '',
+                    'media_type': elem.get('media-type') or '',
+                    'properties': elem.get('properties') or '',
+                })
+            elif tag == '{%s}meta' % OPF_NS and elem.get('property') == 'rendition:viewport' and elem.get('refines'):
+                refines = elem.get('refines')
+                if '#' in refines:
+                    refines = refines[refines.index('#') + 1:]
+                viewports[refines.strip()] = elem.text or ''
+            elif tag == '{%s}spine' % OPF_NS and depth == 1:
+                # every element child counts for the cfi steps, not just itemrefs
+                spine = [dict(child.attrib) for child in elem]
+            if depth == 1:
+                elem.clear()
+    except (OSError, ElementTree.ParseError):
+        return None
+    if spine_step is None:
+        return None
+    by_id = {item['id']: item for item in manifest}
+    json_spine = []
+    for index, itemref in enumerate(spine):
+        idref = itemref.get('idref') or ''
+        item = by_id.get(idref)
+        if item is None:
+            return None
+        ident = itemref.get('id')
+        step = '/{}'.format((index + 1) * 2) + ('[{}]'.format(ident) if ident else '')
+        entry = {
+            'rendition_viewport': viewports.get(ident),
+            'idref': idref,
+            'href': item['href'],
+            'manifest_id': item['id'],
+            'media_type': item['media_type'],
+            'media_overlay_id': item['media_overlay_id'],
+            'linear': itemref.get('linear') or '',
+            'properties': itemref.get('properties') or '',
+            'cfi': spine_step + step + '!',
+        }
+        for prop in entry['properties'].split(' '):
+            entry.update(_SPINE_PROPERTIES.get(prop, ()))
+        if entry['rendition_viewport'] is None:
+            del entry['rendition_viewport']
+        json_spine.append(entry)
+    # Readium prefers the nav document and falls back on the ncx
+    opfdir = posixpath.dirname(opfbookpath)
+    toc = next((i for i in manifest if 'nav' in i['properties'].split()), None) or by_id.get(toc_id)
+    toc_bookpath = None
+    if toc is not None:
+        toc_bookpath = posixpath.normpath(posixpath.join(opfdir, unquote(toc['href']).partition('#')[0]))
+    return {
+        'manifest': manifest,
+        'spine': json_spine,
+        'page_progression_direction': ppd,
+        'toc': toc_bookpath,
+    }
+
+
+''' The navMap of an ncx as nested [{'text', 'href', 'children'}] '''
+def ncx_toc(path):
+    root = []
+    stack = []
+    try:
+        for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                if tag == '{%s}navPoint' % NCX_NS:
+                    entry = {'text': '', 'href': '', 'children': []}
+                    (stack[-1]['children'] if stack else root).append(entry)
+                    stack.append(entry)
+                continue
+            if tag == '{%s}navPoint' % NCX_NS:
+                stack.pop()
+                elem.clear()
+            elif stack and tag == '{%s}text' % NCX_NS and not stack[-1]['text']:
+                stack[-1]['text'] = (elem.text or '').strip()
+            elif stack and tag == '{%s}content' % NCX_NS and not stack[-1]['href']:
+                stack[-1]['href'] = elem.get('src') or ''
+    except (OSError, ElementTree.ParseError):
+        return None
+    return root
+
+
+''' The toc nav of an epub3 navigation document as nested [{'text', 'href', 'children'}] '''
+def nav_toc(path):
+    root = []
+    stack = []
+    in_toc = False
+    depth = 0
+    li_depths = []
+    try:
+        for event, elem in ElementTree.iterparse(path, events=('start', 'end')):
+            tag = elem.tag
+            if event == 'start':
+                depth += 1
+                if tag == '{%s}nav' % XHTML_NS and 'toc' in elem.get('{%s}type' % OPS_NS, '').split():
+                    in_toc = True
+                elif in_toc and tag == '{%s}li' % XHTML_NS:
+                    entry = {'text': '', 'href': '', 'children': []}
+                    (stack[-1]['children'] if stack else root).append(entry)
+                    stack.append(entry)
+                    li_depths.append(depth)
+                continue
+            if in_toc:
+                if tag == '{%s}li' % XHTML_NS:
+                    stack.pop()
+                    li_depths.pop()
+                elif tag in ('{%s}a' % XHTML_NS, '{%s}span' % XHTML_NS) and li_depths and depth == li_depths[-1] + 1:
+                    stack[-1]['text'] = ' '.join(''.join(elem.itertext()).split())
+                    stack[-1]['href'] = elem.get('href') or ''
+                elif tag == '{%s}nav' % XHTML_NS:
+                    break
+            depth -= 1
+    except (OSError, ElementTree.ParseError):
+        return None
+    return root
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+import os
+import posixpath
+import mimetypes
+import zlib
+
+from plugin_utils import QtCore, QtWebEngineCore, Signal
+from epubarchive import EpubArchive, ArchiveError
+
+# QWebEngineUrlScheme only exists in Qt 5.12 and later
+QWebEngineUrlScheme = getattr(QtWebEngineCore, 'QWebEngineUrlScheme', None)
+QWebEngineUrlSchemeHandler = QtWebEngineCore.QWebEngineUrlSchemeHandler
+QWebEngineUrlRequestJob = QtWebEngineCore.QWebEngineUrlRequestJob
+
+SCHEME_NAME = 'sigilreader'
+READER_HOST = 'reader'
+# mount point of books relative to index.html (Readium insists on epub_content)
+BOOK_PREFIX = 'epub_content'
+
+EPUB_MIMETYPE = 'application/epub+zip'
+
+# mimetypes that matter to Readium and that python's mimetypes module
+# either does not know about or gets wrong on some platforms
+_EPUB_MIMETYPES = {
+    '.xhtml': 'application/xhtml+xml',
+    '.html': 'text/html',
+    '.htm': 'text/html',
+    '.opf': 'application/oebps-package+xml',
+    '.ncx': 'application/x-dtbncx+xml',
+    '.xml': 'application/xml',
+    '.smil': 'application/smil+xml',
+    '.css': 'text/css',
+    '.js': 'application/javascript',
+    '.svg': 'image/svg+xml',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+    '.ttf': 'font/ttf',
+    '.otf': 'font/otf',
+    '.woff': 'font/woff',
+    '.woff2': 'font/woff2',
+    '.mp3': 'audio/mpeg',
+    '.m4a': 'audio/mp4',
+    '.mp4': 'video/mp4',
+    '.json': 'application/json',
+}
+
+
+def scheme_supported():
+    return QWebEngineUrlScheme is not None
+
+
+''' Register the custom url scheme used to serve both the viewer and the book.
+    Must be called before the QApplication is created. '''
+def register_reader_scheme():
+    scheme = QWebEngineUrlScheme(QtCore.QByteArray(SCHEME_NAME.encode('ascii')))
+    scheme.setSyntax(QWebEngineUrlScheme.Syntax.Host)
+    scheme.setFlags(QWebEngineUrlScheme.Flag.SecureScheme |
+                    QWebEngineUrlScheme.Flag.LocalAccessAllowed |
+                    QWebEngineUrlScheme.Flag.CorsEnabled)
+    QWebEngineUrlScheme.registerScheme(scheme)
+
+
+''' Readium query string that opens the book mounted under name '''
+def book_query(name):
+    return 'epub=' + BOOK_PREFIX + '/' + name + '/'
+
+
+def guess_mimetype(path):
+    ext = os.path.splitext(path)[1].lower()
+    mt = _EPUB_MIMETYPES.get(ext)
+    if mt is None:
+        mt = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    return mt
+
+
+''' Clean up a url path and split it into its components.
+    Returns None for anything that tries to escape its root. '''
+def split_request_path(path):
+    path = posixpath.normpath('/' + path.lstrip('/'))
+    parts = [p for p in path.split('/') if p]
+    if any(p in ('.', '..') for p in parts):
+        return None
+    return parts
+
+
+class DirectoryBookSource(object):
+
+    ''' Serves the files of an unpacked epub straight from where they live on disk '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def filepath(self, relpath):
+        return os.path.join(self.root, *relpath.split('/'))
+
+    def exists(self, relpath):
+        if relpath == 'mimetype':
+            return True
+        return os.path.isfile(self.filepath(relpath))
+
+    def stamp(self, relpath):
+        ''' Changes whenever the file does, None if it can not be told '''
+        try:
+            st = os.stat(self.filepath(relpath))
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime_ns)
+
+    def open(self, relpath, parent=None):
+        fpath = self.filepath(relpath)
+        if relpath == 'mimetype' and not os.path.isfile(fpath):
+            # Sigil does not always write the mimetype file out
+            dev = QtCore.QBuffer(parent)
+            dev.setData(QtCore.QByteArray(EPUB_MIMETYPE.encode('ascii')))
+        else:
+            dev = QtCore.QFile(fpath, parent)
+        if not dev.open(QtCore.QIODevice.OpenModeFlag.ReadOnly):
+            dev.deleteLater()
+            return None
+        return dev
+
+
+class SyncingBookSource(QtCore.QObject):
+
+    ''' Serves a book cache copy that is still being brought up to date by a
+        bookcache.BookSync. Requests for files that are not written out yet
+        move them to the front of its queue and are answered once they are. '''
+
+    # emitted on the sync's worker threads, delivered on the GUI thread
+    fileReady = Signal(str)
+
+    def __init__(self, sync, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.sync = sync
+        self.files = DirectoryBookSource(sync.bookdir)
+        # relpath -> [(job, callback)]
+        self._waiting = {}
+        self.fileReady.connect(self._file_ready)
+        sync.add_listener(self.fileReady.emit)
+
+    def exists(self, relpath):
+        return self.sync.known(relpath) or self.files.exists(relpath)
+
+    def stamp(self, relpath):
+        return self.files.stamp(relpath)
+
+    def open(self, relpath, parent=None):
+        return self.files.open(relpath, parent)
+
+    def pending(self, relpath):
+        return self.sync.pending(relpath)
+
+    def when_ready(self, relpath, job, callback):
+        self._waiting.setdefault(relpath, []).append((job, callback))
+        job.destroyed.connect(lambda obj=None, relpath=relpath, jid=id(job): self._forget(relpath, jid))
+        self.sync.want(relpath)
+        if not self.sync.pending(relpath):
+            # written out while we were queueing up
+            self._file_ready(relpath)
+
+    def _forget(self, relpath, jid):
+        waiting = self._waiting.get(relpath)
+        if waiting:
+            waiting[:] = [w for w in waiting if id(w[0]) != jid]
+
+    def _file_ready(self, relpath):
+        for job, callback in self._waiting.pop(relpath, ()):
+            callback(job)
+
+
+class ArchiveEntryDevice(QtCore.QIODevice):
+
+    ''' QIODevice over one archive entry. Stored entries are copied out of
+        the memory map and deflated ones inflated, a chunk at a time as
+        Chromium reads, so no entry is ever held in memory whole. '''
+
+    def __init__(self, reader, parent=None):
+        QtCore.QIODevice.__init__(self, parent)
+        self._reader = reader
+
+    def isSequential(self):
+        return True
+
+    def size(self):
+        return self._reader.size
+
+    def bytesAvailable(self):
+        return self._reader.remaining() + QtCore.QIODevice.bytesAvailable(self)
+
+    def atEnd(self):
+        return self._reader.remaining() == 0 and QtCore.QIODevice.bytesAvailable(self) == 0
+
+    def readData(self, maxlen):
+        try:
+            data = bytes(self._reader.read(maxlen))
+        except (zlib.error, ArchiveError) as e:
+            # corrupt deflate data, the reply ends with an error
+            print('Cannot read archive entry: {}'.format(e))
+            return -1
+        if not data and maxlen > 0 and self._reader.remaining():
+            # the deflate stream ended before the entry's recorded size
+            return -1
+        return data
+
+    def writeData(self, data):
+        return -1
+
+
+class EpubArchiveSource(object):
+
+    ''' Serves the entries of a packed .epub without extracting it '''
+
+    def __init__(self, path):
+        st = os.stat(path)
+        self._stamp = (st.st_size, st.st_mtime_ns)
+        self.archive = EpubArchive(path)
+
+    def exists(self, relpath):
+        return relpath in self.archive or relpath == 'mimetype'
+
+    def stamp(self, relpath):
+        entry = self.archive.entries.get(relpath)
+        if entry is None:
+            return None
+        return self._stamp + (entry.header_offset, entry.size)
+
+    def open(self, relpath, parent=None):
+        if relpath not in self.archive:
+            dev = QtCore.QBuffer(parent)
+            dev.setData(QtCore.QByteArray(EPUB_MIMETYPE.encode('ascii')))
+        else:
+            try:
+                reader = self.archive.reader(relpath)
+            except (ArchiveError, OSError) as e:
+                # a corrupt local header or a compression method we can't
+                # inflate, the request fails instead of the slot raising
+                print('Cannot serve {}: {}'.format(relpath, e))
+                return None
+            dev = ArchiveEntryDevice(reader, parent)
+        if not dev.open(QtCore.QIODevice.OpenModeFlag.ReadOnly):
+            dev.deleteLater()
+            return None
+        return dev
+
+    def close(self):
+        self.archive.close()
+
+
+class BookSchemeHandler(QWebEngineUrlSchemeHandler):
+
+    ''' Answers all sigilreader:// requests. Paths under epub_content/<name>/ are
+        streamed on demand from the mounted book source, everything else comes
+        from the viewer directory. '''
+
+    def __init__(self, viewer_root, parent=None):
+        QWebEngineUrlSchemeHandler.__init__(self, parent)
+        self.viewer_root = viewer_root
+        self._mounts = {}
+        self._images = {}
+
+    def mount(self, name, source, images=None):
+        ''' images: an imageproxy.ImageProxy to serve the book's images through '''
+        self._mounts[name] = source
+        if images is not None:
+            self._images[name] = images
+
+    def unmount(self, name):
+        self._mounts.pop(name, None)
+        self._images.pop(name, None)
+
+    def reader_url(self, query=None):
+        url = QtCore.QUrl()
+        url.setScheme(SCHEME_NAME)
+        url.setHost(READER_HOST)
+        url.setPath('/index.html')
+        if query is not None:
+            url.setQuery(query)
+        return url
+
+    @staticmethod
+    def book_name(parts):
+        ''' The mounted book a request is for, None for the viewer's own files '''
+        if len(parts) > 2 and parts[0] == BOOK_PREFIX:
+            return parts[1]
+        return None
+
+    def resolve(self, parts):
+        ''' Map url path components to (source, relpath) '''
+        name = self.book_name(parts)
+        if name is not None:
+            source = self._mounts.get(name)
+            if source is None:
+                return None, None
+            return source, '/'.join(parts[2:])
+        return DirectoryBookSource(self.viewer_root), '/'.join(parts)
+
+    def requestStarted(self, job):
+        if bytes(job.requestMethod()) != b'GET':
+            job.fail(QWebEngineUrlRequestJob.Error.RequestDenied)
+            return
+        url = job.requestUrl()
+        parts = split_request_path(url.path(QtCore.QUrl.ComponentFormattingOption.FullyDecoded))
+        if not parts or url.host() != READER_HOST:
+            job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+            return
+        source, relpath = self.resolve(parts)
+        if source is None or not source.exists(relpath):
+            job.fail(QWebEngineUrlRequestJob.Error.UrlNotFound)
+            return
+        if getattr(source, 'pending', None) is not None and source.pending(relpath):
+            source.when_ready(relpath, job, self.requestStarted)
+            return
+        name = self.book_name(parts)
+        images = self._images.get(name) if name is not None else None
+        if images is not None and images.handles(relpath):
+            # answered asynchronously once a downsampled variant is ready
+            images.serve(job, source, relpath)
+            return
+        # the device is parented to the job so it is cleaned up along with it
+        dev = source.open(relpath, job)
+        if dev is None:
+            job.fail(QWebEngineUrlRequestJob.Error.RequestFailed)
+            return
+        job.reply(QtCore.QByteArray(guess_mimetype(relpath).encode('ascii')), dev)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Where the viewer's console messages go.
+#
+# A broken book can log the same error thousands of times per page turn, so
+# messages are deduplicated by (source, line, message) and only counted after
+# the first time, new messages are rate limited and everything is written out
+# in batches by a writer thread so the GUI thread never waits on stderr. The
+# most recent entries are kept in a ring buffer and a summary of what was
+# logged (with repeat counts) is written when the log is closed.
+
+import sys
+import json
+import time
+import queue
+import threading
+from collections import deque
+
+from plugin_utils import QtCore
+
+LEVELS = ('INFO', 'WARNING', 'ERROR')
+DEFAULT_SUPPRESS = ('ResizeObserver loop limit exceeded',)
+# new distinct messages written per second, the rest only show up in the summary
+DEFAULT_RATE = 20
+DEFAULT_CAPACITY = 200
+FLUSH_MSECS = 500
+SUMMARY_TOP = 10
+
+
+class ConsoleLog(QtCore.QObject):
+
+    def __init__(self, stream=None, level='ERROR', suppress=DEFAULT_SUPPRESS, rate=DEFAULT_RATE,
+                 capacity=DEFAULT_CAPACITY, report_path=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.stream = stream if stream is not None else sys.stderr
+        self.min_level = LEVELS.index(level) if level in LEVELS else LEVELS.index('ERROR')
+        self.suppress = tuple(suppress or ())
+        self.rate = rate
+        self.report_path = report_path
+        self.recent = deque(maxlen=capacity)
+        # (source, line, message) -> entry dict
+        self.entries = {}
+        self.counts = {'messages': 0, 'suppressed': 0, 'filtered': 0, 'rate_limited': 0}
+        self._lines = []
+        self._repeated = set()
+        self._allowance = float(rate)
+        self._last_refill = time.monotonic()
+        self._closed = False
+        self._queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, name='console-log', daemon=True)
+        self._writer.start()
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self.flush)
+        self._timer.start(FLUSH_MSECS)
+
+    def _allow(self):
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        self._allowance = min(float(self.rate), self._allowance + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+        if self._allowance < 1.0:
+            return False
+        self._allowance -= 1.0
+        return True
+
+    def message(self, level, msg, line, source):
+        ''' level is one of LEVELS '''
+        self.counts['messages'] += 1
+        if any(s in msg for s in self.suppress):
+            self.counts['suppressed'] += 1
+            return
+        if LEVELS.index(level) < self.min_level:
+            self.counts['filtered'] += 1
+            return
+        key = (source, line, msg)
+        entry = self.entries.get(key)
+        now = time.time()
+        if entry is not None:
+            entry['count'] += 1
+            entry['last'] = now
+            if entry['written']:
+                self._repeated.add(key)
+            return
+        entry = self.entries[key] = {'level': level, 'source': source, 'line': line, 'message': msg,
+                                     'count': 1, 'first': now, 'last': now, 'written': 0}
+        self.recent.append(entry)
+        if self._closed or not self._allow():
+            self.counts['rate_limited'] += 1
+            return
+        entry['written'] = 1
+        self._lines.append('%s: %s:%s: %s' % (level, source, line, msg))
+
+    def flush(self):
+        ''' Hand what was logged since the last flush to the writer thread '''
+        lines, self._lines = self._lines, []
+        for key in sorted(self._repeated, key=lambda k: self.entries[k]['first']):
+            entry = self.entries[key]
+            lines.append('%s: %s:%s: (repeated %d more times)' % (
+                entry['level'], entry['source'], entry['line'], entry['count'] - entry['written']))
+            entry['written'] = entry['count']
+        self._repeated.clear()
+        if lines:
+            self._queue.put('\n'.join(lines) + '\n')
+
+    def _write_loop(self):
+        while True:
+            text = self._queue.get()
+            if text is None:
+                return
+            # pick up whatever else queued up meanwhile, one write and flush for all of it
+            batch = [text]
+            while True:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    self._write(batch)
+                    return
+                batch.append(more)
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            self.stream.write(''.join(batch))
+            self.stream.flush()
+        except (EnvironmentError, ValueError):
+            pass
+
+    def summary(self):
+        top = sorted(self.entries.values(), key=lambda e: e['count'], reverse=True)
+        return {
+            'counts': dict(self.counts),
+            'distinct': len(self.entries),
+            'top': [{k: e[k] for k in ('level', 'source', 'line', 'message', 'count')} for e in top[:SUMMARY_TOP]],
+            'recent': [{k: e[k] for k in ('level', 'source', 'line', 'message', 'count', 'first', 'last')}
+                       for e in self.recent],
+        }
+
+    def close(self):
+        ''' Write out anything pending plus a summary, then stop the writer '''
+        if self._closed:
+            return
+        self._closed = True
+        self._timer.stop()
+        self.flush()
+        data = self.summary()
+        if self.entries or data['counts']['suppressed']:
+            lines = ['Console: {messages} messages, {suppressed} suppressed, {filtered} below the log level, '
+                     '{rate_limited} not shown (rate limit)'.format(**data['counts'])]
+            for e in data['top']:
+                if e['count'] > 1:
+                    lines.append('  %6d x %s: %s:%s: %s' % (e['count'], e['level'], e['source'], e['line'], e['message']))
+            self._queue.put('\n'.join(lines) + '\n')
+        self._queue.put(None)
+        self._writer.join(2.0)
+        if self.report_path:
+            try:
+                with open(self.report_path, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=1)
+            except EnvironmentError:
+                pass
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Read-only access to the entries of a packed epub without extracting it.
+# The file is memory mapped and its central directory indexed once, stored
+# entries are handed out as memoryviews of the map and deflated entries are
+# inflated a chunk at a time as they are read.
+
+import os
+import mmap
+import zlib
+import struct
+
+STORED = 0
+DEFLATED = 8
+
+_EOCD_SIG = b'PK\x05\x06'
+_EOCD64_LOCATOR_SIG = b'PK\x06\x07'
+_EOCD64_SIG = b'PK\x06\x06'
+_CENTRAL_SIG = b'PK\x01\x02'
+_LOCAL_SIG = b'PK\x03\x04'
+_EOCD_SIZE = 22
+_CENTRAL_SIZE = 46
+_LOCAL_SIZE = 30
+# the end of central directory record may be followed by a comment of up to 64K
+_MAX_EOCD_SEARCH = _EOCD_SIZE + 0xFFFF
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class ZipEntry(object):
+
+    __slots__ = ('name', 'method', 'compressed_size', 'size', 'header_offset', 'data_offset')
+
+    def __init__(self, name, method, compressed_size, size, header_offset):
+        self.name = name
+        self.method = method
+        self.compressed_size = compressed_size
+        self.size = size
+        self.header_offset = header_offset
+        # only known once the local header has been looked at
+        self.data_offset = None
+
+
+class EntryReader(object):
+
+    ''' Sequential reader over one entry, inflating on demand '''
+
+    def __init__(self, archive, entry):
+        self.size = entry.size
+        self.pos = 0
+        self._data = archive.raw(entry)
+        self._in = 0
+        self._inflater = zlib.decompressobj(-15) if entry.method == DEFLATED else None
+        self._pending = b''
+
+    def remaining(self):
+        return self.size - self.pos
+
+    def read(self, n=-1):
+        if n < 0 or n > self.remaining():
+            n = self.remaining()
+        if n <= 0:
+            return b''
+        if self._inflater is None:
+            # stored: a view of the map, nothing is copied here
+            chunk = self._data[self.pos:self.pos + n]
+            self.pos += n
+            return chunk
+        out = [self._pending[:n]]
+        self._pending = self._pending[n:]
+        have = len(out[0])
+        while have < n:
+            if self._inflater.unconsumed_tail:
+                produced = self._inflater.decompress(self._inflater.unconsumed_tail, n - have)
+            elif self._in < len(self._data):
+                block = self._data[self._in:self._in + 256 * 1024]
+                self._in += len(block)
+                produced = self._inflater.decompress(block, n - have)
+            else:
+                produced = self._inflater.flush()
+                if not produced:
+                    break
+            out.append(produced[:n - have])
+            self._pending += produced[n - have:]
+            have += len(produced)
+        data = b''.join(out)
+        self.pos += len(data)
+        return data
+
+
+class EpubArchive(object):
+
+    ''' An epub (or any zip) opened for random access by entry name '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            if size < _EOCD_SIZE:
+                raise ArchiveError('{} is not a zip file'.format(path))
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+            self.entries = self._read_index(size)
+        except Exception:
+            self.close()
+            raise
+
+    def _read_index(self, size):
+        m = self._map
+        start = max(0, size - _MAX_EOCD_SEARCH)
+        eocd = m.rfind(_EOCD_SIG, start)
+        if eocd < 0:
+            raise ArchiveError('{} has no central directory'.format(self.path))
+        count, cd_size, cd_offset = struct.unpack_from('<6xHLL', m, eocd + 4)
+        if 0xFFFFFFFF in (cd_size, cd_offset) or count == 0xFFFF:
+            locator = eocd - 20
+            if locator < 0 or m[locator:locator + 4] != _EOCD64_LOCATOR_SIG:
+                raise ArchiveError('{} has a broken zip64 directory'.format(self.path))
+            eocd64 = struct.unpack_from('<Q', m, locator + 8)[0]
+            if m[eocd64:eocd64 + 4] != _EOCD64_SIG:
+                raise ArchiveError('{} has a broken zip64 directory'.format(self.path))
+            count, cd_size, cd_offset = struct.unpack_from('<QQQ', m, eocd64 + 32)
+        entries = {}
+        pos = cd_offset
+        for i in range(count):
+            if m[pos:pos + 4] != _CENTRAL_SIG:
+                raise ArchiveError('{} has a corrupt central directory'.format(self.path))
+            (flags, method, csize, usize, nlen, xlen, clen,
+             offset) = struct.unpack_from('<8xHH8xLLHHH8xL', m, pos)
+            name = bytes(m[pos + _CENTRAL_SIZE:pos + _CENTRAL_SIZE + nlen])
+            name = name.decode('utf-8' if flags & 0x800 else 'cp437')
+            if 0xFFFFFFFF in (csize, usize, offset):
+                usize, csize, offset = self._zip64_sizes(pos + _CENTRAL_SIZE + nlen, xlen, usize, csize, offset)
+            if not name.endswith('/'):
+                entries[name] = ZipEntry(name, method, csize, usize, offset)
+            pos += _CENTRAL_SIZE + nlen + xlen + clen
+        return entries
+
+    def _zip64_sizes(self, pos, xlen, usize, csize, offset):
+        end = pos + xlen
+        while pos + 4 <= end:
+            tag, length = struct.unpack_from('<HH', self._map, pos)
+            if tag == 1:
+                fields = iter(struct.unpack_from('<{}Q'.format(length // 8), self._map, pos + 4))
+                if usize == 0xFFFFFFFF:
+                    usize = next(fields)
+                if csize == 0xFFFFFFFF:
+                    csize = next(fields)
+                if offset == 0xFFFFFFFF:
+                    offset = next(fields)
+                break
+            pos += 4 + length
+        return usize, csize, offset
+
+    def close(self):
+        view, self._view = getattr(self, '_view', None), None
+        if view is not None:
+            view.release()
+        m, self._map = getattr(self, '_map', None), None
+        if m is not None:
+            try:
+                m.close()
+            except BufferError:
+                # entry views are still in use, the map goes away with the last of them
+                pass
+        f, self._file = getattr(self, '_file', None), None
+        if f is not None:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def namelist(self):
+        return list(self.entries)
+
+    def getinfo(self, name):
+        try:
+            return self.entries[name]
+        except KeyError:
+            raise KeyError('{} is not in {}'.format(name, self.path))
+
+    def raw(self, entry):
+        ''' The entry's (possibly compressed) bytes as a view of the map '''
+        if entry.data_offset is None:
+            pos = entry.header_offset
+            if self._map[pos:pos + 4] != _LOCAL_SIG:
+                raise ArchiveError('bad local header for {}'.format(entry.name))
+            nlen, xlen = struct.unpack_from('<HH', self._map, pos + 26)
+            entry.data_offset = pos + _LOCAL_SIZE + nlen + xlen
+        if entry.method not in (STORED, DEFLATED):
+            raise ArchiveError('{} uses unsupported compression method {}'.format(entry.name, entry.method))
+        return self._view[entry.data_offset:entry.data_offset + entry.compressed_size]
+
+    def reader(self, name):
+        return EntryReader(self, self.getinfo(name))
+
+    def read(self, name):
+        entry = self.getinfo(name)
+        if entry.method == STORED:
+            return self.raw(entry)
+        return zlib.decompress(self.raw(entry), -15)
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Downsampled variants of a book's raster images for the viewer.
+#
+# Comics and photo books often embed images many times larger than anything
+# the reader window can show, and Chromium decodes each of them at full size.
+# Images requested through the sigilreader:// scheme that are larger than the
+# viewport (times the device pixel ratio) are scaled down to fit it on a pool
+# of worker threads and the request is answered once the variant is ready.
+# Variants are kept on disk by a key made of the image's content hash and
+# the viewport bucket, so they survive Sigil writing the book out afresh on
+# every launch, one folder per book in an LRUStore. Within a folder the least
+# recently used variants go once it is over budget. The book itself is never
+# touched.
+
+import os
+import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from plugin_utils import QtCore, QtGui, QtWebEngineCore, Qt, Signal
+from lrustore import LRUStore, dir_size
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+DEFAULT_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))
+# viewport sizes are rounded up to a multiple of this so that resizing the
+# window a little does not produce a new set of variants
+BUCKET = 256
+JPEG_QUALITY = 90
+
+QWebEngineUrlRequestJob = QtWebEngineCore.QWebEngineUrlRequestJob
+
+# extension: (format written, mimetype), gifs are left alone since they may be animated
+_FORMATS = {
+    '.jpg': ('jpg', 'image/jpeg'),
+    '.jpeg': ('jpg', 'image/jpeg'),
+    '.png': ('png', 'image/png'),
+    '.webp': ('webp', 'image/webp'),
+}
+
+
+def bucket(n):
+    n = int(n)
+    return max(BUCKET, -(-n // BUCKET) * BUCKET)
+
+
+''' Scale an image down to fit target (a QSize) and write it to path.
+    Returns False if the image already fits or could not be read. Runs on
+    a worker thread so only the thread-safe image classes are used. '''
+def write_variant(dev, target, fmt, path):
+    reader = QtGui.QImageReader(dev)
+    reader.setAutoTransform(True)
+    size = reader.size()
+    if not size.isValid():
+        return False
+    if reader.transformation() & QtGui.QImageIOHandler.Transformation.TransformationRotate90:
+        # the size is the stored one, the viewer sees the image turned on its side
+        target = target.transposed()
+    if size.width() <= target.width() and size.height() <= target.height():
+        return False
+    # jpegs are decoded straight at the smaller size, which is most of the win
+    reader.setScaledSize(size.scaled(target, Qt.AspectRatioMode.KeepAspectRatio))
+    image = reader.read()
+    if image.isNull():
+        return False
+    tmp = '{}.{}.part'.format(path, threading.get_ident())
+    if not image.save(tmp, fmt, JPEG_QUALITY if fmt == 'jpg' else -1):
+        return False
+    os.replace(tmp, path)
+    return True
+
+
+class ImageProxy(QtCore.QObject):
+
+    ''' Answers the scheme handler's image requests for one mounted book '''
+
+    # request key, variant key, variant path or '' when the original should
+    # be served, whether the variant was already on disk
+    _variantDone = Signal(str, str, str, bool)
+
+    def __init__(self, cachedir, key, budget=DEFAULT_BUDGET, workers=DEFAULT_WORKERS, digests=None, parent=None):
+        ''' digests: the launch's bookcache.BookDigests for the book, images
+            it has no hash for are hashed as they are read '''
+        QtCore.QObject.__init__(self, parent)
+        self.store = LRUStore(cachedir, budget)
+        self.budget = budget
+        self.key = key
+        self.folder = self.store.path(key)
+        os.makedirs(self.folder, exist_ok=True)
+        self.digests = digests
+        self.target = None
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix='image-proxy')
+        # request key -> [(job, source, relpath, mimetype)] waiting for it
+        self._pending = {}
+        # request key -> variant key, once the image has been hashed
+        self._variants = {}
+        # variant keys of images that turned out to fit already
+        self._fits = set()
+        self.stats = {'scaled': 0, 'cached': 0, 'original': 0}
+        self._variantDone.connect(self._answer)
+        writable = set(bytes(f).decode('ascii') for f in QtGui.QImageWriter.supportedImageFormats())
+        self.formats = {ext: v for ext, v in _FORMATS.items() if v[0] in writable}
+
+    def set_viewport(self, width, height, dpr=1.0):
+        self.target = QtCore.QSize(bucket(width * dpr), bucket(height * dpr))
+
+    def handles(self, relpath):
+        return self.target is not None and os.path.splitext(relpath)[1].lower() in self.formats
+
+    @staticmethod
+    def variant_key(digest, target):
+        return '{}-{}x{}'.format(digest, target.width(), target.height())
+
+    def serve(self, job, source, relpath):
+        ''' Reply to job with a variant of relpath, now or once it is made '''
+        fmt, mimetype = self.formats[os.path.splitext(relpath)[1].lower()]
+        if source.stamp(relpath) is None:
+            self._reply_original(job, source, relpath, mimetype)
+            return
+        request = '{}|{}x{}'.format(relpath, self.target.width(), self.target.height())
+        key = self._variants.get(request)
+        if key is not None:
+            if key in self._fits:
+                self._reply_original(job, source, relpath, mimetype)
+                return
+            path = os.path.join(self.folder, key + '.' + fmt)
+            if os.path.isfile(path):
+                self.stats['cached'] += 1
+                self._reply_file(job, path, mimetype)
+                return
+        waiting = self._pending.get(request)
+        # Chromium owns the job and may drop it (page turned, window closed)
+        # before the variant is ready
+        job.destroyed.connect(lambda obj=None, request=request, jid=id(job): self._forget(request, jid))
+        if waiting is not None:
+            waiting.append((job, source, relpath, mimetype))
+            return
+        self._pending[request] = [(job, source, relpath, mimetype)]
+        self.pool.submit(self._make, source, relpath, request, QtCore.QSize(self.target), fmt)
+
+    def _digest(self, source, relpath):
+        # (content hash, the image bytes if they had to be read for it)
+        if self.digests is not None:
+            digest = self.digests.get((relpath,)).get(relpath)
+            if digest is not None:
+                return digest, None
+        dev = source.open(relpath)
+        if dev is None:
+            return None, None
+        try:
+            data = bytes(dev.readAll())
+        finally:
+            dev.close()
+        # the same hash as bookcache.file_hash
+        return hashlib.blake2b(data, digest_size=20).hexdigest(), data
+
+    def _make(self, source, relpath, request, target, fmt):
+        key = path = ''
+        ok = cached = False
+        try:
+            digest, data = self._digest(source, relpath)
+            if digest is not None:
+                key = self.variant_key(digest, target)
+                path = os.path.join(self.folder, key + '.' + fmt)
+                if os.path.isfile(path):
+                    # most recently used, for the sweep in close()
+                    os.utime(path)
+                    ok = cached = True
+                else:
+                    if data is None:
+                        dev = source.open(relpath)
+                    else:
+                        dev = QtCore.QBuffer()
+                        dev.setData(QtCore.QByteArray(data))
+                        dev.open(QtCore.QIODevice.OpenModeFlag.ReadOnly)
+                    if dev is not None:
+                        try:
+                            ok = write_variant(dev, target, fmt, path)
+                        finally:
+                            dev.close()
+        except Exception as e:
+            print('Image proxy could not scale {}: {}'.format(relpath, e))
+        self._variantDone.emit(request, key, path if ok else '', cached)
+
+    def _forget(self, request, jid):
+        waiting = self._pending.get(request)
+        if waiting:
+            waiting[:] = [w for w in waiting if id(w[0]) != jid]
+
+    def _answer(self, request, key, path, cached):
+        if key:
+            self._variants[request] = key
+            if not path:
+                self._fits.add(key)
+        for job, source, relpath, mimetype in self._pending.pop(request, ()):
+            if path:
+                self.stats['cached' if cached else 'scaled'] += 1
+                self._reply_file(job, path, mimetype)
+            else:
+                self._reply_original(job, source, relpath, mimetype)
+
+    def _reply_file(self, job, path, mimetype):
+        dev = QtCore.QFile(path, job)
+        if not dev.open(QtCore.QIODevice.OpenModeFlag.ReadOnly):
+            dev.deleteLater()
+            job.fail(QWebEngineUrlRequestJob.Error.RequestFailed)
+            return
+        job.reply(QtCore.QByteArray(mimetype.encode('ascii')), dev)
+
+    def _reply_original(self, job, source, relpath, mimetype):
+        self.stats['original'] += 1
+        dev = source.open(relpath, job)
+        if dev is None:
+            job.fail(QWebEngineUrlRequestJob.Error.RequestFailed)
+            return
+        job.reply(QtCore.QByteArray(mimetype.encode('ascii')), dev)
+
+    def close(self):
+        ''' Stop the workers and keep the variant cache within its budget '''
+        try:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+        except TypeError:
+            # cancel_futures is new in python 3.9
+            self.pool.shutdown(wait=True)
+        self._pending.clear()
+        self._sweep_folder()
+        self.store.touch(self.key, dir_size(self.folder))
+        self.store.sweep(keep=(self.key,))
+        print('Image proxy: {scaled} scaled, {cached} from cache, {original} served as is'.format(**self.stats))
+
+    def _sweep_folder(self):
+        # the book's own folder is kept within the budget too, dropping
+        # variants of edited images and old viewport sizes, least recently
+        # used first
+        variants = []
+        total = 0
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if name.endswith('.part') and st.st_mtime < time.time() - 60 * 60:
+                # left by a session that was killed
+                _remove(path)
+                continue
+            variants.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        variants.sort()
+        for mtime, size, path in variants:
+            if total <= self.budget:
+                break
+            if _remove(path):
+                total -= size
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Page counts and page start CFIs that Readium worked out for each spine
+# item, remembered between sessions. Entries are keyed by the content hash
+# of the spine item's document and by a layout key (viewport size plus the
+# reader settings that change pagination) which the viewer computes itself,
+# so editing one chapter or changing the font size only invalidates what it
+# actually affects. sigil_hooks.js reports pages as they are laid out and
+# uses the stored maps to jump to a book-wide page without laying out the
+# chapters before it.
+
+import os
+import time
+
+from bookinfo import book_key, spine_documents
+from bookcache import BookDigests
+from lrustore import LRUStore, read_json, write_json_atomic, dir_size
+
+LOCATIONS_NAME = 'locations.json'
+DEFAULT_BUDGET = 64 * 1024 * 1024
+# layouts remembered per book, the least recently used ones are dropped
+MAX_LAYOUTS = 8
+
+
+class LocationCache(object):
+
+    def __init__(self, cachedir, bookroot, key=None, budget=DEFAULT_BUDGET, digests=None):
+        ''' digests: the launch's bookcache.BookDigests for the book '''
+        self.store = LRUStore(cachedir, budget)
+        self.key = key or book_key(bookroot)
+        self.path = os.path.join(self.store.path(self.key), LOCATIONS_NAME)
+        data = read_json(self.path, {})
+        if not isinstance(data, dict):
+            data = {}
+        self.layouts = data.get('layouts', {})
+        self.dirty = False
+        spine = spine_documents(bookroot)
+        found = (digests or BookDigests(bookroot)).get(bookpath for idref, bookpath in spine)
+        # idref -> content hash of the document
+        self.hashes = {idref: found[bookpath] for idref, bookpath in spine if bookpath in found}
+
+    def viewer_data(self):
+        ''' {layout key: {idref: {'pages': n, 'cfis': {page index: cfi}}}} for the current spine '''
+        ans = {}
+        for layout, entry in self.layouts.items():
+            items = entry.get('items', {})
+            known = {idref: items[h] for idref, h in self.hashes.items() if h in items}
+            if known:
+                ans[layout] = known
+        return ans
+
+    def record(self, layout, idref, pages, index=None, cfi=None):
+        digest = self.hashes.get(idref)
+        if digest is None or not isinstance(pages, int) or pages < 1:
+            return
+        entry = self.layouts.setdefault(layout, {'items': {}})
+        entry['used'] = time.time()
+        item = entry['items'].get(digest)
+        if item is None or item.get('pages') != pages:
+            # a different page count means any page starts we had are stale
+            item = entry['items'][digest] = {'pages': pages, 'cfis': {}}
+            self.dirty = True
+        if cfi and isinstance(index, int) and 0 <= index < pages and item['cfis'].get(str(index)) != cfi:
+            item['cfis'][str(index)] = cfi
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            self.store.touch(self.key)
+            return
+        current = set(self.hashes.values())
+        # forget old versions of edited chapters and layouts nobody uses any more
+        for entry in self.layouts.values():
+            entry['items'] = {h: v for h, v in entry.get('items', {}).items() if h in current}
+        keep = sorted(self.layouts, key=lambda k: self.layouts[k].get('used', 0), reverse=True)[:MAX_LAYOUTS]
+        self.layouts = {k: self.layouts[k] for k in keep if self.layouts[k]['items']}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomic(self.path, {'layouts': self.layouts})
+        self.store.touch(self.key, dir_size(self.store.path(self.key)))
+        self.store.sweep(keep=(self.key,))
+        self.dirty = False
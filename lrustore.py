@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+import os
+import json
+import time
+import shutil
+import itertools
+
+INDEX_NAME = 'index.json'
+TRASH_PREFIX = '.trash-'
+HOLDS_FOLDER = '.holds'
+
+_hold_ids = itertools.count()
+
+
+def dir_size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def read_json(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+''' Write json so that readers only ever see the old or the new contents '''
+def write_json_atomic(path, data):
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _lock(f):
+    # raises OSError if another open file already holds the lock
+    if os.name == 'nt':
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+class Hold(object):
+
+    ''' Keeps a store's entry from being evicted, by this or any other
+        process, until released. The lock goes away with the process so
+        holds left behind by a crash are recognised and cleared. '''
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'wb')
+        _lock(self._file)
+
+    def release(self):
+        if self._file is None:
+            return
+        self._file.close()
+        self._file = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class LRUStore(object):
+
+    ''' A folder of cache entries, one sub-folder per key, kept under a total
+        size budget (in bytes) by evicting the least recently used entries.
+
+        The index only records sizes and last use times. Anything it does not
+        know about is adopted on the next sweep and entries are renamed out of
+        the way before being deleted, so a crash at any point leaves a store
+        the next sweep can repair. '''
+
+    def __init__(self, root, budget):
+        self.root = root
+        self.budget = budget
+        os.makedirs(root, exist_ok=True)
+        self._index_path = os.path.join(root, INDEX_NAME)
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def hold(self, key):
+        holds = os.path.join(self.root, HOLDS_FOLDER)
+        os.makedirs(holds, exist_ok=True)
+        return Hold(os.path.join(holds, '{}.{}-{}'.format(key, os.getpid(), next(_hold_ids))))
+
+    def held(self, key):
+        holds = os.path.join(self.root, HOLDS_FOLDER)
+        try:
+            names = os.listdir(holds)
+        except OSError:
+            return False
+        for name in names:
+            if not name.startswith(key + '.'):
+                continue
+            p = os.path.join(holds, name)
+            try:
+                with open(p, 'rb') as f:
+                    _lock(f)
+            except OSError:
+                return True
+            # nobody holds the lock any more
+            try:
+                os.remove(p)
+            except OSError:
+                return True
+        return False
+
+    def _load(self):
+        index = read_json(self._index_path, {})
+        return index if isinstance(index, dict) else {}
+
+    def touch(self, key, size=None):
+        index = self._load()
+        entry = index.get(key, {'size': 0})
+        entry['used'] = time.time()
+        if size is not None:
+            entry['size'] = size
+        index[key] = entry
+        write_json_atomic(self._index_path, index)
+
+    def _trash(self, key):
+        src = self.path(key)
+        if not os.path.isdir(src):
+            return
+        dst = os.path.join(self.root, TRASH_PREFIX + key + '-' + str(os.getpid()))
+        try:
+            os.replace(src, dst)
+        except OSError:
+            dst = src
+        shutil.rmtree(dst, ignore_errors=True)
+
+    def remove(self, key):
+        index = self._load()
+        index.pop(key, None)
+        self._trash(key)
+        write_json_atomic(self._index_path, index)
+
+    def sweep(self, keep=()):
+        ''' Enforce the budget, never evicting the keys in keep or held
+            by any process. Returns the list of evicted keys. '''
+        index = self._load()
+        for name in os.listdir(self.root):
+            p = os.path.join(self.root, name)
+            if name == HOLDS_FOLDER:
+                continue
+            elif name.startswith(TRASH_PREFIX):
+                # left behind by an eviction that was interrupted
+                shutil.rmtree(p, ignore_errors=True)
+            elif os.path.isdir(p) and name not in index:
+                index[name] = {'size': dir_size(p), 'used': os.path.getmtime(p)}
+        for key in list(index.keys()):
+            if not os.path.isdir(self.path(key)):
+                del index[key]
+        total = sum(e.get('size', 0) for e in index.values())
+        evicted = []
+        for key in sorted(index, key=lambda k: index[k].get('used', 0)):
+            if total <= self.budget:
+                break
+            if key in keep or self.held(key):
+                continue
+            total -= index[key].get('size', 0)
+            self._trash(key)
+            del index[key]
+            evicted.append(key)
+        write_json_atomic(self._index_path, index)
+        return evicted
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+import os
+import sys
+import time
+import errno
+import shutil
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+STRATEGIES = ('reflink', 'hardlink', 'copy')
+DEFAULT_STRATEGIES = STRATEGIES
+
+# errors that mean a strategy can never work for this source/destination pair
+_UNSUPPORTED = {errno.EXDEV, errno.EPERM, errno.EACCES, errno.EINVAL, errno.EMLINK,
+                getattr(errno, 'ENOTSUP', errno.EINVAL), getattr(errno, 'EOPNOTSUPP', errno.EINVAL),
+                getattr(errno, 'ENOTTY', errno.EINVAL), getattr(errno, 'ENOSYS', errno.EINVAL)}
+
+# linux FICLONE ioctl (btrfs, xfs, bcachefs ...)
+_FICLONE = 0x40049409
+_clonefile = None
+if sys.platform.startswith('darwin'):
+    try:
+        import ctypes
+        import ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _clonefile = _libc.clonefile
+        _clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32)
+    except (OSError, AttributeError):
+        _clonefile = None
+
+
+''' Make dest a copy-on-write clone of src '''
+def reflink(src, dest):
+    if _clonefile is not None:
+        if _clonefile(os.fsencode(src), os.fsencode(dest), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dest)
+        return
+    if not sys.platform.startswith('linux'):
+        raise OSError(errno.EOPNOTSUPP, 'reflinks not supported on this platform', dest)
+    import fcntl
+    with open(src, 'rb') as s, open(dest, 'wb') as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        except OSError:
+            d.close()
+            os.remove(dest)
+            raise
+
+
+def hardlink(src, dest):
+    os.link(src, dest)
+
+
+def copy(src, dest):
+    shutil.copyfile(src, dest)
+
+
+_PLACERS = {'reflink': reflink, 'hardlink': hardlink, 'copy': copy}
+
+
+class MaterializeReport(object):
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.strategies = dict((s, 0) for s in STRATEGIES)
+        self.errors = []
+
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.seconds if self.seconds else 0.0
+
+    def as_dict(self):
+        return {'files': self.files, 'bytes': self.bytes, 'seconds': self.seconds,
+                'files_per_second': self.files_per_second,
+                'bytes_per_second': self.bytes_per_second,
+                'strategies': dict(self.strategies), 'errors': len(self.errors)}
+
+    def __str__(self):
+        used = ', '.join('{} {}'.format(n, s) for s, n in self.strategies.items() if n)
+        return '{} files, {:.1f} MB in {:.3f}s ({:.0f} files/s, {:.1f} MB/s) [{}]'.format(
+            self.files, self.bytes / 1e6, self.seconds, self.files_per_second,
+            self.bytes_per_second / 1e6, used or 'nothing to do')
+
+
+class Materializer(object):
+
+    ''' Writes files out over a thread pool. Each file is placed with the first
+        of the given strategies that works: a copy-on-write reflink, a hardlink
+        or a plain copy. A strategy that fails because the filesystem does not
+        support it is not tried again for the rest of the run. '''
+
+    def __init__(self, strategies=DEFAULT_STRATEGIES, workers=None):
+        self.strategies = [s for s in strategies if s in _PLACERS] or ['copy']
+        self.workers = workers or min(32, (os.cpu_count() or 1) * 4)
+        self._disabled = set()
+        self._lock = threading.Lock()
+
+    def _place(self, src, dest):
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        # never leave a partial file under its real name
+        tmp = dest + '.part'
+        for strategy in self.strategies:
+            if strategy in self._disabled and strategy != 'copy':
+                continue
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            try:
+                _PLACERS[strategy](src, tmp)
+            except OSError as e:
+                if strategy == 'copy' or e.errno not in _UNSUPPORTED:
+                    raise
+                with self._lock:
+                    self._disabled.add(strategy)
+                continue
+            os.replace(tmp, dest)
+            return strategy
+        copy(src, tmp)
+        os.replace(tmp, dest)
+        return 'copy'
+
+    def place(self, src, dest):
+        ''' Write out a single file, returns the strategy used '''
+        return self._place(src, dest)
+
+    def materialize(self, pairs):
+        ''' pairs is an iterable of (src, dest) file paths '''
+        report = MaterializeReport()
+        start = time.perf_counter()
+
+        def work(pair):
+            src, dest = pair
+            size = os.path.getsize(src)
+            return self._place(src, dest), size
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [(pair, pool.submit(work, pair)) for pair in pairs]
+            for pair, fut in futures:
+                try:
+                    strategy, size = fut.result()
+                except OSError as e:
+                    report.errors.append((pair[0], str(e)))
+                    continue
+                report.files += 1
+                report.bytes += size
+                report.strategies[strategy] += 1
+        report.seconds = time.perf_counter() - start
+        return report
+
+
+def tree_pairs(srcdir, destdir):
+    for dirpath, dirs, files in os.walk(srcdir):
+        rel = os.path.relpath(dirpath, srcdir)
+        for name in files:
+            yield os.path.join(dirpath, name), os.path.normpath(os.path.join(destdir, rel, name))
+
+
+def materialize_tree(srcdir, destdir, strategies=DEFAULT_STRATEGIES, workers=None):
+    return Materializer(strategies, workers).materialize(tree_pairs(srcdir, destdir))
+
+
+# Compare strategies on a given filesystem, e.g.
+#   python materialize.py /path/to/unpacked/book /same/fs/scratch --strategy hardlink
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Materialize a folder and report throughput')
+    parser.add_argument('src')
+    parser.add_argument('dest')
+    parser.add_argument('-s', '--strategy', action='append', choices=STRATEGIES,
+                        help='strategy to try (repeat for fallbacks, default: all in order)')
+    parser.add_argument('-w', '--workers', type=int, default=None)
+    args = parser.parse_args(argv)
+    if os.path.exists(args.dest):
+        sys.exit('Destination must not exist')
+    report = materialize_tree(args.src, args.dest, args.strategy or DEFAULT_STRATEGIES, args.workers)
+    print(report)
+    for src, err in report.errors:
+        print('ERROR: {}: {}'.format(src, err), file=sys.stderr)
+    return 1 if report.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
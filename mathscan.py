@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Which spine documents of a book contain MathML, so that the viewer only
+# adds MathJax (1.8 MB of script to parse and run) to the documents that
+# have math to typeset and leaves it out of a book without any altogether.
+# The documents are scanned on a pool of threads and the answers are kept
+# per book by content hash, with the hashes taken from the launch's
+# bookcache.BookDigests, so reopening a book only reads the documents that
+# were edited.
+
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from bookinfo import book_key, spine_documents
+from bookcache import BookDigests
+from lrustore import LRUStore, read_json, write_json_atomic, dir_size
+
+MATHML_NAME = 'mathml.json'
+DEFAULT_BUDGET = 4 * 1024 * 1024
+DEFAULT_WORKERS = max(1, min(8, os.cpu_count() or 2))
+
+_comment_pattern = re.compile(br'<!--.*?-->', re.DOTALL)
+# a math element, prefixed or not, but not <mathematics> or the like
+_math_pattern = re.compile(br'<(?:[A-Za-z_][\w.-]*:)?math[\s/>]')
+
+
+def has_mathml(data):
+    if b'math' not in data:
+        return False
+    return _math_pattern.search(_comment_pattern.sub(b'', data)) is not None
+
+
+def scan_file(path):
+    with open(path, 'rb') as f:
+        return has_mathml(f.read())
+
+
+class MathScan(object):
+
+    def __init__(self, cachedir, budget=DEFAULT_BUDGET, workers=DEFAULT_WORKERS):
+        self.store = LRUStore(cachedir, budget)
+        self.workers = max(1, workers)
+        self.stats = {'documents': 0, 'scanned': 0}
+
+    def scan(self, bookroot, key=None, digests=None):
+        ''' {'book': True if any spine document has MathML,
+            'complete': False if some could not be scanned,
+            'items': {bookpath: has MathML}} for the spine of the book,
+            documents that could not be scanned are left out of items.
+            digests: the launch's bookcache.BookDigests for the book '''
+        key = key or book_key(bookroot)
+        path = os.path.join(self.store.path(key), MATHML_NAME)
+        cached = read_json(path, {})
+        if not isinstance(cached, dict):
+            cached = {}
+        known = cached.get('results') or {}
+        spine = set(bookpath for idref, bookpath in spine_documents(bookroot))
+        found = (digests or BookDigests(bookroot)).get(spine)
+        results = {digest: known[digest] for digest in found.values() if digest in known}
+        todo = {}
+        for bookpath, digest in found.items():
+            if digest not in results:
+                todo.setdefault(digest, bookpath)
+        self.stats['documents'] = len(found)
+        self.stats['scanned'] = len(todo)
+        if todo:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(todo)), thread_name_prefix='math-scan') as pool:
+                answers = pool.map(lambda bookpath: self._scan_one(bookroot, bookpath), todo.values())
+                for digest, answer in zip(todo, answers):
+                    if answer is not None:
+                        results[digest] = answer
+        items = {bookpath: results[digest] for bookpath, digest in found.items() if digest in results}
+        if todo or results != known:
+            os.makedirs(self.store.path(key), exist_ok=True)
+            write_json_atomic(path, {'results': results})
+            self.store.touch(key, dir_size(self.store.path(key)))
+            self.store.sweep(keep=(key,))
+        else:
+            self.store.touch(key)
+        return {'book': any(items.values()), 'complete': len(items) == len(spine), 'items': items}
+
+    @staticmethod
+    def _scan_one(bookroot, bookpath):
+        try:
+            return scan_file(os.path.join(bookroot, *bookpath.split('/')))
+        except OSError:
+            return None
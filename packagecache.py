@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# The manifest, spine and toc of a book worked out in python and handed to
+# the viewer, so Readium does not have to walk the OPF and ncx with jQuery on
+# every open (which takes a while for books with thousands of items). The
+# result is remembered per book and reused for as long as the OPF and the toc
+# document hash the same, with the hashes taken from the launch's
+# bookcache.BookDigests.
+
+import os
+
+from bookinfo import book_key, find_opf_bookpath, package_document, ncx_toc, nav_toc
+from bookcache import BookDigests
+from lrustore import LRUStore, read_json, write_json_atomic, dir_size
+
+PACKAGE_NAME = 'package.json'
+DEFAULT_BUDGET = 32 * 1024 * 1024
+# bump whenever the shape of the data handed to the viewer changes
+FORMAT = 2
+
+
+class PackageCache(object):
+
+    def __init__(self, cachedir, budget=DEFAULT_BUDGET):
+        self.store = LRUStore(cachedir, budget)
+
+    def load(self, bookroot, key=None, digests=None):
+        ''' {'opf', 'manifest', 'spine', 'page_progression_direction', 'toc',
+            'toc_source', 'toc_items'} for the book, None if it can not be worked out '''
+        opfbookpath = find_opf_bookpath(bookroot)
+        if not opfbookpath:
+            return None
+        key = key or book_key(bookroot)
+        digests = digests or BookDigests(bookroot)
+        path = os.path.join(self.store.path(key), PACKAGE_NAME)
+        cached = read_json(path, {})
+        if not isinstance(cached, dict) or cached.get('format') != FORMAT:
+            cached = {}
+        old = cached.get('files') or {}
+        data = cached.get('data')
+        if data and old and data.get('opf') == opfbookpath and digests.get(old) == old:
+            self.store.touch(key)
+            return data
+
+        data = package_document(os.path.join(bookroot, *opfbookpath.split('/')), opfbookpath)
+        if data is None:
+            return None
+        data['opf'] = opfbookpath
+        bookpaths = [opfbookpath]
+        data['toc_source'] = None
+        data['toc_items'] = None
+        if data['toc']:
+            toc_path = os.path.join(bookroot, *data['toc'].split('/'))
+            if data['toc'].lower().endswith('.ncx'):
+                data['toc_source'], data['toc_items'] = 'ncx', ncx_toc(toc_path)
+            else:
+                data['toc_source'], data['toc_items'] = 'nav', nav_toc(toc_path)
+            if os.path.isfile(toc_path):
+                bookpaths.append(data['toc'])
+        files = digests.get(bookpaths)
+        if len(files) == len(bookpaths):
+            os.makedirs(self.store.path(key), exist_ok=True)
+            write_json_atomic(path, {'format': FORMAT, 'files': files, 'data': data})
+            self.store.touch(key, dir_size(self.store.path(key)))
+            self.store.sweep(keep=(key,))
+        return data
@@ -11,41 +11,183 @@
 
 import sys
 import os
+import json
 import argparse
 import tempfile, shutil
 import inspect
+from concurrent.futures import ThreadPoolExecutor
 
 from plugin_utils import QtCore, QtWidgets
 from plugin_utils import QtWebEngineWidgets
 from plugin_utils import QWebEnginePage, QWebEngineProfile, QWebEngineScript, QWebEngineSettings
-from plugin_utils import PluginApplication, iswindows, ismacos
+from plugin_utils import PluginApplication, Signal, iswindows, ismacos
+
+import bookserver
+import bookcache
+import bookinfo
+import lrustore
+import consolelog
+import requestpolicy
+import materialize
+import startup_timing
+# the modules behind optional features (resident_reader, searchindex,
+# imageproxy, locationcache, packagecache, mathscan) and the Qt modules
+# they need are only imported when the feature is switched on
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
 
 
+def plugin_prefs_folder(bk):
+    return os.path.dirname(bk._w.plugin_dir) + '/plugins_prefs/' + bk._w.plugin_name
+
+
+def book_cache(bk, prefs, materializer):
+    return bookcache.BookCache(os.path.join(plugin_prefs_folder(bk), 'book-cache'),
+                               prefs['book_cache_budget_mb'] * 1024 * 1024, materializer)
+
+
+''' The .epub file Sigil opened the book from, its book folder for a book
+    that has never been saved (or a Sigil that does not say) '''
+def book_origin(bk):
+    return getattr(bk._w, 'epub_filepath', None) or bk._w.ebook_root
+
+
+''' Key of this copy of the book in the book cache, other editions with the
+    same identifier get a copy (and a resident reader window) of their own '''
+def book_cache_key(bk):
+    return bookinfo.edition_key(bk._w.ebook_root, book_origin(bk))
+
+
+# seconds to wait on exit for a background book cache sync
+SYNC_JOIN_TIMEOUT = 60
+
+
+''' Bring the persistent copy of the book up to date and return (name, folder) '''
+def sync_book_cache(bk, prefs, materializer):
+    cache = book_cache(bk, prefs, materializer)
+    # a stable name also lets Readium find its saved reading position again
+    book_name, book_root, stats = cache.sync(bk._w.ebook_root, key=book_cache_key(bk))
+    cache.sweep(keep=(book_name,))
+    print('Book cache: {copied} of {files} files copied, {removed} removed'.format(**stats))
+    if stats['copied']:
+        print('Materialized: {}'.format(stats['materialize']))
+    return book_name, book_root
+
+
+''' The viewer's per-book data that is keyed on file contents: the location
+    cache, the package manifest and the MathML scan. They share one
+    bookcache.BookDigests so every file is hashed at most once, and this
+    runs on a background thread while the window opens, timing itself with
+    a child of the launch's timer (see MainWindow.set_book_data). '''
+def load_book_data(prefs, pfolder, bookroot, key, digests, timer):
+    locations = None
+    if prefs['location_cache']:
+        import locationcache
+        with timer.phase('location_cache'):
+            locations = locationcache.LocationCache(os.path.join(pfolder, 'locations'), bookroot, key=key,
+                                                    budget=prefs['location_cache_budget_mb'] * 1024 * 1024,
+                                                    digests=digests)
+
+    package = None
+    if prefs['package_manifest']:
+        import packagecache
+        with timer.phase('package_manifest'):
+            package = packagecache.PackageCache(os.path.join(pfolder, 'packages')).load(
+                bookroot, key=key, digests=digests)
+
+    mathml = None
+    if prefs['mathml_scan']:
+        import mathscan
+        with timer.phase('mathml_scan'):
+            scan = mathscan.MathScan(os.path.join(pfolder, 'mathml'),
+                                     workers=prefs['mathml_scan_workers'] or mathscan.DEFAULT_WORKERS)
+            mathml = scan.scan(bookroot, key=key, digests=digests)
+        timer.info['mathml'] = dict(scan.stats, book=mathml['book'])
+    return locations, package, mathml, timer
+
+
+def request_policy(prefs):
+    try:
+        return requestpolicy.RequestPolicy.from_prefs(prefs)
+    except KeyError:
+        return None
+
+
+BOOK_STORAGE_FOLDER = 'book-storage'
+
+
+def book_storage(pfolder, budget_mb):
+    return lrustore.LRUStore(os.path.join(pfolder, BOOK_STORAGE_FOLDER), budget_mb * 1024 * 1024)
+
+
+''' Record the size of a book's storage partition once it is closed and
+    evict the partitions of the least recently opened books over budget.
+    Partitions in keep, or held open by any process, are never evicted. '''
+def sweep_book_storage(pfolder, storage_key, budget_mb, keep=()):
+    store = book_storage(pfolder, budget_mb)
+    store.touch(storage_key, lrustore.dir_size(store.path(storage_key)))
+    evicted = store.sweep(keep=(storage_key,) + tuple(keep))
+    if evicted:
+        print('Book storage: removed {} least recently opened books'.format(len(evicted)))
+
+
+# console messages starting with this come from viewer/cloud-reader-lite/scripts/sigil_hooks.js
+READER_EVENT_PREFIX = '__sigil_event__:'
+
+
+class ReaderApplication(PluginApplication):
+
+    ''' PluginApplication that times the parts of its setup '''
+
+    def __init__(self, args, bk, timer=None, **kwargs):
+        self._timer = timer or startup_timing.PhaseTimer()
+        with self._timer.phase('app_init'):
+            PluginApplication.__init__(self, args, bk, **kwargs)
+
+    def match_sigil_highdpi(self):
+        with self._timer.phase('app_highdpi'):
+            PluginApplication.match_sigil_highdpi(self)
+
+    def load_base_qt_translations(self):
+        with self._timer.phase('app_qt_translations'):
+            PluginApplication.load_base_qt_translations(self)
+
+    def load_plugin_translations(self, trans_folder):
+        with self._timer.phase('app_plugin_translations'):
+            PluginApplication.load_plugin_translations(self, trans_folder)
+
+    def match_sigil_font(self):
+        with self._timer.phase('app_font_matching'):
+            PluginApplication.match_sigil_font(self)
+
+
 class WebPage(QWebEnginePage):
 
-    def __init__(self, profile, parent=None):
+    # name, json payload
+    readerEvent = Signal(str, str)
+
+    def __init__(self, profile, parent=None, console=None):
        QWebEnginePage.__init__(self, profile, parent)
+       # deduplicated, rate limited and written out off the GUI thread
+       self.console = console if console is not None else consolelog.ConsoleLog(parent=self)
 
     def javaScriptConsoleMessage(self, level, msg, linenumber, source_id):
+        if msg.startswith(READER_EVENT_PREFIX):
+            name, _, payload = msg[len(READER_EVENT_PREFIX):].partition(':')
+            self.readerEvent.emit(name, payload)
+            return
         prefix = {
             QWebEnginePage.JavaScriptConsoleMessageLevel.InfoMessageLevel: 'INFO',
             QWebEnginePage.JavaScriptConsoleMessageLevel.WarningMessageLevel: 'WARNING'
         }.get(level, 'ERROR')
-        if prefix in ('ERROR') and not 'ResizeObserver loop limit exceeded' in msg:
-            try:
-                print('%s: %s:%s: %s' % (prefix, source_id, linenumber, msg), file=sys.stderr)
-                sys.stderr.flush()
-            except EnvironmentError:
-                pass
+        self.console.message(prefix, msg, linenumber, source_id)
             
     def acceptNavigationRequest(self, url, req_type, is_main_frame):
         if req_type == QWebEnginePage.NavigationType.NavigationTypeReload:
             return True
         if req_type == QWebEnginePage.NavigationType.NavigationTypeBackForward:
             return True
-        if url.scheme() in ('data', 'file', 'blob'):
+        if url.scheme() in ('data', 'file', 'blob', bookserver.SCHEME_NAME):
             return True
         if url.scheme() in ('http', 'https') and req_type == QWebEnginePage.NavigationType.NavigationTypeLinkClicked:
             print('Blocking external navigation request to: ', url.toString())
@@ -54,28 +196,57 @@ class WebPage(QWebEnginePage):
         return False
 
 
+def create_profile(pfolder, scheme_handler=None, parent=None, storage_key=None, request_policy=None):
+    if storage_key is not None:
+        # every book gets its own storage partition so that opening one only
+        # loads that book's Readium bookmarks and settings
+        localstorepath = os.path.join(pfolder, BOOK_STORAGE_FOLDER, storage_key)
+        profile_name = 'ReadiumReaderSigil-' + storage_key
+    else:
+        localstorepath = pfolder + '/local-storage'
+        profile_name = 'ReadiumReaderSigilPluginSettings'
+    if not os.path.exists(localstorepath):
+        try:
+            os.makedirs(localstorepath, 0o700)
+        except FileExistsError:
+            # directory already exists
+            pass
+    print(localstorepath)
+    profile = QWebEngineProfile(profile_name, parent)
+    # Set HTTP Cache type to memory only
+    profile.setHttpCacheType(QWebEngineProfile.MemoryHttpCache)
+    # Serve the viewer and the book through our own url scheme if asked to
+    if scheme_handler is not None:
+        profile.installUrlSchemeHandler(QtCore.QByteArray(bookserver.SCHEME_NAME.encode('ascii')), scheme_handler)
+    # Fail requests to remote hosts right away instead of waiting on them
+    if request_policy is not None:
+        profile.request_interceptor = requestpolicy.install(profile, request_policy)
+    # Save Readium prefs to plugin prefs
+    profile.setPersistentStoragePath(localstorepath)
+    print(profile.isOffTheRecord())
+    print(profile.cachePath())  # Verify that nothing gets written here
+    print(profile.httpCacheType())
+    print(profile.persistentStoragePath())
+    return profile
+
+
 class WebView(QtWebEngineWidgets.QWebEngineView):
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, scheme_handler=None, profile=None, pfolder=None, storage_key=None, console=None,
+                 request_policy=None):
         QtWebEngineWidgets.QWebEngineView.__init__(self, parent)
-        app = PluginApplication.instance()
-        # Plugin prefs folder
-        pfolder = os.path.dirname(app.bk._w.plugin_dir) + '/plugins_prefs/' + app.bk._w.plugin_name
-        localstorepath = pfolder + '/local-storage'
-        if not os.path.exists(localstorepath):
-            try:
-                os.makedirs(localstorepath, 0o700)
-            except FileExistsError:
-                # directory already exists
-                pass
-        print(localstorepath)
+        app = QtWidgets.QApplication.instance()
         w = app.primaryScreen().availableGeometry().width()
         self._size_hint = QtCore.QSize(int(w/3), int(w/2))
-        # How to get bookid to add to QWebEngineProfile name?
-        self._profile = QWebEngineProfile('ReadiumReaderSigilPluginSettings')
-        # Set HTTP Cache type to memory only
-        self._profile.setHttpCacheType(QWebEngineProfile.MemoryHttpCache)
-        self._page = WebPage(self._profile, self)
+        # A profile can be shared between views (see resident_reader.py),
+        # otherwise each view gets its own one
+        if profile is None:
+            # Plugin prefs folder
+            if pfolder is None:
+                pfolder = plugin_prefs_folder(app.bk)
+            profile = create_profile(pfolder, scheme_handler, storage_key=storage_key, request_policy=request_policy)
+        self._profile = profile
+        self._page = WebPage(self._profile, self, console=console)
         self.setPage(self._page)
         # Set this View's page settings
         s = self.settings()
@@ -84,12 +255,6 @@ class WebView(QtWebEngineWidgets.QWebEngineView):
         s.setAttribute(QWebEngineSettings.WebAttribute.JavascriptCanAccessClipboard, True)
         s.setAttribute(QWebEngineSettings.WebAttribute.LocalContentCanAccessFileUrls, True)
         s.setAttribute(QWebEngineSettings.WebAttribute.AllowWindowActivationFromJavaScript, True)
-        # Save Readium prefs to plugin prefs
-        self._page.profile().setPersistentStoragePath(localstorepath)
-        print(self._page.profile().isOffTheRecord())
-        print(self._page.profile().cachePath())  # Verify that nothing gets written here
-        print(self._page.profile().httpCacheType())
-        print(self._page.profile().persistentStoragePath())
 
     def sizeHint(self):
         return self._size_hint
@@ -98,18 +263,38 @@ class WebView(QtWebEngineWidgets.QWebEngineView):
     
 class MainWindow(QtWidgets.QMainWindow):
 
+    # the future of a load_book_data() call, emitted on whichever thread
+    # finishes it and delivered to set_book_data() on the GUI thread
+    bookDataReady = Signal(object)
+
     # constructor
-    def __init__(self, query, prefs, *args, **kwargs):
+    def __init__(self, query, prefs, *args, scheme_handler=None, profile=None, pfolder=None, timer=None,
+                 storage_key=None, locations=None, search=None, images=None, console=None, package=None,
+                 mathml=None, embedded=False, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         
         self.query = query
         self.prefs = prefs
+        self.timer = timer
+        self.locations = locations
+        self.images = images
+        # a tab of readertabs.ReaderTabs rather than a window of its own
+        self.embedded = embedded
         
         # creating a QWebEngineView
-        self.browser = WebView()
+        self.browser = WebView(scheme_handler=scheme_handler, profile=profile, pfolder=pfolder,
+                               storage_key=storage_key, console=console, request_policy=request_policy(prefs))
 
         # adding action when loading is finished
         self.browser.loadFinished.connect(self.update_title)
+        self.browser.page().readerEvent.connect(self.reader_event)
+        if self.timer is not None:
+            self.browser.loadFinished.connect(lambda ok: self.timer.mark('load_finished', ok=ok))
+        self.bookDataReady.connect(self.set_book_data)
+        self.inject_book_data(locations, package, mathml)
+        self.channel = None
+        if search is not None:
+            self.publish_search(search)
 
         # creating QToolBar for navigation and add close button
         # navtb = QToolBar("Navigation")
@@ -120,16 +305,20 @@ class MainWindow(QtWidgets.QMainWindow):
         # navtb.addAction(done_btn)
         
         # build url to launch readium with
-        readerpath = os.path.join(SCRIPT_DIR,'viewer','cloud-reader-lite','index.html')
-        bookurl = QtCore.QUrl.fromLocalFile(readerpath)
-        bookurl.setQuery(self.query)
+        if scheme_handler is not None:
+            bookurl = scheme_handler.reader_url(self.query)
+        else:
+            readerpath = os.path.join(SCRIPT_DIR,'viewer','cloud-reader-lite','index.html')
+            bookurl = QtCore.QUrl.fromLocalFile(readerpath)
+            bookurl.setQuery(self.query)
         self.browser.setUrl(bookurl)
 
         # set this browser as central widget or main window
         self.setCentralWidget(self.browser)
 
-        self.readsettings()
-        self.show()
+        if not self.embedded:
+            self.readsettings()
+            self.show()
 
     def readsettings(self):
         b64val = self.prefs.get('geometry', None)
@@ -144,16 +333,113 @@ class MainWindow(QtWidgets.QMainWindow):
         width =    self.browser.width()
         self.setWindowTitle('Screen Size:'  +  ' (%dx%d)' % (width, height))
 
+    def inject_global(self, name, var, data):
+        # has to be in place before Readium starts, sigil_hooks.js picks it up
+        script = QWebEngineScript()
+        script.setName(name)
+        script.setSourceCode('window.{} = {};'.format(var, json.dumps(data)))
+        script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentCreation)
+        script.setWorldId(QWebEngineScript.ScriptWorldId.MainWorld)
+        script.setRunsOnSubFrames(False)
+        self.browser.page().scripts().insert(script)
+
+    def inject_book_data(self, locations, package, mathml):
+        ''' Returns the globals set, as {name: data} '''
+        globals_ = {}
+        if locations is not None:
+            globals_['__sigilLocations'] = locations.viewer_data()
+            self.inject_global('sigil-locations', '__sigilLocations', globals_['__sigilLocations'])
+        if package is not None:
+            globals_['__sigilPackage'] = package
+            self.inject_global('sigil-package', '__sigilPackage', package)
+        if mathml is not None:
+            globals_['__sigilMathML'] = mathml
+            self.inject_global('sigil-mathml', '__sigilMathML', mathml)
+        return globals_
+
+    def set_book_data(self, future):
+        try:
+            locations, package, mathml, timer = future.result()
+        except Exception as e:
+            print('Book data is not available: {}'.format(e))
+            return
+        if self.timer is not None:
+            self.timer.merge(timer)
+            self.timer.mark('book_data')
+        self.locations = locations
+        # the scripts only cover later loads of the viewer, the one already
+        # running gets the globals now and sigil_hooks.js whatever it still can use
+        globals_ = self.inject_book_data(locations, package, mathml)
+        source = ''.join('window.{} = {};'.format(var, json.dumps(data)) for var, data in globals_.items())
+        source += 'if (window.SigilReader) { SigilReader.setBookData(); }'
+        self.browser.page().runJavaScript(source)
+
+    def publish_search(self, index):
+        import searchindex
+        from plugin_utils import QtWebChannel
+        self.search_bridge = searchindex.SearchBridge(index, self)
+        self.channel = QtWebChannel.QWebChannel(self.browser.page())
+        self.channel.registerObject('search', self.search_bridge)
+        self.browser.page().setWebChannel(self.channel)
+        f = QtCore.QFile(':/qtwebchannel/qwebchannel.js')
+        if not f.open(QtCore.QIODevice.OpenModeFlag.ReadOnly):
+            print('qwebchannel.js is missing, search is not available in the viewer')
+            return
+        source = bytes(f.readAll()).decode('utf-8')
+        f.close()
+        # sigil_hooks.js wraps this up as SigilReader.search()
+        source += '''
+            new QWebChannel(qt.webChannelTransport, function (channel) {
+                window.SigilSearch = channel.objects.search;
+            });'''
+        script = QWebEngineScript()
+        script.setName('sigil-search')
+        script.setSourceCode(source)
+        script.setInjectionPoint(QWebEngineScript.InjectionPoint.DocumentReady)
+        script.setWorldId(QWebEngineScript.ScriptWorldId.MainWorld)
+        script.setRunsOnSubFrames(False)
+        self.browser.page().scripts().insert(script)
+
+    def reader_event(self, name, payload):
+        if name == 'location' and self.locations is not None:
+            try:
+                data = json.loads(payload)
+                self.locations.record(data['layout'], data['idref'], data['pages'], data.get('index'), data.get('cfi'))
+            except (ValueError, KeyError):
+                pass
+            return
+        if self.timer is None:
+            return
+        if name == 'first-render':
+            try:
+                data = json.loads(payload)
+            except ValueError:
+                data = {}
+            self.timer.mark('first_render', idref=data.get('idref'), page_ms=data.get('t'))
+            self.timer.emit()
+        elif name == 'reader-ready':
+            self.timer.mark('reader_ready')
+
     def done(self):
         self.close()
 
     def resizeEvent(self, ev):
         QtWidgets.QMainWindow.resizeEvent(self, ev)
         self.update_title()
+        if self.images is not None:
+            # images are scaled for the device pixels the view covers
+            self.images.set_viewport(self.browser.width(), self.browser.height(), self.browser.devicePixelRatioF())
 
     def closeEvent(self, ev):
-        b64val = str(self.saveGeometry().toBase64(), 'ascii')
-        self.prefs['geometry'] = b64val
+        if not self.embedded:
+            b64val = str(self.saveGeometry().toBase64(), 'ascii')
+            self.prefs['geometry'] = b64val
+        if self.locations is not None:
+            self.locations.save()
+        self.browser.page().console.close()
+        interceptor = getattr(self.browser.page().profile(), 'request_interceptor', None)
+        if interceptor is not None:
+            interceptor.report()
         QtWidgets.QMainWindow.closeEvent(self, ev)
 
 
@@ -164,26 +450,180 @@ def run(bk):
         print("\nThis plugin requires Sigil-1.6.0 or later to function.")
         return -1
     
+    timer = startup_timing.PhaseTimer.from_env(plugin_prefs_folder(bk))
+
     # get users preferences and set defaults for width of images in gui (in pixels)
     prefs = bk.getPrefs()
+    # 'scheme' streams the book to Readium straight from Sigil's copy of it,
+    # 'cache' streams it from a persistent per-book copy kept in the plugin prefs folder,
+    # 'copy' writes the whole book out under epub_content first
+    prefs.defaults['book_serving'] = 'scheme'
+    prefs.defaults['book_cache_budget_mb'] = bookcache.DEFAULT_BUDGET // (1024 * 1024)
+    # with 'cache', only bring the files needed for the first page up to date
+    # before opening and sync the rest in the background
+    prefs.defaults['progressive_open'] = True
+    # ways to write book files out, tried in order: 'reflink', 'hardlink', 'copy'
+    prefs.defaults['materialize_strategies'] = list(materialize.DEFAULT_STRATEGIES)
+    materializer = materialize.Materializer(prefs['materialize_strategies'])
+
+    # give every book its own web storage, keeping at most storage_budget_mb
+    # of it around for the most recently opened books
+    prefs.defaults['storage_partitions'] = True
+    prefs.defaults['storage_budget_mb'] = 256
+    book_id = bookinfo.book_key(bk._w.ebook_root, book_origin(bk))
+    storage_key = book_id if prefs['storage_partitions'] else None
+
+    # remember Readium's page counts and page start cfis between sessions
+    prefs.defaults['location_cache'] = True
+    prefs.defaults['location_cache_budget_mb'] = 64
+    # work out the manifest, spine and ncx toc in python (remembered per book)
+    # instead of having Readium walk the OPF with jQuery on every open
+    prefs.defaults['package_manifest'] = True
+    # scan the spine for MathML so that the viewer only adds MathJax to
+    # the documents that have some, Readium's own check of each document
+    # does for the rest (and for everything while this is off)
+    prefs.defaults['mathml_scan'] = False
+    # 0 for as many as make sense on this machine
+    prefs.defaults['mathml_scan_workers'] = 0
+    # full-text search of the spine for the viewer through a QWebChannel
+    prefs.defaults['search_index'] = True
+    # serve images larger than the reader window scaled down to its size,
+    # for comics and photo books (only when the book is served by scheme)
+    prefs.defaults['image_proxy'] = False
+    prefs.defaults['image_proxy_budget_mb'] = 256
+    # 0 for as many as make sense on this machine
+    prefs.defaults['image_proxy_workers'] = 0
+    # the viewer's console: lowest level shown ('INFO', 'WARNING' or 'ERROR'),
+    # messages never shown, new messages shown per second and whether to
+    # write console-report.json to the plugin prefs folder on close
+    prefs.defaults['console_level'] = 'ERROR'
+    prefs.defaults['console_suppress'] = list(consolelog.DEFAULT_SUPPRESS)
+    prefs.defaults['console_rate'] = consolelog.DEFAULT_RATE
+    prefs.defaults['console_report'] = False
+    # requests to remote hosts: 'block' or 'allow' (the deny lists still
+    # apply), hosts match their subdomains too and paths are url path prefixes
+    prefs.defaults['remote_requests'] = 'block'
+    prefs.defaults['request_allow_hosts'] = []
+    prefs.defaults['request_deny_hosts'] = list(requestpolicy.DEFAULT_DENY_HOSTS)
+    prefs.defaults['request_deny_paths'] = []
+
+    # keep a reader process running after its window closes and hand it
+    # the next book instead of starting Qt and Chromium from scratch
+    prefs.defaults['resident_reader'] = False
+    prefs.defaults['resident_idle_minutes'] = 30
+    prefs.defaults['resident_memory_mb'] = 1536
+    # open the books handed to the resident reader as tabs of one window,
+    # background tabs are frozen and later discarded after so many idle
+    # minutes (0 never) and at most resident_tabs_live of them keep a renderer
+    prefs.defaults['resident_tabs'] = False
+    prefs.defaults['resident_tabs_freeze_minutes'] = 5
+    prefs.defaults['resident_tabs_discard_minutes'] = 30
+    prefs.defaults['resident_tabs_live'] = 4
 
-    # create your own current copy of all ebook contents in destination directory
-    # it must be relative and under the index.html directory inside an epub_content directory
     viewer_home = os.path.join(SCRIPT_DIR, 'viewer', 'cloud-reader-lite')
-    epub_home = os.path.join(viewer_home, 'epub_content')
-    os.makedirs(epub_home, exist_ok = True)
 
-    bookdir = tempfile.mkdtemp(suffix=None, prefix=None, dir=epub_home)
-    bookdir_name = os.path.split(bookdir)[-1]
-
-    bk.copy_book_contents_to(bookdir)
-    data = 'application/epub+zip'
-    mpath = os.path.join(bookdir, 'mimetype')
-    with open(mpath, 'wb') as f:
-        f.write(data.encode('utf-8'))
-        f.close()
-        
-    query = 'epub=epub_content/' +  bookdir_name + '/'
+    if prefs['resident_reader'] and bookserver.scheme_supported():
+        import resident_reader
+        # the resident reader outlives Sigil's temp folder so it always reads from the book cache
+        with timer.phase('book_prepare'):
+            book_name, book_root = sync_book_cache(bk, prefs, materializer)
+        request = {
+            'name': book_name,
+            'book_root': book_root,
+            'origin': book_origin(bk),
+            'viewer_home': viewer_home,
+            'pfolder': plugin_prefs_folder(bk),
+            'icon': os.path.join(bk._w.plugin_dir, bk._w.plugin_name, 'plugin.svg'),
+            'highdpi': getattr(bk._w, 'highdpi', 'detect'),
+            'idle_minutes': prefs['resident_idle_minutes'],
+            'memory_mb': prefs['resident_memory_mb'],
+            'storage_key': storage_key,
+            'storage_budget_mb': prefs['storage_budget_mb'],
+            'tabs': prefs['resident_tabs'],
+            'tabs_freeze_minutes': prefs['resident_tabs_freeze_minutes'],
+            'tabs_discard_minutes': prefs['resident_tabs_discard_minutes'],
+            'tabs_live': prefs['resident_tabs_live'],
+            'request_policy': [prefs['remote_requests'], prefs['request_allow_hosts'],
+                               prefs['request_deny_hosts'], prefs['request_deny_paths']],
+        }
+        with timer.phase('handoff'):
+            handed_off = resident_reader.hand_off(request)
+        if handed_off:
+            print('Book handed off to the running Readium Reader')
+        else:
+            with timer.phase('spawn_resident'):
+                resident_reader.spawn(request)
+            print('Started a resident Readium Reader')
+        timer.info['mode'] = 'resident'
+        timer.emit()
+        bk.savePrefs(prefs)
+        return 0
+
+    if storage_key is not None:
+        # so that no other reader sweeps this partition away while it is open
+        storage_hold = book_storage(plugin_prefs_folder(bk), prefs['storage_budget_mb']).hold(storage_key)
+
+    serving = prefs['book_serving']
+    use_scheme = serving in ('scheme', 'cache') and bookserver.scheme_supported()
+
+    bookdir = None
+    sync = None
+    with timer.phase('book_prepare'):
+        if use_scheme:
+            # the scheme has to be known before the QApplication is created
+            bookserver.register_reader_scheme()
+            if serving == 'cache' and prefs['progressive_open']:
+                sync = book_cache(bk, prefs, materializer).start_sync(bk._w.ebook_root,
+                                                                      bookinfo.opening_files(bk._w.ebook_root),
+                                                                      key=book_cache_key(bk))
+                book_name, book_root = sync.key, sync.bookdir
+            elif serving == 'cache':
+                book_name, book_root = sync_book_cache(bk, prefs, materializer)
+            else:
+                book_name = 'book' + os.urandom(4).hex()
+                book_root = bk._w.ebook_root
+            query = bookserver.book_query(book_name)
+        else:
+            # create your own current copy of all ebook contents in destination directory
+            # it must be relative and under the index.html directory inside an epub_content directory
+            epub_home = os.path.join(viewer_home, 'epub_content')
+            os.makedirs(epub_home, exist_ok = True)
+            bookcache.remove_stale_tempdirs(epub_home)
+
+            bookdir = tempfile.mkdtemp(suffix=None, prefix=None, dir=epub_home)
+            bookdir_name = os.path.split(bookdir)[-1]
+
+            # Sigil has already written the current book out to ebook_root so link or
+            # clone its files where the filesystem allows instead of copying every byte
+            report = materializer.materialize(materialize.tree_pairs(bk._w.ebook_root, bookdir))
+            print('Materialized: {}'.format(report))
+            if report.errors:
+                bk.copy_book_contents_to(bookdir)
+            data = 'application/epub+zip'
+            mpath = os.path.join(bookdir, 'mimetype')
+            # never write through a hardlink back into Sigil's own files
+            if not os.path.exists(mpath):
+                with open(mpath, 'wb') as f:
+                    f.write(data.encode('utf-8'))
+                    f.close()
+
+            query = 'epub=epub_content/' +  bookdir_name + '/'
+
+    # hashes from this launch's sync where there is one, Sigil's copy of the
+    # book gets new mtimes on every launch so earlier hashes can't be trusted
+    if sync is not None:
+        digests = bookcache.BookDigests(bk._w.ebook_root, sync=sync)
+    elif use_scheme and serving == 'cache':
+        digests = bookcache.BookDigests(bk._w.ebook_root,
+                                        manifest=book_cache(bk, prefs, materializer).manifest(book_name))
+    else:
+        digests = bookcache.BookDigests(bk._w.ebook_root)
+    book_data = None
+    if prefs['location_cache'] or prefs['package_manifest'] or prefs['mathml_scan']:
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='book-data')
+        book_data = pool.submit(load_book_data, prefs, plugin_prefs_folder(bk), bk._w.ebook_root, book_id,
+                                digests, timer.child())
+        pool.shutdown(wait=False)
 
     '''
     if not ismacos:
@@ -191,28 +631,88 @@ def run(bk):
     '''
     icon = os.path.join(bk._w.plugin_dir, bk._w.plugin_name, 'plugin.svg')
     # creating a python qt application
-    app = PluginApplication(sys.argv, bk, app_icon=icon)
+    app = ReaderApplication(sys.argv, bk, timer=timer, app_icon=icon)
+    timer.info['qt'] = QtCore.qVersion()
+    timer.info['mode'] = serving if use_scheme else 'copy'
 
     # setting name to the application
     app.setApplicationName("Readium Cloud Reader Lite Demo")
 
+    scheme_handler = None
+    images = None
+    if use_scheme:
+        scheme_handler = bookserver.BookSchemeHandler(viewer_home, app)
+        if prefs['image_proxy']:
+            import imageproxy
+            images = imageproxy.ImageProxy(os.path.join(plugin_prefs_folder(bk), 'image-variants'),
+                                           book_id,
+                                           budget=prefs['image_proxy_budget_mb'] * 1024 * 1024,
+                                           workers=prefs['image_proxy_workers'] or imageproxy.DEFAULT_WORKERS,
+                                           digests=digests, parent=app)
+        if sync is not None:
+            source = bookserver.SyncingBookSource(sync, app)
+            sync.start()
+        else:
+            source = bookserver.DirectoryBookSource(book_root)
+        scheme_handler.mount(book_name, source, images=images)
+
+    console = consolelog.ConsoleLog(level=prefs['console_level'], suppress=prefs['console_suppress'],
+                                    rate=prefs['console_rate'], parent=app,
+                                    report_path=(os.path.join(plugin_prefs_folder(bk), 'console-report.json')
+                                                 if prefs['console_report'] else None))
+
+    search = None
+    if prefs['search_index']:
+        import searchindex
+        search = searchindex.SearchIndex()
+
     # creating a main window object
-    window = MainWindow(query, prefs)
+    with timer.phase('main_window'):
+        window = MainWindow(query, prefs, scheme_handler=scheme_handler, timer=timer, storage_key=storage_key,
+                            search=search, images=images, console=console)
+
+    if book_data is not None:
+        # Readium starts without it and picks it up whenever it is ready
+        book_data.add_done_callback(window.bookDataReady.emit)
+
+    # indexed in the background while Readium starts up
+    if search is not None:
+        search.start(bk._w.ebook_root)
 
     # loop
     app.exec_()
+
+    if images is not None:
+        images.close()
+
+    if sync is not None:
+        # the manifest is only written once every file is in place, a sync
+        # that is stuck on some file is left to the next launch to finish
+        if not sync.join(SYNC_JOIN_TIMEOUT):
+            print('Book cache: gave up waiting for the sync to finish')
+        sync.cache.sweep(keep=(book_name,))
+        print('Book cache: {first} files before opening, {copied} of {files} copied, {removed} removed'.format(
+            **sync.stats))
     
     # done with temp folder so clean up after yourself
-    shutil.rmtree(bookdir)
+    if bookdir is not None:
+        shutil.rmtree(bookdir)
     
     print("Readium Reader Session Complete")
     bk.savePrefs(prefs)
+    # in case Readium never got as far as rendering a page
+    timer.emit()
 
     # Prevent potential crash when exiting by specifying the order
     # of deletion. Apparently a known issue with PyQt5 < 5.14
     # https://stackoverflow.com/questions/59120337/59126660#59126660
     del window, app
 
+    # after the profile is gone so that its storage has been written out
+    if storage_key is not None:
+        storage_hold.release()
+        sweep_book_storage(plugin_prefs_folder(bk), storage_key, prefs['storage_budget_mb'])
+
     # Setting the proper Return value is important.
     # 0 - means success
     # anything else means failure
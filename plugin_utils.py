@@ -28,6 +28,7 @@
 import os
 import sys
 import inspect
+import importlib
 
 
 SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
@@ -36,47 +37,103 @@ SIGIL_QT_MAJOR_VERSION = tuple(map(int, (e.split("."))))[0]
 DEBUG = 0
 
 
+# Only QtCore, QtGui and QtWidgets are imported up front. Everything else is
+# resolved on first attribute access (see __getattr__ below) since importing
+# the other bindings is a noticeable part of a plugin's startup time.
+# Name: (module, attribute or None for the module itself, is part of QtWebEngine)
 if SIGIL_QT_MAJOR_VERSION == 6:
-    from PySide6 import QtCore, QtGui, QtNetwork, QtPrintSupport, QtSvg, QtWebChannel, QtWidgets  # noqa: F401
-    # Plugins that don't use QtWebEngine shouldn't fail when external Pythons
-    # don't have PySide6 installed. Bundled Pythons will always have PySide6
-    # installed startting with Qt6 releases.
-    try:
-        from PySide6 import QtWebEngineCore, QtWebEngineWidgets  # noqa: F401
-        from PySide6.QtWebEngineCore import QWebEnginePage, QWebEngineProfile, QWebEngineScript, QWebEngineSettings  # noqa: F401
-    except ImportError:
-        print('QtWebEngine PySide6 Python bindings not found.')
-        print('If this plugin needs QtWebEngine, make sure those bindings are installed.')
-        pass
-    else:
-        if DEBUG:
-            print('QtWebEngine PySide6 Python bindings found.')
+    from PySide6 import QtCore, QtGui, QtWidgets  # noqa: F401
+    _LAZY_EXPORTS = {
+        'QtNetwork': ('PySide6.QtNetwork', None, False),
+        'QtPrintSupport': ('PySide6.QtPrintSupport', None, False),
+        'QtSvg': ('PySide6.QtSvg', None, False),
+        'QtWebChannel': ('PySide6.QtWebChannel', None, False),
+        'QUiLoader': ('PySide6.QtUiTools', 'QUiLoader', False),
+        # Plugins that don't use QtWebEngine shouldn't fail when external Pythons
+        # don't have PySide6 installed. Bundled Pythons will always have PySide6
+        # installed startting with Qt6 releases.
+        'QtWebEngineCore': ('PySide6.QtWebEngineCore', None, True),
+        'QtWebEngineWidgets': ('PySide6.QtWebEngineWidgets', None, True),
+        'QWebEnginePage': ('PySide6.QtWebEngineCore', 'QWebEnginePage', True),
+        'QWebEngineProfile': ('PySide6.QtWebEngineCore', 'QWebEngineProfile', True),
+        'QWebEngineScript': ('PySide6.QtWebEngineCore', 'QWebEngineScript', True),
+        'QWebEngineSettings': ('PySide6.QtWebEngineCore', 'QWebEngineSettings', True),
+    }
 
     from PySide6.QtCore import Qt, Signal, Slot, qVersion  # noqa: F401
     from PySide6.QtGui import QAction, QActionGroup  # noqa: F401
-    from PySide6.QtUiTools import QUiLoader  # noqa: F401
 elif SIGIL_QT_MAJOR_VERSION == 5:
-    from PyQt5 import QtCore, QtGui, QtNetwork, QtPrintSupport, QtSvg, QtWidgets  # noqa: F401
-    # Plugins that don't use QtWebEngine shouldn't fail when external Pythons
-    # Don't have PyQt5 installed. And Sigil versions before PyQtWebEngine was added (Pre-1.6)
-    # should be able to run plugins that use this script, but don't use QtWebEngine.
-    try:
-        from PyQt5 import QtWebEngineCore, QtWebEngineWidgets  # noqa: F401
-        from PyQt5.QtWebEngineWidgets import QWebEnginePage, QWebEngineProfile, QWebEngineScript, QWebEngineSettings   # noqa: F401
+    from PyQt5 import QtCore, QtGui, QtWidgets  # noqa: F401
+    _LAZY_EXPORTS = {
+        'QtNetwork': ('PyQt5.QtNetwork', None, False),
+        'QtPrintSupport': ('PyQt5.QtPrintSupport', None, False),
+        'QtSvg': ('PyQt5.QtSvg', None, False),
+        'uic': ('PyQt5.uic', None, False),
+        # Return the standard PyQt5 loadUi object
+        'loadUi': ('PyQt5.uic', 'loadUi', False),
+        # Plugins that don't use QtWebEngine shouldn't fail when external Pythons
+        # Don't have PyQt5 installed. And Sigil versions before PyQtWebEngine was added (Pre-1.6)
+        # should be able to run plugins that use this script, but don't use QtWebEngine.
+        # PyQt5 insists on QtWebEngineWidgets being imported before the QApplication
+        # is created, so plugins should import it (or its classes) at the top.
+        'QtWebEngineCore': ('PyQt5.QtWebEngineCore', None, True),
+        'QtWebEngineWidgets': ('PyQt5.QtWebEngineWidgets', None, True),
+        'QWebEnginePage': ('PyQt5.QtWebEngineWidgets', 'QWebEnginePage', True),
+        'QWebEngineProfile': ('PyQt5.QtWebEngineWidgets', 'QWebEngineProfile', True),
+        'QWebEngineScript': ('PyQt5.QtWebEngineWidgets', 'QWebEngineScript', True),
+        'QWebEngineSettings': ('PyQt5.QtWebEngineWidgets', 'QWebEngineSettings', True),
         # WebChannel binding not added until Sigil 1.6
-        from PyQt5 import QtWebChannel   # noqa: F401
-    except ImportError:
-        print('QtWebEngine PyQt5 Python bindings not found.')
-        print('If this plugin needs QtWebEngine make sure those bindings are installed')
-        print('(or use Sigil 1.6 or newer, which has it bundled).')
-        pass
-    else:
-        if DEBUG:
-            print('QtWebEngine PyQt5 Python bindings found.')
+        'QtWebChannel': ('PyQt5.QtWebChannel', None, True),
+    }
 
     from PyQt5.QtCore import Qt, pyqtSignal as Signal, pyqtSlot as Slot, qVersion  # noqa: F401
     from PyQt5.QtWidgets import QAction, QActionGroup  # noqa: F401
-    from PyQt5 import uic  # noqa: F401
+
+_webengine_missing = False
+
+
+def _resolve_lazy_export(name):
+    global _webengine_missing
+    modname, attr, is_webengine = _LAZY_EXPORTS[name]
+    try:
+        value = importlib.import_module(modname)
+        if attr is not None:
+            value = getattr(value, attr)
+    except ImportError:
+        if is_webengine and not _webengine_missing:
+            _webengine_missing = True
+            binding = 'PySide6' if SIGIL_QT_MAJOR_VERSION == 6 else 'PyQt5'
+            print('QtWebEngine {} Python bindings not found.'.format(binding))
+            print('If this plugin needs QtWebEngine, make sure those bindings are installed.')
+            if SIGIL_QT_MAJOR_VERSION == 5:
+                print('(or use Sigil 1.6 or newer, which has it bundled).')
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    if DEBUG and is_webengine:
+        print('QtWebEngine {} resolved from {}'.format(name, modname))
+    # cache it so __getattr__ is never consulted for this name again
+    globals()[name] = value
+    return value
+
+
+def __getattr__(name):
+    if name in _LAZY_EXPORTS:
+        return _resolve_lazy_export(name)
+    if name == 'UiLoader' and SIGIL_QT_MAJOR_VERSION == 6:
+        return _uiloader_class()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_EXPORTS))
+
+
+# Module level __getattr__ needs Python 3.7, so resolve everything up front before that
+if sys.version_info < (3, 7):
+    for _name in list(_LAZY_EXPORTS):
+        try:
+            _resolve_lazy_export(_name)
+        except AttributeError:
+            pass
 
 
 PLUGIN_QT_MAJOR_VERSION = tuple(map(int, (qVersion().split("."))))[0]
@@ -377,44 +434,57 @@ class PluginApplication(QtWidgets.QApplication):
 
 # Mimic the behavior of PyQt5.uic.loadUi() in PySide6
 # so the same code can be used for PyQt5/PySide6.
+# The class is only built the first time it is needed so that QtUiTools
+# does not get imported by plugins that never load a .ui file.
 if 'PySide6' in sys.modules:
-    class UiLoader(QUiLoader):
-        def __init__(self, baseinstance, customWidgets=None):
-            QUiLoader.__init__(self, baseinstance)
-            self.baseinstance = baseinstance
-            self.customWidgets = customWidgets
-
-        def createWidget(self, class_name, parent=None, name=''):
-            if parent is None and self.baseinstance:
-                # supposed to create the top-level widget, return the base instance
-                # instead
-                return self.baseinstance
-            else:
-                if class_name in self.availableWidgets():
-                    # create a new widget for child widgets
-                    widget = QUiLoader.createWidget(self, class_name, parent, name)
+    _UiLoader = None
+
+    def _uiloader_class():
+        global _UiLoader
+        if _UiLoader is not None:
+            return _UiLoader
+        QUiLoader = _resolve_lazy_export('QUiLoader')
+
+        class UiLoader(QUiLoader):
+            def __init__(self, baseinstance, customWidgets=None):
+                QUiLoader.__init__(self, baseinstance)
+                self.baseinstance = baseinstance
+                self.customWidgets = customWidgets
+
+            def createWidget(self, class_name, parent=None, name=''):
+                if parent is None and self.baseinstance:
+                    # supposed to create the top-level widget, return the base instance
+                    # instead
+                    return self.baseinstance
                 else:
-                    # if not in the list of availableWidgets, must be a custom widget
-                    # this will raise KeyError if the user has not supplied the
-                    # relevant class_name in the dictionary, or TypeError, if
-                    # customWidgets is None
-                    try:
-                        widget = self.customWidgets[class_name](parent)
-
-                    except (TypeError, KeyError):
-                        raise Exception('No custom widget ' + class_name + ' found in customWidgets param of UiLoader __init__.')
-
-                if self.baseinstance:
-                    # set an attribute for the new child widget on the base
-                    # instance, just like PyQt5/6.uic.loadUi does.
-                    setattr(self.baseinstance, name, widget)
-
-                return widget
+                    if class_name in self.availableWidgets():
+                        # create a new widget for child widgets
+                        widget = QUiLoader.createWidget(self, class_name, parent, name)
+                    else:
+                        # if not in the list of availableWidgets, must be a custom widget
+                        # this will raise KeyError if the user has not supplied the
+                        # relevant class_name in the dictionary, or TypeError, if
+                        # customWidgets is None
+                        try:
+                            widget = self.customWidgets[class_name](parent)
+
+                        except (TypeError, KeyError):
+                            raise Exception('No custom widget ' + class_name + ' found in customWidgets param of UiLoader __init__.')
+
+                    if self.baseinstance:
+                        # set an attribute for the new child widget on the base
+                        # instance, just like PyQt5/6.uic.loadUi does.
+                        setattr(self.baseinstance, name, widget)
+
+                    return widget
+
+        _UiLoader = UiLoader
+        return _UiLoader
 
     def loadUi(uifile, baseinstance=None, customWidgets=None,
             workingDirectory=None):
 
-        loader = UiLoader(baseinstance, customWidgets)
+        loader = _uiloader_class()(baseinstance, customWidgets)
 
         # If the .ui file references icons or other resources it may
         # not find them unless the cwd is defined. If this compat library
@@ -432,6 +502,5 @@ if 'PySide6' in sys.modules:
         QtCore.QMetaObject.connectSlotsByName(widget)
         return widget
 
-# Otherwise return the standard PyQt5 loadUi object
-else:
-    loadUi = uic.loadUi
+    if sys.version_info < (3, 7):
+        UiLoader = _uiloader_class()
@@ -15,6 +15,7 @@ except:
     print('PyQt5')
 import os
 import sys
+import json
 import argparse
 
 _plat = sys.platform.lower()
@@ -44,7 +45,7 @@ class WebPage(QWebEnginePage):
             return True
         if req_type == QWebEnginePage.NavigationType.NavigationTypeBackForward:
             return True
-        if url.scheme() in ('data', 'file', 'blob'):
+        if url.scheme() in ('data', 'file', 'blob', 'sigilreader'):
             return True
         if url.scheme() in ('http', 'https') and req_type == QWebEnginePage.NavigationType.NavigationTypeLinkClicked:
             print('Blocking external navigation request to: ', url.toString())
@@ -72,11 +73,102 @@ class WebView(QWebEngineView):
         return self._size_hint
 
 
+# Live reload support for --watch. Content documents are re-rendered in place
+# at the current position, anything else the page depends on (stylesheets,
+# images, fonts) re-renders whatever is on screen and a changed OPF reloads.
+DEBOUNCE_MSECS = 300
+RERENDER_EXTS = ('.xhtml', '.html', '.htm', '.svg', '.css', '.js', '.png', '.jpg', '.jpeg', '.gif', '.webp',
+                 '.ttf', '.otf', '.woff', '.woff2')
+
+
+def read_spine(bookroot):
+    ''' Returns (opf path, {absolute content document path: spine idref}) '''
+    import bookinfo
+    opfbookpath = bookinfo.find_opf_bookpath(bookroot) or ''
+    opfpath = os.path.join(bookroot, *opfbookpath.split('/'))
+    spine = {}
+    for idref, bookpath in bookinfo.spine_documents(bookroot):
+        spine[os.path.join(bookroot, *bookpath.split('/'))] = idref
+    return opfpath, spine
+
+
+class BookWatcher(QObject):
+
+    def __init__(self, bookroot, page, parent=None):
+        QObject.__init__(self, parent)
+        self.bookroot = os.path.normpath(bookroot)
+        self.page = page
+        self.opfpath, self.spine = read_spine(self.bookroot)
+        self.mtimes = {}
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.fileChanged.connect(self.changed)
+        self.watcher.directoryChanged.connect(self.changed)
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(DEBOUNCE_MSECS)
+        self.timer.timeout.connect(self.flush)
+        self.rescan()
+
+    def rescan(self):
+        dirs, files = [], []
+        mtimes = {}
+        for root, dnames, fnames in os.walk(self.bookroot):
+            dirs.append(root)
+            for name in fnames:
+                path = os.path.join(root, name)
+                try:
+                    mtimes[path] = os.stat(path).st_mtime_ns
+                except OSError:
+                    continue
+                if path == self.opfpath or name.lower().endswith(RERENDER_EXTS):
+                    files.append(path)
+        self.mtimes = mtimes
+        # editors that save by renaming drop the watch on the old file
+        watched = set(self.watcher.files()) | set(self.watcher.directories())
+        missing = [p for p in dirs + files if p not in watched]
+        if missing:
+            self.watcher.addPaths(missing)
+
+    def changed(self, path):
+        # a save often arrives as several events, wait for them to settle
+        self.timer.start()
+
+    def flush(self):
+        old = self.mtimes
+        self.rescan()
+        changed = [p for p, t in self.mtimes.items() if old.get(p) != t]
+        if not changed:
+            return
+        if self.opfpath in changed:
+            print('Package document changed, reloading')
+            self.opfpath, self.spine = read_spine(self.bookroot)
+            self.page.triggerAction(QWebEnginePage.WebAction.Reload)
+            return
+        idrefs = sorted(set(self.spine[p] for p in changed if p in self.spine))
+        if len(idrefs) < len([p for p in changed if p.lower().endswith(RERENDER_EXTS)]):
+            # something other than a content document, re-render whatever is showing
+            idrefs = None
+        self.page.runJavaScript('window.SigilReader ? SigilReader.rerender(%s) : null' % json.dumps(idrefs),
+                                self.rerendered)
+
+    def rerendered(self, idref):
+        if idref:
+            print('Re-rendered', idref)
+
+
+def viewer_home(mydir):
+    # next to the viewer or at the top of the plugin
+    for path in (os.path.join(mydir, 'cloud-reader-lite'), os.path.join(mydir, 'viewer', 'cloud-reader-lite')):
+        if os.path.isdir(path):
+            return path
+    return os.path.join(mydir, 'cloud-reader-lite')
+
+
 # creating main window class
 class MainWindow(QMainWindow):
 
     # constructor
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, watch=False, book=None, **kwargs):
         super(MainWindow, self).__init__(*args, **kwargs)
         
         mydir = os.path.dirname(os.path.abspath(__file__))
@@ -96,10 +188,33 @@ class MainWindow(QMainWindow):
         done_btn.triggered.connect(self.done)
         navtb.addAction(done_btn)
 
-        bookurl = QUrl.fromLocalFile(mydir + '/cloud-reader-lite/index.html')
-        bookurl.setQuery('epub=epub_content/ebook/')
+        bookroot = mydir + '/cloud-reader-lite/epub_content/ebook'
+        if book is None:
+            bookurl = QUrl.fromLocalFile(mydir + '/cloud-reader-lite/index.html')
+            bookurl.setQuery('epub=epub_content/ebook/')
+        else:
+            # serve the viewer and the book through the plugin's url scheme,
+            # a packed .epub is read in place without being extracted
+            import bookserver
+            self.scheme_handler = bookserver.BookSchemeHandler(viewer_home(mydir), self)
+            QWebEngineProfile.defaultProfile().installUrlSchemeHandler(
+                QByteArray(bookserver.SCHEME_NAME.encode('ascii')), self.scheme_handler)
+            if os.path.isdir(book):
+                bookroot = book
+                source = bookserver.DirectoryBookSource(book)
+            else:
+                bookroot = None
+                source = bookserver.EpubArchiveSource(book)
+            self.scheme_handler.mount('ebook', source)
+            bookurl = self.scheme_handler.reader_url(bookserver.book_query('ebook'))
         self.browser.setUrl(bookurl)
 
+        self.watcher = None
+        if watch and bookroot is None:
+            print('--watch needs an unpacked book, not watching', book)
+        elif watch:
+            self.watcher = BookWatcher(bookroot, self.browser.page(), self)
+
         # set this browser as central widget or main window
         self.setCentralWidget(self.browser)
 
@@ -154,7 +269,26 @@ highdpi_choices = ['detect', 'on', 'off']
 highdpi = 'detect'
 parser = argparse.ArgumentParser()
 parser.add_argument('-d', '--highdpi', default='detect')
+parser.add_argument('-w', '--watch', action='store_true', help='re-render chapters as they are edited')
+parser.add_argument('book', nargs='?', help='a .epub file or unpacked book folder (default: epub_content/ebook)')
+parser.add_argument('--batch', nargs=argparse.REMAINDER,
+                    help='open many books headless in this one process and report how they render (see batchcheck.py)')
 args = parser.parse_args()
+if args.batch is not None:
+    if 'PySide2' in sys.modules:
+        sys.exit('The batch check uses the plugin\'s PyQt5 based modules')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import batchcheck
+    sys.exit(batchcheck.main(args.batch))
+book = os.path.abspath(args.book) if args.book else None
+if book is not None:
+    if 'PySide2' in sys.modules:
+        sys.exit('Opening a book by path uses the plugin\'s PyQt5 based bookserver module')
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import bookserver
+    # has to happen before the QApplication is created
+    bookserver.register_reader_scheme()
 if args.highdpi and args.highdpi.lower() in highdpi_choices:
     highdpi = args.highdpi.lower()
     print(highdpi)
@@ -170,7 +304,7 @@ app = QApplication(sys.argv)
 app.setApplicationName("Readium Cloud Reader Lite Demo")
 
 # creating a main window object
-window = MainWindow()
+window = MainWindow(watch=args.watch, book=book)
 
 # loop
 app.exec_()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# One window with a tab per book for the resident reader. All tabs share one
+# profile and browser process. Tabs left in the background are frozen after
+# a while (their page keeps its renderer but runs no scripts or timers) and
+# discarded after longer still (the renderer goes away and the page reloads
+# when its tab is shown again, Readium reopens it where it was). No more
+# than max_live tabs keep a renderer at any time.
+
+import time
+
+from plugin_utils import QtCore, QtWidgets, QWebEnginePage
+
+# page lifecycle states are new in Qt 5.14
+LIFECYCLE = hasattr(QWebEnginePage, 'LifecycleState')
+CHECK_MSECS = 15 * 1000
+
+
+class ReaderTabs(QtWidgets.QMainWindow):
+
+    def __init__(self, prefs, freeze_minutes=5, discard_minutes=30, max_live=4, parent=None):
+        QtWidgets.QMainWindow.__init__(self, parent)
+        self.prefs = prefs
+        self.freeze_secs = freeze_minutes * 60
+        self.discard_secs = discard_minutes * 60
+        self.max_live = max(1, max_live)
+        # window -> when it was last the current tab
+        self.last_active = {}
+        self.current = None
+        self.tabs = QtWidgets.QTabWidget(self)
+        self.tabs.setTabsClosable(True)
+        self.tabs.setMovable(True)
+        self.tabs.setDocumentMode(True)
+        self.tabs.tabCloseRequested.connect(self.close_tab)
+        self.tabs.currentChanged.connect(self._activated)
+        self.setCentralWidget(self.tabs)
+        b64val = self.prefs.get('tabs_geometry', None)
+        if b64val:
+            self.restoreGeometry(QtCore.QByteArray.fromBase64(QtCore.QByteArray(b64val.encode('ascii'))))
+        if LIFECYCLE:
+            self.timer = QtCore.QTimer(self)
+            self.timer.timeout.connect(self.check_idle)
+            self.timer.start(CHECK_MSECS)
+        else:
+            print('Qt {} has no page lifecycle states, background tabs stay live'.format(QtCore.qVersion()))
+
+    def windows(self):
+        return [self.tabs.widget(i) for i in range(self.tabs.count())]
+
+    def add_book(self, window, title, tooltip=None):
+        ''' window is a MainWindow created with embedded=True '''
+        index = self.tabs.addTab(window, title)
+        self.tabs.setTabToolTip(index, tooltip or title)
+        self.tabs.setCurrentIndex(index)
+
+    def show_book(self, window):
+        self.tabs.setCurrentWidget(window)
+
+    def lifecycle_state(self, window):
+        return window.browser.page().lifecycleState()
+
+    def set_lifecycle_state(self, window, state):
+        page = window.browser.page()
+        if page.lifecycleState() != state:
+            page.setLifecycleState(state)
+
+    def _activated(self, index):
+        now = time.monotonic()
+        if self.current is not None and self.current in self.last_active:
+            self.last_active[self.current] = now
+        window = self.tabs.widget(index)
+        self.current = window
+        if window is None:
+            return
+        self.last_active[window] = now
+        self.setWindowTitle(self.tabs.tabText(index))
+        if LIFECYCLE:
+            # a discarded page reloads from here
+            self.set_lifecycle_state(window, QWebEnginePage.LifecycleState.Active)
+            self.limit_live()
+
+    def check_idle(self):
+        now = time.monotonic()
+        for window in self.windows():
+            if window is self.current:
+                continue
+            idle = now - self.last_active.get(window, now)
+            state = self.lifecycle_state(window)
+            if self.discard_secs and idle >= self.discard_secs:
+                if state != QWebEnginePage.LifecycleState.Discarded:
+                    self.set_lifecycle_state(window, QWebEnginePage.LifecycleState.Discarded)
+            elif self.freeze_secs and idle >= self.freeze_secs:
+                if state == QWebEnginePage.LifecycleState.Active:
+                    self.set_lifecycle_state(window, QWebEnginePage.LifecycleState.Frozen)
+        self.limit_live()
+
+    def limit_live(self):
+        ''' Discard the least recently used background tabs over the cap '''
+        live = [w for w in self.windows() if w is not self.current and
+                self.lifecycle_state(w) != QWebEnginePage.LifecycleState.Discarded]
+        live.sort(key=lambda w: self.last_active.get(w, 0))
+        # the current tab always counts as one of them
+        for window in live[:max(0, len(live) - (self.max_live - 1))]:
+            self.set_lifecycle_state(window, QWebEnginePage.LifecycleState.Discarded)
+
+    def close_tab(self, index):
+        window = self.tabs.widget(index)
+        if window is None:
+            return
+        self.last_active.pop(window, None)
+        if window is self.current:
+            self.current = None
+        self.tabs.removeTab(index)
+        window.close()
+        if not self.tabs.count():
+            self.close()
+
+    def closeEvent(self, ev):
+        self.prefs['tabs_geometry'] = str(self.saveGeometry().toBase64(), 'ascii')
+        while self.tabs.count():
+            window = self.tabs.widget(0)
+            self.last_active.pop(window, None)
+            self.tabs.removeTab(0)
+            window.close()
+        self.current = None
+        QtWidgets.QMainWindow.closeEvent(self, ev)
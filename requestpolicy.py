@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Which requests the viewer may make at all.
+#
+# acceptNavigationRequest only sees navigations. Stylesheets, fonts and
+# images a book (or the viewer's font-faces/fonts.js) pulls in from remote
+# hosts go out regardless and on a machine without network access each of
+# them hangs until it times out. The interceptor installed on the profile
+# checks every request against a policy compiled once up front and fails
+# the disallowed ones immediately, counting them per host.
+
+import re
+import threading
+from collections import Counter
+
+from plugin_utils import QtWebEngineCore
+
+QWebEngineUrlRequestInterceptor = QtWebEngineCore.QWebEngineUrlRequestInterceptor
+
+# never leave the machine
+LOCAL_SCHEMES = ('sigilreader', 'file', 'data', 'blob', 'qrc', 'about')
+# Readium's online font faces, denied even when remote requests are allowed
+DEFAULT_DENY_HOSTS = ('fonts.googleapis.com', 'fonts.gstatic.com')
+
+
+''' Regex matching any of hosts and their subdomains, None for no hosts '''
+def host_pattern(hosts):
+    hosts = [h.strip().lower().lstrip('.') for h in hosts if h and h.strip()]
+    if not hosts:
+        return None
+    return re.compile(r'(?:.*\.)?(?:{})\Z'.format('|'.join(re.escape(h) for h in hosts)))
+
+
+class RequestPolicy(object):
+
+    def __init__(self, remote='block', allow_hosts=(), deny_hosts=DEFAULT_DENY_HOSTS, deny_paths=(),
+                 local_schemes=LOCAL_SCHEMES):
+        self.allow_remote = remote == 'allow'
+        self.local_schemes = frozenset(s.lower() for s in local_schemes)
+        self._allow_hosts = host_pattern(allow_hosts)
+        self._deny_hosts = host_pattern(deny_hosts)
+        self._deny_paths = tuple(p for p in deny_paths if p)
+
+    @classmethod
+    def from_prefs(cls, prefs):
+        return cls(prefs['remote_requests'], prefs['request_allow_hosts'], prefs['request_deny_hosts'],
+                   prefs['request_deny_paths'])
+
+    def allows(self, scheme, host, path):
+        if scheme in self.local_schemes:
+            return True
+        if self._deny_hosts is not None and self._deny_hosts.match(host):
+            return False
+        if self._deny_paths and path.startswith(self._deny_paths):
+            return False
+        if self._allow_hosts is not None and self._allow_hosts.match(host):
+            return True
+        return self.allow_remote
+
+
+class RequestInterceptor(QWebEngineUrlRequestInterceptor):
+
+    def __init__(self, policy, parent=None):
+        QWebEngineUrlRequestInterceptor.__init__(self, parent)
+        self.policy = policy
+        self.blocked = Counter()
+        # first party url (the viewer page) -> Counter of hosts
+        self.blocked_pages = {}
+        # Qt before 5.13 calls interceptRequest on its IO thread
+        self._lock = threading.Lock()
+
+    def interceptRequest(self, info):
+        url = info.requestUrl()
+        host = url.host().lower()
+        if not self.policy.allows(url.scheme().lower(), host, url.path()):
+            info.block(True)
+            key = host or url.scheme()
+            with self._lock:
+                self.blocked[key] += 1
+                self.blocked_pages.setdefault(info.firstPartyUrl().toString(), Counter())[key] += 1
+
+    def take_blocked(self, match):
+        ''' {host: count} blocked for the pages whose url contains match, which are forgotten '''
+        ans = Counter()
+        with self._lock:
+            for page in [p for p in self.blocked_pages if match in p]:
+                ans.update(self.blocked_pages.pop(page))
+        return dict(ans)
+
+    def report(self):
+        with self._lock:
+            blocked = self.blocked.most_common()
+        if blocked:
+            print('Blocked remote requests: ' + ', '.join('{} ({})'.format(h, n) for h, n in blocked))
+
+
+''' Put an interceptor for policy in front of every request of profile '''
+def install(profile, policy):
+    interceptor = RequestInterceptor(policy, profile)
+    if hasattr(profile, 'setUrlRequestInterceptor'):
+        profile.setUrlRequestInterceptor(interceptor)
+    else:
+        # Qt 5.12 and earlier
+        profile.setRequestInterceptor(interceptor)
+    return interceptor
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# A reader process that stays alive after its window is closed so that the
+# next plugin launch only has to hand it a book over a QLocalServer instead
+# of paying for Qt, Chromium and the Readium bundle all over again.
+#
+# run() in plugin.py talks to it with hand_off() and starts it with spawn().
+# It quits on its own once it has been idle for idle_minutes or, when no
+# window is open, once it and its renderers use more than memory_mb.
+
+import os
+import sys
+import re
+import json
+import hashlib
+import argparse
+import subprocess
+
+from plugin_utils import QtCore, QtNetwork, QtGui, QtWidgets, Qt, iswindows, ismacos
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+SERVER_PREFIX = 'ReadiumReaderSigil-'
+HANDOFF_TIMEOUT = 1000
+MEMORY_CHECK_INTERVAL = 30 * 1000
+LOG_NAME = 'resident-reader.log'
+# mount names and storage keys end up in urls and folder names
+_name_pattern = re.compile(r'^[A-Za-z0-9_.-]+$')
+
+
+def server_name(pfolder):
+    # one resident reader per plugin prefs folder (and so per user)
+    return SERVER_PREFIX + hashlib.sha1(os.path.abspath(pfolder).encode('utf-8')).hexdigest()[:12]
+
+
+''' Ask a running resident reader to open the book. Returns False if there is none. '''
+def hand_off(request, timeout=HANDOFF_TIMEOUT):
+    sock = QtNetwork.QLocalSocket()
+    sock.connectToServer(server_name(request['pfolder']))
+    if not sock.waitForConnected(timeout):
+        return False
+    sock.write(QtCore.QByteArray(json.dumps(request).encode('utf-8') + b'\n'))
+    ok = sock.waitForBytesWritten(timeout) and sock.waitForReadyRead(timeout)
+    reply = bytes(sock.readAll()) if ok else b''
+    sock.disconnectFromServer()
+    return reply.startswith(b'ok')
+
+
+''' Start a detached resident reader that opens the book as soon as it is up.
+    Its output goes to resident-reader.log in the plugin prefs folder, Sigil
+    stops reading the plugin's own output once the plugin returns. '''
+def spawn(request):
+    args = [sys.executable, os.path.join(SCRIPT_DIR, 'resident_reader.py'), json.dumps(request)]
+    kwargs = {'stdin': subprocess.DEVNULL, 'stdout': subprocess.DEVNULL, 'stderr': subprocess.STDOUT,
+              'close_fds': True}
+    if iswindows:
+        kwargs['creationflags'] = subprocess.DETACHED_PROCESS | subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        kwargs['start_new_session'] = True
+    log = None
+    try:
+        os.makedirs(request['pfolder'], exist_ok=True)
+        log = open(os.path.join(request['pfolder'], LOG_NAME), 'wb')
+        kwargs['stdout'] = log
+    except OSError:
+        pass
+    try:
+        subprocess.Popen(args, **kwargs)
+    finally:
+        if log is not None:
+            log.close()
+
+
+def _proc_tree_rss(pid):
+    # /proc on Linux, resident pages of pid and all of its descendants
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), 'r') as f:
+                # the command name in parentheses may contain spaces
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        todo.extend(children.get(p, ()))
+        try:
+            with open('/proc/{}/statm'.format(p), 'r') as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, IndexError):
+            pass
+    return total
+
+
+def _ps_tree_rss(pid):
+    # ps on macOS and the BSDs, rss is in KiB
+    try:
+        # no capture_output or text, those need python 3.7
+        out = subprocess.run(['ps', '-A', '-o', 'pid=,ppid=,rss='], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True, timeout=5)
+    except (OSError, subprocess.SubprocessError):
+        return 0
+    children = {}
+    rss = {}
+    for line in out.stdout.splitlines():
+        try:
+            p, ppid, kb = (int(v) for v in line.split())
+        except ValueError:
+            continue
+        children.setdefault(ppid, []).append(p)
+        rss[p] = kb * 1024
+    total = 0
+    todo = [pid]
+    while todo:
+        p = todo.pop()
+        todo.extend(children.get(p, ()))
+        total += rss.get(p, 0)
+    return total
+
+
+def _own_working_set():
+    import ctypes
+    from ctypes import wintypes
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                    ('PeakWorkingSetSize', ctypes.c_size_t), ('WorkingSetSize', ctypes.c_size_t),
+                    ('QuotaPeakPagedPoolUsage', ctypes.c_size_t), ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                    ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t), ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                    ('PagefileUsage', ctypes.c_size_t), ('PeakPagefileUsage', ctypes.c_size_t)]
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    handle = ctypes.windll.kernel32.GetCurrentProcess()
+    if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+        return counters.WorkingSetSize
+    return 0
+
+
+''' Current resident set size in bytes of this process together with its
+    QtWebEngineProcess children, which hold most of the memory. Uses psutil
+    when it is installed. Without it Windows only gets this process's own
+    working set, so the limit is approximate there. '''
+def process_rss():
+    pid = os.getpid()
+    try:
+        import psutil
+    except ImportError:
+        psutil = None
+    if psutil is not None:
+        try:
+            proc = psutil.Process(pid)
+            total = proc.memory_info().rss
+            for child in proc.children(recursive=True):
+                try:
+                    total += child.memory_info().rss
+                except psutil.Error:
+                    pass
+            return total
+        except psutil.Error:
+            return 0
+    if sys.platform.startswith('linux'):
+        return _proc_tree_rss(pid)
+    if iswindows:
+        return _own_working_set()
+    return _ps_tree_rss(pid)
+
+
+def setup_highdpi(highdpi):
+    if ismacos or tuple(map(int, QtCore.qVersion().split('.'))) >= (6, 0, 0):
+        return
+    has_env_setting = False
+    env_vars = ('QT_AUTO_SCREEN_SCALE_FACTOR', 'QT_SCALE_FACTOR', 'QT_SCREEN_SCALE_FACTORS', 'QT_DEVICE_PIXEL_RATIO')
+    for v in env_vars:
+        if os.environ.get(v):
+            has_env_setting = True
+            break
+    if highdpi == 'on' or (highdpi == 'detect' and not has_env_setting):
+        QtWidgets.QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, True)
+    elif highdpi == 'off':
+        QtWidgets.QApplication.setAttribute(Qt.AA_EnableHighDpiScaling, False)
+        for p in env_vars:
+            os.environ.pop(p, None)
+
+
+class ResidentReader(QtCore.QObject):
+
+    def __init__(self, request, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        # imported here since plugin.py imports this module for hand_off()
+        import bookserver
+        import plugin
+        import requestpolicy
+        import bookinfo
+        import readertabs
+        from lrustore import read_json
+        self._plugin = plugin
+        self._bookserver = bookserver
+        self._bookinfo = bookinfo
+        self._readertabs = readertabs
+        self.pfolder = request['pfolder']
+        self.idle_msecs = int(request.get('idle_minutes', 30) * 60 * 1000)
+        self.memory_limit = int(request.get('memory_mb', 1536)) * 1024 * 1024
+        self._prefs_path = os.path.join(self.pfolder, 'resident.json')
+        self.prefs = read_json(self._prefs_path, {})
+        self.windows = {}
+
+        self.viewer_home = request['viewer_home']
+        self.scheme_handler = bookserver.BookSchemeHandler(self.viewer_home, self)
+        self.request_policy = requestpolicy.RequestPolicy(*request.get('request_policy', ()))
+        # profiles by storage partition (None when all books share one)
+        self.profiles = {}
+        # the windows using each partition and its hold against sweeps
+        self.profile_users = {}
+        self.storage_holds = {}
+        # books as tabs of one window, they all share one profile
+        self.tabs_mode = bool(request.get('tabs', False))
+        self.tabs_settings = (request.get('tabs_freeze_minutes', 5), request.get('tabs_discard_minutes', 30),
+                              request.get('tabs_live', 4))
+        self.tabbed = None
+
+        self.server = QtNetwork.QLocalServer(self)
+        # only processes of the same user may hand books over
+        self.server.setSocketOptions(QtNetwork.QLocalServer.UserAccessOption)
+        self.server.newConnection.connect(self._accept)
+
+        self.idle_timer = QtCore.QTimer(self)
+        self.idle_timer.setSingleShot(True)
+        self.idle_timer.timeout.connect(self.quit)
+        self.memory_timer = QtCore.QTimer(self)
+        self.memory_timer.timeout.connect(self._check_memory)
+        self.memory_timer.start(MEMORY_CHECK_INTERVAL)
+
+    def listen(self):
+        name = server_name(self.pfolder)
+        if self.server.listen(name):
+            return True
+        probe = QtNetwork.QLocalSocket()
+        probe.connectToServer(name)
+        if probe.waitForConnected(HANDOFF_TIMEOUT):
+            # another resident reader is already up
+            probe.disconnectFromServer()
+            return False
+        # a socket left over from a reader that crashed
+        QtNetwork.QLocalServer.removeServer(name)
+        return self.server.listen(name)
+
+    def check_request(self, request):
+        ''' Raises ValueError unless request is a well formed hand-off for this reader '''
+        if not isinstance(request, dict):
+            raise ValueError('not a json object')
+        for field in ('name', 'book_root'):
+            if not isinstance(request.get(field), str):
+                raise ValueError('{} missing or not a string'.format(field))
+        if not _name_pattern.match(request['name']):
+            raise ValueError('bad book name {!r}'.format(request['name']))
+        storage_key = request.get('storage_key')
+        if storage_key is not None and not (isinstance(storage_key, str) and _name_pattern.match(storage_key)):
+            raise ValueError('bad storage key {!r}'.format(storage_key))
+        for field in ('pfolder', 'viewer_home'):
+            # a reader serves one prefs folder and one viewer
+            value = request.get(field)
+            if value is not None and (not isinstance(value, str) or
+                                      os.path.realpath(value) != os.path.realpath(getattr(self, field))):
+                raise ValueError('{} does not match this reader'.format(field))
+        # books only ever come from the book cache
+        cache = os.path.realpath(os.path.join(self.pfolder, 'book-cache'))
+        book_root = os.path.realpath(request['book_root'])
+        if os.path.dirname(os.path.dirname(book_root)) != cache or not os.path.isdir(book_root):
+            raise ValueError('book_root is not a book cache folder')
+        for field in ('storage_budget_mb', 'tabs_freeze_minutes', 'tabs_discard_minutes', 'tabs_live'):
+            value = request.get(field, 0)
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise ValueError('{} is not a number'.format(field))
+
+    def open_book(self, request):
+        self.check_request(request)
+        name = request['name']
+        self.idle_timer.stop()
+        window = self.windows.get(name)
+        if window is not None:
+            # same book again, the cache has just been synced so simply reload it
+            window.browser.reload()
+            if window.embedded:
+                self.tabbed.show_book(window)
+        else:
+            if self.tabs_mode:
+                request = dict(request, storage_key=None)
+            storage_key = request.get('storage_key')
+            self.scheme_handler.mount(name, self._bookserver.DirectoryBookSource(request['book_root']))
+            window = self._plugin.MainWindow(self._bookserver.book_query(name), self.prefs,
+                                             scheme_handler=self.scheme_handler,
+                                             profile=self._profile(storage_key), embedded=self.tabs_mode)
+            window.setAttribute(Qt.WA_DeleteOnClose, True)
+            window.destroyed.connect(lambda obj=None, name=name, request=request: self._window_closed(name, request))
+            self.windows[name] = window
+            if self.tabs_mode:
+                # editions of a book share a title, the file they came from tells them apart
+                origin = request.get('origin')
+                self._tabs().add_book(window, self._bookinfo.book_title(request['book_root']) or name,
+                                      origin if isinstance(origin, str) else None)
+        if window.embedded:
+            window = self.tabbed
+        window.showNormal()
+        window.raise_()
+        window.activateWindow()
+
+    def _tabs(self):
+        if self.tabbed is None:
+            self.tabbed = self._readertabs.ReaderTabs(self.prefs, *self.tabs_settings)
+            self.tabbed.setAttribute(Qt.WA_DeleteOnClose, True)
+            self.tabbed.destroyed.connect(self._tabs_closed)
+        return self.tabbed
+
+    def _tabs_closed(self, obj=None):
+        self.tabbed = None
+
+    def _profile(self, storage_key):
+        # all profiles share this process's one browser process
+        profile = self.profiles.get(storage_key)
+        if profile is None:
+            if storage_key is not None and storage_key not in self.storage_holds:
+                store = self._plugin.book_storage(self.pfolder, 0)
+                self.storage_holds[storage_key] = store.hold(storage_key)
+            profile = self._plugin.create_profile(self.pfolder, self.scheme_handler, storage_key=storage_key,
+                                                  request_policy=self.request_policy)
+            self.profiles[storage_key] = profile
+        # editions of one book share its partition
+        self.profile_users[storage_key] = self.profile_users.get(storage_key, 0) + 1
+        return profile
+
+    def _window_closed(self, name, request):
+        self.windows.pop(name, None)
+        self.scheme_handler.unmount(name)
+        from lrustore import write_json_atomic
+        write_json_atomic(self._prefs_path, self.prefs)
+        storage_key = request.get('storage_key')
+        self.profile_users[storage_key] = self.profile_users.get(storage_key, 1) - 1
+        if storage_key is not None and self.profile_users[storage_key] <= 0:
+            # a book's partition is only needed while its windows are open
+            del self.profile_users[storage_key]
+            profile = self.profiles.pop(storage_key, None)
+            budget_mb = int(request.get('storage_budget_mb', 256))
+            if profile is not None:
+                # its storage is only written out once the profile is gone
+                profile.destroyed.connect(
+                    lambda obj=None, key=storage_key: self._storage_closed(key, budget_mb))
+                profile.deleteLater()
+            else:
+                self._storage_closed(storage_key, budget_mb)
+        if not self.windows:
+            if process_rss() > self.memory_limit:
+                self.quit()
+                return
+            self.idle_timer.start(self.idle_msecs)
+
+    def _storage_closed(self, storage_key, budget_mb):
+        if storage_key in self.profiles:
+            # the book was opened again in the meantime
+            return
+        hold = self.storage_holds.pop(storage_key, None)
+        if hold is not None:
+            hold.release()
+        self._plugin.sweep_book_storage(self.pfolder, storage_key, budget_mb, keep=tuple(self.storage_holds))
+
+    def _check_memory(self):
+        if not self.windows and process_rss() > self.memory_limit:
+            self.quit()
+
+    def _accept(self):
+        while self.server.hasPendingConnections():
+            sock = self.server.nextPendingConnection()
+            sock.readyRead.connect(lambda sock=sock: self._read(sock))
+            sock.disconnected.connect(sock.deleteLater)
+
+    def _read(self, sock):
+        if not sock.canReadLine():
+            return
+        try:
+            request = json.loads(bytes(sock.readLine()).decode('utf-8'))
+            self.open_book(request)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            print('Bad hand-off request: {}'.format(e), file=sys.stderr)
+            sock.write(QtCore.QByteArray(b'error\n'))
+        else:
+            sock.write(QtCore.QByteArray(b'ok\n'))
+        sock.flush()
+
+    def quit(self):
+        self.server.close()
+        QtWidgets.QApplication.instance().quit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resident Readium Reader')
+    parser.add_argument('request', help='json hand-off request for the first book')
+    args = parser.parse_args(argv)
+    request = json.loads(args.request)
+
+    import bookserver
+    bookserver.register_reader_scheme()
+    setup_highdpi(request.get('highdpi', 'detect'))
+    app = QtWidgets.QApplication([sys.argv[0]])
+    app.setApplicationName("Readium Cloud Reader Lite Demo")
+    app.setQuitOnLastWindowClosed(False)
+    if request.get('icon'):
+        app.setWindowIcon(QtGui.QIcon(request['icon']))
+
+    reader = ResidentReader(request)
+    if not reader.listen():
+        # lost the race against another plugin launch
+        if hand_off(request):
+            return 0
+        print('Could not start the resident reader server', file=sys.stderr)
+        return 1
+    try:
+        reader.open_book(request)
+    except (ValueError, KeyError, TypeError, OSError) as e:
+        print('Bad request: {}'.format(e), file=sys.stderr)
+        reader.quit()
+        return 1
+    app.exec_()
+    del reader, app
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Full-text search over the spine documents of a book. The index is built on
+# a background thread and maps every token to the documents it occurs in and
+# its positions there (token ordinals, kept in compact arrays). Phrase queries
+# check that the tokens follow each other, the last token of a query also
+# matches as a prefix so results show up while typing. SearchBridge hands the
+# index to the viewer over a QWebChannel.
+
+import os
+import re
+import json
+import time
+import bisect
+import threading
+from array import array
+from html import unescape
+
+from plugin_utils import QtCore, Signal, Slot
+from bookinfo import spine_documents
+
+SNIPPET_CONTEXT = 40
+DEFAULT_LIMIT = 100
+
+_word_pattern = re.compile(r'\w+')
+_tag_pattern = re.compile(r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<[^>]*>', re.S)
+_skip_pattern = re.compile(r'<(script|style)\b', re.I)
+_body_pattern = re.compile(r'<(/?)body[\s/>]', re.I)
+
+
+''' The text of an xhtml document's body as the DOM's textContent would see it,
+    without script and style contents. Offsets into it are the ones
+    textPosition() in sigil_hooks.js counts through the body's text nodes.
+    A document without a body (an svg spine item) is taken whole. '''
+def extract_text(markup):
+    out = []
+    pos = 0
+    skip_until = None
+    inside = _body_pattern.search(markup) is None
+    for m in _tag_pattern.finditer(markup):
+        if inside and skip_until is None and m.start() > pos:
+            out.append(unescape(markup[pos:m.start()]))
+        tag = m.group()
+        pos = m.end()
+        if skip_until is not None:
+            if tag.lower().startswith(skip_until):
+                skip_until = None
+            continue
+        if tag.startswith('<![CDATA['):
+            if inside:
+                out.append(tag[9:-3])
+            continue
+        body = _body_pattern.match(tag)
+        if body:
+            inside = not body.group(1) and not tag.endswith('/>')
+            continue
+        skip = _skip_pattern.match(tag)
+        if skip and not tag.endswith('/>'):
+            skip_until = '</' + skip.group(1).lower()
+    if inside and skip_until is None and pos < len(markup):
+        out.append(unescape(markup[pos:]))
+    return ''.join(out)
+
+
+def read_markup(path):
+    with open(path, 'rb') as f:
+        data = f.read()
+    return data.decode('utf-8', errors='replace')
+
+
+def start_matches(start, following):
+    return all(start + i + 1 in positions for i, positions in enumerate(following))
+
+
+class Document(object):
+
+    __slots__ = ('idref', 'href', 'text', 'offsets', 'tokens')
+
+    def __init__(self, idref, href, text):
+        self.idref = idref
+        self.href = href
+        self.text = text
+        # character offset of every token, by token ordinal
+        self.offsets = array('I')
+        self.tokens = ()
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # token -> {doc id: array of token ordinals}
+        self._postings = {}
+        self._vocabulary = None
+        self._docs = {}
+        self._order = []
+        self.ready = False
+        self.progress = 0.0
+        self.build_seconds = None
+        self._thread = None
+
+    # ------------------------------------------------------------------
+    # building
+
+    def _tokenize(self, doc):
+        local = {}
+        offsets = doc.offsets
+        for ordinal, m in enumerate(_word_pattern.finditer(doc.text)):
+            offsets.append(m.start())
+            token = m.group().lower()
+            positions = local.get(token)
+            if positions is None:
+                positions = local[token] = array('I')
+            positions.append(ordinal)
+        doc.tokens = tuple(local)
+        return local
+
+    def build(self, bookroot):
+        ''' Index the spine of the book in bookroot '''
+        start = time.perf_counter()
+        spine = spine_documents(bookroot)
+        with self._lock:
+            self._postings = {}
+            self._docs = {}
+            self._order = [idref for idref, href in spine]
+            self._vocabulary = None
+        for i, (idref, href) in enumerate(spine):
+            try:
+                doc = Document(idref, href, extract_text(read_markup(os.path.join(bookroot, *href.split('/')))))
+            except OSError:
+                continue
+            local = self._tokenize(doc)
+            # the lock is only held to merge one document in
+            with self._lock:
+                self._docs[idref] = doc
+                for token, positions in local.items():
+                    postings = self._postings.get(token)
+                    if postings is None:
+                        postings = self._postings[token] = {}
+                    postings[idref] = positions
+                self._vocabulary = None
+            self.progress = (i + 1) / float(len(spine))
+        self.progress = 1.0
+        self.build_seconds = time.perf_counter() - start
+        self.ready = True
+
+    def start(self, bookroot):
+        ''' Run build() on a background thread '''
+        self.ready = False
+        self._thread = threading.Thread(target=self.build, args=(bookroot,), name='search-index', daemon=True)
+        self._thread.start()
+        return self._thread
+
+    # ------------------------------------------------------------------
+    # querying
+
+    def _prefixed(self, prefix):
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        vocab = self._vocabulary
+        i = bisect.bisect_left(vocab, prefix)
+        while i < len(vocab) and vocab[i].startswith(prefix):
+            yield vocab[i]
+            i += 1
+
+    def search(self, query, limit=DEFAULT_LIMIT, prefix=True):
+        ''' Phrase search, results in spine order as dicts with idref, href,
+            offset (into the document's text), length and snippet '''
+        tokens = [t.lower() for t in _word_pattern.findall(query)]
+        if not tokens:
+            return []
+        results = []
+        with self._lock:
+            exact = [self._postings.get(t) for t in tokens[:-1]]
+            if any(p is None for p in exact):
+                return []
+            if prefix:
+                last = [self._postings[t] for t in self._prefixed(tokens[-1])]
+            else:
+                last = [self._postings[tokens[-1]]] if tokens[-1] in self._postings else []
+            if not last:
+                return []
+            candidates = set()
+            for p in last:
+                candidates.update(p)
+            for p in exact:
+                candidates.intersection_update(p)
+            for docid in self._order:
+                if docid not in candidates:
+                    continue
+                doc = self._docs[docid]
+                # positions are only worked out for the documents we get to
+                ends = set()
+                for p in last:
+                    ends.update(p.get(docid, ()))
+                if exact:
+                    following = [set(p[docid]) for p in exact[1:]]
+                    starts = [s for s in exact[0][docid]
+                              if start_matches(s, following) and s + len(exact) in ends]
+                else:
+                    starts = sorted(ends)
+                for s in starts:
+                    results.append(self._result(doc, s, len(tokens)))
+                    if len(results) >= limit:
+                        return results
+        return results
+
+    def _result(self, doc, start, ntokens):
+        offset = doc.offsets[start]
+        last = doc.offsets[start + ntokens - 1]
+        m = _word_pattern.match(doc.text, last)
+        end = m.end() if m else last
+        snippet = doc.text[max(0, offset - SNIPPET_CONTEXT):end + SNIPPET_CONTEXT]
+        return {
+            'idref': doc.idref,
+            'href': doc.href,
+            'offset': offset,
+            'length': end - offset,
+            'snippet': ' '.join(snippet.split()),
+        }
+
+    def stats(self):
+        with self._lock:
+            return {
+                'ready': self.ready,
+                'progress': round(self.progress, 3),
+                'documents': len(self._docs),
+                'tokens': len(self._postings),
+                'characters': sum(len(d.text) for d in self._docs.values()),
+                'build_seconds': self.build_seconds,
+            }
+
+
+class SearchBridge(QtCore.QObject):
+
+    ''' Published to the viewer as "search" on a QWebChannel '''
+
+    indexReady = Signal(str)
+
+    def __init__(self, index, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.index = index
+        self._timer = QtCore.QTimer(self)
+        self._timer.timeout.connect(self._check_ready)
+        self._timer.start(100)
+
+    def _check_ready(self):
+        if self.index.ready:
+            self._timer.stop()
+            self.indexReady.emit(json.dumps(self.index.stats()))
+
+    @Slot(str, int, result=str)
+    def search(self, query, limit):
+        start = time.perf_counter()
+        results = self.index.search(query, limit or DEFAULT_LIMIT)
+        return json.dumps({
+            'ready': self.index.ready,
+            'results': results,
+            'ms': round((time.perf_counter() - start) * 1000, 3),
+        })
+
+    @Slot(result=str)
+    def stats(self):
+        return json.dumps(self.index.stats())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Per-phase timing of a plugin launch. Set READIUM_READER_TIMING to
+#   stderr (or 1)  to print one json record per launch to stderr
+#   file           to append it to startup-timing.jsonl in the plugin prefs folder
+#   any other value to append it to the file of that name
+
+import os
+import sys
+import json
+import time
+import platform
+from contextlib import contextmanager
+
+ENV_VAR = 'READIUM_READER_TIMING'
+TIMING_FILE = 'startup-timing.jsonl'
+
+
+class PhaseTimer(object):
+
+    def __init__(self, destination=None):
+        self.destination = destination
+        self.t0 = time.perf_counter()
+        self.started = time.time()
+        self.phases = []
+        self.marks = {}
+        self.info = {}
+        self.emitted = False
+
+    @classmethod
+    def from_env(cls, pfolder):
+        value = os.environ.get(ENV_VAR, '').strip()
+        if not value or value == '0':
+            return cls()
+        if value in ('1', 'stderr'):
+            return cls('stderr')
+        if value == 'file':
+            return cls(os.path.join(pfolder, TIMING_FILE))
+        return cls(value)
+
+    @property
+    def enabled(self):
+        return self.destination is not None
+
+    def now(self):
+        return time.perf_counter() - self.t0
+
+    @contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.phases.append({'name': name, 'start': round(start, 6), 'duration': round(self.now() - start, 6)})
+
+    def mark(self, name, **extra):
+        ''' Record the first time something happened, relative to the start of run() '''
+        if name not in self.marks:
+            self.marks[name] = dict(extra, t=round(self.now(), 6))
+
+    def child(self):
+        ''' A timer on the same clock for work done on another thread, that
+            thread only touches the child and merge() brings it back in '''
+        timer = PhaseTimer()
+        timer.t0 = self.t0
+        return timer
+
+    def merge(self, other):
+        self.phases.extend(other.phases)
+        self.info.update(other.info)
+        for name, mark in other.marks.items():
+            self.marks.setdefault(name, mark)
+
+    def record(self):
+        return {
+            'started': self.started,
+            'python': platform.python_version(),
+            'platform': sys.platform,
+            'info': self.info,
+            'phases': self.phases,
+            'marks': self.marks,
+        }
+
+    def emit(self):
+        if not self.enabled or self.emitted:
+            return
+        self.emitted = True
+        line = json.dumps(self.record(), sort_keys=True)
+        try:
+            if self.destination == 'stderr':
+                print(line, file=sys.stderr)
+                sys.stderr.flush()
+            else:
+                os.makedirs(os.path.dirname(os.path.abspath(self.destination)), exist_ok=True)
+                with open(self.destination, 'a', encoding='utf-8') as f:
+                    f.write(line + '\n')
+        except EnvironmentError:
+            pass
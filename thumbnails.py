@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+# Copyright 2021 Kevin B. Hendricks, Stratford Ontario Canada
+# Copyright 2021 Doug Massay
+
+# This plugin's source code is available under the GNU LGPL Version 2.1 or GNU LGPL Version 3 License.
+# See https://www.gnu.org/licenses/old-licenses/lgpl-2.1.en.html or
+# https://www.gnu.org/licenses/lgpl.html for the complete text of the license.
+
+# Page thumbnails of the spine items of a book for strip and grid overviews.
+#
+# Every spine document is loaded on its own in one of a pool of hidden views
+# at a reduced viewport, grabbed once it has settled and scaled down. Each
+# view gets its own render process from QtWebEngine so the pool lays pages
+# out in parallel. Thumbnails are cached by a hash of the document, the
+# stylesheets and images it references (and whatever those stylesheets pull
+# in) and the render size, so only items whose sources changed are rendered
+# again.
+#
+#   python thumbnails.py BOOKDIR OUTDIR [-j 4] [--width 150]
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+
+from plugin_utils import QtCore, QtGui, QtWidgets, Qt, Signal
+from plugin_utils import QtWebEngineWidgets, QWebEnginePage, QWebEngineSettings
+from bookinfo import spine_documents, book_key, _referenced, _reference_pattern, _css_reference_pattern
+from bookcache import file_hash
+from lrustore import LRUStore, dir_size
+
+DEFAULT_BUDGET = 256 * 1024 * 1024
+VIEWPORT = (600, 800)
+THUMB_WIDTH = 150
+# time for fonts and images to settle after loadFinished
+SETTLE_MSECS = 150
+ITEM_TIMEOUT_MSECS = 20000
+
+
+class ThumbnailCache(object):
+
+    ''' PNGs under <cachedir>/<book key>/, one folder per book in an LRUStore '''
+
+    def __init__(self, cachedir, bookroot, key=None, budget=DEFAULT_BUDGET, size=None):
+        self.bookroot = bookroot
+        self.store = LRUStore(cachedir, budget)
+        self.key = key or book_key(bookroot)
+        self.folder = self.store.path(self.key)
+        os.makedirs(self.folder, exist_ok=True)
+        self.size = size or (VIEWPORT[0], VIEWPORT[1], THUMB_WIDTH)
+        self._hashes = {}
+
+    def _hash(self, bookpath):
+        if bookpath not in self._hashes:
+            try:
+                self._hashes[bookpath] = file_hash(os.path.join(self.bookroot, *bookpath.split('/')))
+            except OSError:
+                self._hashes[bookpath] = None
+        return self._hashes[bookpath]
+
+    def item_key(self, bookpath):
+        ''' Hash of everything that shows up in the item's thumbnail '''
+        digest = self._hash(bookpath)
+        if digest is None:
+            return None
+        h = hashlib.blake2b(digest_size=16)
+        h.update(json.dumps(self.size).encode('ascii'))
+        h.update(digest.encode('ascii'))
+        # url()s of inline styles and what the stylesheets pull in themselves
+        deps = set(_referenced(self.bookroot, bookpath, _css_reference_pattern))
+        for dep in _referenced(self.bookroot, bookpath, _reference_pattern):
+            deps.add(dep)
+            if dep.lower().endswith('.css'):
+                deps.update(_referenced(self.bookroot, dep, _css_reference_pattern))
+        for dep in sorted(deps):
+            h.update(dep.encode('utf-8'))
+            h.update((self._hash(dep) or '').encode('ascii'))
+        return h.hexdigest()
+
+    def path(self, item_key):
+        return os.path.join(self.folder, item_key + '.png')
+
+    def lookup(self, bookpath):
+        ''' (item key, cached png or None) '''
+        key = self.item_key(bookpath)
+        if key is None:
+            return None, None
+        p = self.path(key)
+        return key, (p if os.path.isfile(p) else None)
+
+    def finish(self, keep_keys):
+        # drop thumbnails of old versions of the items
+        keep = set(k + '.png' for k in keep_keys)
+        for name in os.listdir(self.folder):
+            if name.endswith('.png') and name not in keep:
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except OSError:
+                    pass
+        self.store.touch(self.key, dir_size(self.folder))
+        self.store.sweep(keep=(self.key,))
+
+
+class ThumbnailRenderer(QtCore.QObject):
+
+    ''' Renders the thumbnails of a book that are not in its cache yet '''
+
+    # idref, png path
+    thumbnailReady = Signal(str, str)
+    # idref, reason
+    thumbnailFailed = Signal(str, str)
+    finished = Signal()
+
+    def __init__(self, cache, url_for=None, workers=4, profile=None, parent=None):
+        QtCore.QObject.__init__(self, parent)
+        self.cache = cache
+        self.url_for = url_for or self._file_url
+        self.workers = max(1, workers)
+        self.profile = profile
+        self.queue = []
+        self.keys = []
+        self.views = []
+        # view -> (item, generation of its load)
+        self.busy = {}
+        self.generation = 0
+        self.stats = {'cached': 0, 'rendered': 0, 'failed': 0}
+
+    def _file_url(self, bookpath):
+        return QtCore.QUrl.fromLocalFile(os.path.join(self.cache.bookroot, *bookpath.split('/')))
+
+    def start(self):
+        for idref, bookpath in spine_documents(self.cache.bookroot):
+            key, cached = self.cache.lookup(bookpath)
+            if key is None:
+                self.thumbnailFailed.emit(idref, 'missing')
+                continue
+            self.keys.append(key)
+            if cached:
+                self.stats['cached'] += 1
+                self.thumbnailReady.emit(idref, cached)
+            else:
+                self.queue.append((idref, bookpath, key))
+        self.queue.reverse()
+        for i in range(min(self.workers, len(self.queue))):
+            self.views.append(self._make_view())
+        for view in self.views:
+            self._next(view)
+        if not self.queue and not self.busy:
+            self._done()
+
+    def _make_view(self):
+        view = QtWebEngineWidgets.QWebEngineView()
+        if self.profile is not None:
+            view.setPage(QWebEnginePage(self.profile, view))
+        s = view.settings()
+        s.setAttribute(QWebEngineSettings.WebAttribute.LocalContentCanAccessFileUrls, True)
+        s.setAttribute(QWebEngineSettings.WebAttribute.ShowScrollBars, False)
+        # laid out and painted like a visible window but never shown on screen
+        view.setAttribute(Qt.WA_DontShowOnScreen, True)
+        view.resize(*self.cache.size[:2])
+        view.show()
+        view.loadFinished.connect(lambda ok, view=view: self._loaded(view, ok))
+        timer = QtCore.QTimer(view)
+        timer.setSingleShot(True)
+        timer.timeout.connect(lambda view=view: self._failed(view, 'timed out'))
+        view._watchdog = timer
+        return view
+
+    def _next(self, view):
+        if not self.queue:
+            view.deleteLater()
+            if view in self.views:
+                self.views.remove(view)
+            if not self.busy:
+                self._done()
+            return
+        item = self.queue.pop()
+        self.generation += 1
+        self.busy[view] = (item, self.generation)
+        view._watchdog.start(ITEM_TIMEOUT_MSECS)
+        view.setUrl(self.url_for(item[1]))
+
+    def _loaded(self, view, ok):
+        job = self.busy.get(view)
+        if job is None:
+            return
+        if not ok:
+            self._failed(view, 'load failed')
+            return
+        generation = job[1]
+        QtCore.QTimer.singleShot(SETTLE_MSECS, lambda: self._capture(view, generation))
+
+    def _capture(self, view, generation):
+        job = self.busy.get(view)
+        if job is None or job[1] != generation:
+            # the load this was for has failed or timed out since
+            return
+        del self.busy[view]
+        view._watchdog.stop()
+        idref, bookpath, key = job[0]
+        image = view.grab().toImage()
+        thumb = image.scaledToWidth(self.cache.size[2], Qt.SmoothTransformation)
+        path = self.cache.path(key)
+        if thumb.save(path + '.part', 'PNG'):
+            os.replace(path + '.part', path)
+            self.stats['rendered'] += 1
+            self.thumbnailReady.emit(idref, path)
+        else:
+            self.stats['failed'] += 1
+            self.thumbnailFailed.emit(idref, 'could not save')
+        self._next(view)
+
+    def _failed(self, view, reason):
+        job = self.busy.pop(view, None)
+        if job is None:
+            return
+        view._watchdog.stop()
+        self.stats['failed'] += 1
+        self.thumbnailFailed.emit(job[0][0], reason)
+        # the aborted load can still report loadFinished(False) later and
+        # that signal says nothing about which load it was for, so the next
+        # item gets a view of its own rather than this one
+        view.stop()
+        if self.queue:
+            view.deleteLater()
+            self.views.remove(view)
+            view = self._make_view()
+            self.views.append(view)
+        self._next(view)
+
+    def _done(self):
+        if self.keys is None:
+            return
+        self.cache.finish(self.keys)
+        self.keys = None
+        self.finished.emit()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render page thumbnails of an unpacked epub')
+    parser.add_argument('book', help='unpacked book folder')
+    parser.add_argument('cachedir', help='thumbnail cache folder')
+    parser.add_argument('-j', '--workers', type=int, default=4, help='pages rendering at the same time')
+    parser.add_argument('--width', type=int, default=THUMB_WIDTH, help='thumbnail width in pixels')
+    parser.add_argument('--viewport', default='{}x{}'.format(*VIEWPORT), help='render size, WIDTHxHEIGHT')
+    args = parser.parse_args(argv)
+
+    vw, vh = (int(v) for v in args.viewport.lower().split('x'))
+    app = QtWidgets.QApplication([sys.argv[0]])
+    cache = ThumbnailCache(args.cachedir, os.path.abspath(args.book), size=(vw, vh, args.width))
+    renderer = ThumbnailRenderer(cache, workers=args.workers)
+    timer = QtCore.QElapsedTimer()
+    renderer.thumbnailReady.connect(lambda idref, path: print(idref, path))
+    renderer.thumbnailFailed.connect(lambda idref, why: print(idref, 'FAILED:', why, file=sys.stderr))
+    renderer.finished.connect(app.quit)
+    timer.start()
+    QtCore.QTimer.singleShot(0, renderer.start)
+    app.exec_()
+    print('{rendered} rendered, {cached} cached, {failed} failed'.format(**renderer.stats),
+          'in {:.2f}s'.format(timer.elapsed() / 1000.0))
+    return 1 if renderer.stats['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -59192,6 +59192,11 @@ define('readium_js/epub-model/package_document',['jquery', 'underscore', 'URIjs'
         // https://github.com/readium/readium-js-viewer/blob/develop/lib/EpubReader.js#L59
         this.generateTocListDOM = function(callback) {
             var that = this;
+            var sigilToc = (window.SigilReader && that.tocIsNcx()) ? window.SigilReader.tocList(that.getToc()) : null;
+            if (sigilToc) {
+                callback(sigilToc);
+                return;
+            }
             this.getTocDom(function (tocDom) {
                 if (tocDom) {
                     if (that.tocIsNcx()) {
@@ -59702,8 +59707,10 @@ define('readium_js/epub-model/package_document_parser',['jquery', 'underscore',
                 // TODO: Bindings are unused
                 var bindings = getJsonBindings(xmlDom);
 
-                var manifest = new Manifest(getJsonManifest(xmlDom));
-                var spine = getJsonSpine(xmlDom, manifest, metadata);
+                // the plugin may have worked these out already (sigil_hooks.js)
+                var sigilPackage = window.SigilReader ? window.SigilReader.packageFor(publicationFetcher.getPackageUrl(), xmlDom) : null;
+                var manifest = new Manifest(sigilPackage ? sigilPackage.manifest : getJsonManifest(xmlDom));
+                var spine = sigilPackage ? sigilPackage.spine : getJsonSpine(xmlDom, manifest, metadata);
 
                 // try to find a cover image
                 var cover = getCoverHref(xmlDom);
@@ -61159,7 +61166,10 @@ define('readium_js/Readium',['readium_shared_js/globals', 'text!version.json', '
 
             var scripts = "<script type=\"text/javascript\">(" + injectedScript.toString() + ")()<\/script>";
 
-            if (_options && _options.mathJaxUrl && contentDocumentHtml.search(/<(\w+:|)(?=math)/) >= 0) {
+            // the plugin knows which spine items have MathML, guess for the rest
+            var sigilMathML = window.SigilReader ? window.SigilReader.hasMathML(src) : null;
+            if (_options && _options.mathJaxUrl &&
+                (sigilMathML === null ? contentDocumentHtml.search(/<(\w+:|)(?=math)/) >= 0 : sigilMathML)) {
                 scripts += "<script type=\"text/javascript\" src=\"" + _options.mathJaxUrl + "\"> <\/script>";
             }
 
@@ -0,0 +1,322 @@
+// Small bridge between Readium and the ReadiumReader plugin's python side.
+// Events are passed to python as console messages that WebPage picks up,
+// which works the same for file:// and sigilreader:// pages in Qt5 and Qt6.
+(function () {
+    'use strict';
+
+    var EVENT_PREFIX = '__sigil_event__:';
+
+    function emit(name, data) {
+        console.info(EVENT_PREFIX + name + ':' + JSON.stringify(data || {}));
+    }
+
+    // Readium creates ReadiumSDK.reader asynchronously once its modules are loaded
+    function whenReader(callback) {
+        if (window.ReadiumSDK && window.ReadiumSDK.reader) {
+            callback(window.ReadiumSDK.reader);
+            return;
+        }
+        setTimeout(function () { whenReader(callback); }, 20);
+    }
+
+    var firstRender = true;
+    // {layout key: {idref: {pages: n, cfis: {page index: cfi}}}} remembered
+    // from earlier sessions (see locationcache.py) and kept up to date here
+    var locations = window.__sigilLocations || {};
+
+    // everything that changes how a spine item is split into pages
+    function layoutKey(reader) {
+        var s = reader.viewerSettings() || {};
+        return JSON.stringify([window.innerWidth, window.innerHeight, s.fontSize, s.fontSelection, s.columnGap,
+                               s.columnMaxWidth, s.columnMinWidth, s.syntheticSpread, s.scroll]);
+    }
+
+    function recordLocation(reader, pages) {
+        if (!pages || !pages.length) {
+            return;
+        }
+        var page = pages[0];
+        var layout = layoutKey(reader);
+        var bookmark = reader.bookmarkCurrentPage();
+        bookmark = bookmark ? JSON.parse(bookmark) : null;
+        var cfi = (bookmark && bookmark.idref === page.idref) ? bookmark.contentCFI : null;
+        var items = locations[layout] = locations[layout] || {};
+        var item = items[page.idref];
+        if (!item || item.pages !== page.spineItemPageCount) {
+            item = items[page.idref] = {pages: page.spineItemPageCount, cfis: {}};
+        }
+        if (cfi) {
+            item.cfis[page.spineItemPageIndex] = cfi;
+        }
+        emit('location', {layout: layout, idref: page.idref, pages: page.spineItemPageCount,
+                          index: page.spineItemPageIndex, cfi: cfi});
+    }
+    // manifest, spine and toc of the book worked out by the plugin (see
+    // packagecache.py), picked up by Readium's PackageDocumentParser
+    var packageData = window.__sigilPackage || null;
+
+    function urlPath(url) {
+        url = String(url).split(/[?#]/)[0];
+        try {
+            return decodeURIComponent(url);
+        } catch (e) {
+            return url;
+        }
+    }
+
+    function packageFor(packageUrl, packageDom) {
+        if (!packageData || !packageUrl) {
+            return null;
+        }
+        var path = urlPath(packageUrl);
+        if (path.slice(-(packageData.opf.length + 1)) !== '/' + packageData.opf) {
+            return null;
+        }
+        // a cheap check that the OPF Readium got is the one the plugin parsed
+        if (packageDom && (packageDom.getElementsByTagNameNS('*', 'itemref').length !== packageData.spine.length ||
+                           packageDom.getElementsByTagNameNS('*', 'item').length !== packageData.manifest.length)) {
+            return null;
+        }
+        return packageData;
+    }
+
+    function addTocItems(ol, items) {
+        for (var i = 0; i < items.length; i++) {
+            var li = document.createElement('li');
+            li.className = 'nav-elem';
+            var a = document.createElement('a');
+            if (items[i].href) {
+                a.setAttribute('href', items[i].href);
+            }
+            a.textContent = items[i].text;
+            li.appendChild(a);
+            ol.appendChild(li);
+            if (items[i].children.length) {
+                var sub = document.createElement('li');
+                var subOl = document.createElement('ol');
+                addTocItems(subOl, items[i].children);
+                sub.appendChild(subOl);
+                ol.appendChild(sub);
+            }
+        }
+    }
+
+    // the same list Readium builds from an ncx navMap
+    function tocList(tocUrl) {
+        if (!packageData || packageData.toc_source !== 'ncx' || !packageData.toc_items) {
+            return null;
+        }
+        if (tocUrl && urlPath(tocUrl).slice(-packageData.toc.length) !== packageData.toc) {
+            return null;
+        }
+        var ol = document.createElement('ol');
+        addTocItems(ol, packageData.toc_items);
+        return ol;
+    }
+
+    function toc() {
+        return packageData ? packageData.toc_items : null;
+    }
+
+    // which spine documents have MathML (see mathscan.py)
+    var mathml = window.__sigilMathML || null;
+
+    // whether Readium should add MathJax to the content document at src:
+    // never for a book whose every spine document was found without MathML,
+    // otherwise what the scan found for the document and null (let Readium
+    // check it itself) for anything it did not scan
+    function hasMathML(src) {
+        if (!mathml || !src) {
+            return null;
+        }
+        if (!mathml.book && mathml.complete) {
+            return false;
+        }
+        var path = urlPath(src);
+        for (var bookpath in mathml.items) {
+            if (path.slice(-(bookpath.length + 1)) === '/' + bookpath) {
+                return mathml.items[bookpath];
+            }
+        }
+        return null;
+    }
+
+    // The plugin works the globals above out while the viewer starts and sets
+    // them whenever they are ready, anything Readium has already done without
+    // them stays as it is. Page counts recorded this session win.
+    function setBookData() {
+        var loaded = window.__sigilLocations || {};
+        for (var layout in loaded) {
+            var items = locations[layout] = locations[layout] || {};
+            for (var idref in loaded[layout]) {
+                if (!items[idref]) {
+                    items[idref] = loaded[layout][idref];
+                }
+            }
+        }
+        packageData = window.__sigilPackage || packageData;
+        mathml = window.__sigilMathML || mathml;
+    }
+
+    // what Readium last opened the book with, so one spine item can be re-rendered
+    var lastOpenBookData = null;
+
+    whenReader(function (reader) {
+        var openBook = reader.openBook;
+        reader.openBook = function (openBookData) {
+            lastOpenBookData = openBookData;
+            return openBook.apply(this, arguments);
+        };
+        emit('reader-ready', {t: performance.now()});
+        reader.on(ReadiumSDK.Events.PAGINATION_CHANGED, function (pageChangeData) {
+            var pages = (pageChangeData && pageChangeData.paginationInfo) ? pageChangeData.paginationInfo.openPages : [];
+            recordLocation(reader, pages);
+            if (!firstRender) {
+                return;
+            }
+            firstRender = false;
+            emit('first-render', {
+                t: performance.now(),
+                idref: (pages && pages.length) ? pages[0].idref : null
+            });
+        });
+    });
+
+    // Reload the spine item on screen at the current position, without
+    // reloading the viewer, if it is one of idrefs (or always if idrefs is null).
+    // Returns the idref that was re-rendered or null.
+    function rerender(idrefs) {
+        var reader = window.ReadiumSDK && window.ReadiumSDK.reader;
+        if (!reader || !lastOpenBookData) {
+            return null;
+        }
+        var bookmark = reader.bookmarkCurrentPage();
+        bookmark = bookmark ? JSON.parse(bookmark) : null;
+        if (!bookmark || (idrefs && idrefs.indexOf(bookmark.idref) < 0)) {
+            return null;
+        }
+        var data = {};
+        for (var key in lastOpenBookData) {
+            data[key] = lastOpenBookData[key];
+        }
+        data.settings = reader.viewerSettings();
+        data.openPageRequest = {idref: bookmark.idref, elementCfi: bookmark.contentCFI};
+        reader.openBook(data);
+        return bookmark.idref;
+    }
+
+    // Book-wide page count for the current layout, null while some spine
+    // item has never been laid out with it
+    function pageCount() {
+        var reader = window.ReadiumSDK && window.ReadiumSDK.reader;
+        if (!reader || !reader.spine()) {
+            return null;
+        }
+        var items = locations[layoutKey(reader)] || {};
+        var total = 0;
+        var spine = reader.spine().items;
+        for (var i = 0; i < spine.length; i++) {
+            if (!items[spine[i].idref]) {
+                return null;
+            }
+            total += items[spine[i].idref].pages;
+        }
+        return total;
+    }
+
+    // Jump to a 0-based book-wide page using the remembered page counts,
+    // only the target spine item gets laid out. Returns false if unknown.
+    function gotoPage(n) {
+        var reader = window.ReadiumSDK && window.ReadiumSDK.reader;
+        if (!reader || !reader.spine()) {
+            return false;
+        }
+        var items = locations[layoutKey(reader)] || {};
+        var spine = reader.spine().items;
+        for (var i = 0; i < spine.length; i++) {
+            var item = items[spine[i].idref];
+            if (!item) {
+                return false;
+            }
+            if (n < item.pages) {
+                if (item.cfis[n]) {
+                    reader.openSpineItemElementCfi(spine[i].idref, item.cfis[n]);
+                } else {
+                    reader.openSpineItemPage(spine[i].idref, n);
+                }
+                return true;
+            }
+            n -= item.pages;
+        }
+        return false;
+    }
+
+    // Full-text search through the plugin's index (searchindex.py), callback
+    // gets {ready, results: [{idref, href, offset, length, snippet}], ms}
+    function search(query, limit, callback) {
+        if (!window.SigilSearch) {
+            callback({ready: false, results: [], error: 'search is not available'});
+            return;
+        }
+        window.SigilSearch.search(query, limit || 100, function (reply) {
+            callback(JSON.parse(reply));
+        });
+    }
+
+    // The text node holding character offset of the body's text, counted the
+    // way searchindex.extract_text() does
+    function textPosition(body, offset) {
+        var walker = body.ownerDocument.createTreeWalker(body, NodeFilter.SHOW_TEXT, {
+            acceptNode: function (node) {
+                var tag = node.parentNode && node.parentNode.nodeName.toLowerCase();
+                return (tag === 'script' || tag === 'style') ? NodeFilter.FILTER_REJECT : NodeFilter.FILTER_ACCEPT;
+            }
+        });
+        var node;
+        while ((node = walker.nextNode())) {
+            if (offset < node.data.length) {
+                return node;
+            }
+            offset -= node.data.length;
+        }
+        return null;
+    }
+
+    function openSearchResult(result) {
+        var reader = window.ReadiumSDK && window.ReadiumSDK.reader;
+        if (!reader) {
+            return;
+        }
+        function reveal() {
+            var body = reader.getElement(result.idref, 'body');
+            // Readium hands back a jQuery wrapper
+            body = (body && body.jquery) ? body[0] : body;
+            var node = body ? textPosition(body, result.offset) : null;
+            if (node) {
+                reader.insureElementVisibility(result.idref, node.parentNode);
+            }
+        }
+        var pages = reader.getPaginationInfo().openPages;
+        if (pages.length && pages[0].idref === result.idref) {
+            reveal();
+            return;
+        }
+        reader.once(ReadiumSDK.Events.PAGINATION_CHANGED, reveal);
+        reader.openSpineItemPage(result.idref, 0);
+    }
+
+    window.SigilReader = {
+        emit: emit,
+        whenReader: whenReader,
+        rerender: rerender,
+        pageCount: pageCount,
+        gotoPage: gotoPage,
+        search: search,
+        openSearchResult: openSearchResult,
+        packageFor: packageFor,
+        tocList: tocList,
+        toc: toc,
+        hasMathML: hasMathML,
+        setBookData: setBookData
+    };
+})();